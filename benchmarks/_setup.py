@@ -0,0 +1,37 @@
+"""Shared setup for the benchmark scripts.
+
+The benchmarks reuse the settings of ``runtests.py`` and run against a
+fresh test database.
+"""
+from os.path import abspath, dirname
+import sys
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+
+def setup():
+    """Configure Django and create the test database.
+
+    Returns a callable that destroys the test database.
+    """
+    import django
+    from django.conf import settings
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment
+    from runtests import DEFAULT_SETTINGS
+
+    if not settings.configured:
+        settings.configure(**DEFAULT_SETTINGS)
+    django.setup()
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    return lambda: runner.teardown_databases(old_config)
+
+
+def timed(func, *args, **kwargs):
+    """Call ``func`` and return ``(seconds, result)``."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
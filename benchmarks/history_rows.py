@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Time rendering a list of historical records.
+
+Mirrors the admin history page, which touches ``history_object`` more
+than once per row.
+
+    python benchmarks/history_rows.py [rows]
+"""
+from datetime import datetime, timedelta
+import sys
+
+from _setup import setup, timed
+
+TEMPLATE = (
+    "{% for action in action_list %}"
+    "{{ action.history_object }} {{ action.history_object.pk }} "
+    "{{ action.instance.question }} {{ action.history_date }}\n"
+    "{% endfor %}"
+)
+
+
+def report(label, rows, seconds):
+    print("%s: %d rows in %.3fs (%.1f us/row)" % (
+        label, rows, seconds, seconds * 1e6 / rows))
+
+
+def main(rows=10000):
+    teardown = setup()
+    try:
+        from django.template import Context, Template
+        from simple_history.tests.models import HistoricalPoll, Poll
+
+        now = datetime.now()
+        poll = Poll.objects.create(question="benchmark", pub_date=now)
+        HistoricalPoll.objects.bulk_create(
+            HistoricalPoll(id=poll.pk, question="question %d" % i,
+                           pub_date=now, history_type='~',
+                           history_date=now + timedelta(seconds=i))
+            for i in range(rows))
+
+        def access(action_list):
+            for action in action_list:
+                str(action.history_object)
+                action.history_object.pk
+                action.instance.question
+
+        action_list = list(poll.history.all())
+        seconds, _ = timed(access, action_list)
+        report("history_object access", len(action_list), seconds)
+
+        action_list = list(poll.history.all())
+        template = Template(TEMPLATE)
+        seconds, _ = timed(template.render,
+                           Context({'action_list': action_list}))
+        report("template render", len(action_list), seconds)
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
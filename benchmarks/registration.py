@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Time Django startup with many models registered for history.
+
+Generates an app of synthetic models, each with a foreign key to the
+previous one and a number of extra methods and properties, and times
+``django.setup()`` in a fresh process, reporting how much of it is the
+relation setup run from ``AppConfig.ready()``. With ``list`` the models are
+registered with a single ``register_model_list()`` call.
+
+    python benchmarks/registration.py [models] [attributes] [list]
+"""
+from os.path import abspath, dirname, join
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_NAME = 'registration_benchmark'
+
+MODELS = '''
+from django.db import models
+
+from simple_history import register, register_model_list
+
+
+def method(self):
+    return self.pk
+
+previous = None
+model_list = []
+for i in range(%(models)d):
+    attrs = {
+        '__module__': __name__,
+        'name': models.CharField(max_length=20),
+    }
+    for j in range(%(attributes)d):
+        attrs['method_%%d' %% j] = method
+        attrs['property_%%d' %% j] = property(method)
+    if previous is not None:
+        attrs['parent'] = models.ForeignKey(previous, null=True)
+    previous = type(str('Synthetic%%d' %% i), (models.Model,), attrs)
+    if %(batch)r:
+        model_list.append(previous)
+    else:
+        register(previous)
+register_model_list(model_list[::-1])
+'''
+
+
+def child(path):
+    sys.path.insert(0, path)
+    import django
+    from django.conf import settings
+    from simple_history.apps import SimpleHistoryConfig
+
+    relations = [0.0]
+    ready = SimpleHistoryConfig.ready
+
+    def timed_ready(self):
+        start = time.time()
+        ready(self)
+        relations[0] += time.time() - start
+
+    SimpleHistoryConfig.ready = timed_ready
+    settings.configure(
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'simple_history',
+            APP_NAME,
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+    )
+    start = time.time()
+    django.setup()
+    print("%f %f" % (time.time() - start, relations[0]))
+
+
+def main(models=300, attributes=50, batch=False):
+    path = tempfile.mkdtemp()
+    try:
+        os.mkdir(join(path, APP_NAME))
+        open(join(path, APP_NAME, '__init__.py'), 'w').close()
+        with open(join(path, APP_NAME, 'models.py'), 'w') as f:
+            f.write(MODELS % {'models': models, 'attributes': attributes,
+                              'batch': batch})
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [dirname(dirname(abspath(__file__))), env.get('PYTHONPATH', '')])
+        output = subprocess.check_output(
+            [sys.executable, abspath(__file__), '--child', path], env=env)
+        seconds, relations = [float(value)
+                              for value in output.decode().split()[-2:]]
+        print("setup: %d models with %d extra attributes in %.3fs "
+              "(%.2f ms/model)" % (models, attributes * 2, seconds,
+                                   seconds * 1e3 / models))
+        print("relation setup: %.3fs (%.2f ms/model)" % (
+            relations, relations * 1e3 / models))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:3]],
+             batch=sys.argv[3:] == ['list'])
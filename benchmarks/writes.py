@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Time saves of tracked models with and without write metrics.
+
+Each save of a choice writes its historical record and links it to the
+history of its poll.
+
+    python benchmarks/writes.py [saves]
+"""
+from datetime import datetime
+import sys
+
+from _setup import setup, timed
+
+
+def report(label, saves, seconds):
+    print("%s: %d saves in %.3fs (%.1f us/save)" % (
+        label, saves, seconds, seconds * 1e6 / saves))
+
+
+def main(saves=2000):
+    teardown = setup()
+    try:
+        from django.test.utils import override_settings
+        from simple_history.tests.models import Choice, Poll
+
+        poll = Poll.objects.create(question="benchmark",
+                                   pub_date=datetime.now())
+        choice = Choice.objects.create(poll=poll, choice="benchmark", votes=0)
+
+        def save():
+            for votes in range(saves):
+                choice.votes = votes
+                choice.save()
+
+        seconds, _ = timed(save)
+        report("metrics disabled", saves, seconds)
+        with override_settings(SIMPLE_HISTORY_METRICS=True):
+            seconds, _ = timed(save)
+        report("metrics enabled", saves, seconds)
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,10 +1,14 @@
 from __future__ import unicode_literals
+from functools import reduce
+import heapq
+
 from django.db.models.query import Q
-from django.db.models.loading import get_model
 from django.db.models.signals import post_save, m2m_changed
 
 __version__ = '1.8.1'
 
+default_app_config = 'simple_history.apps.SimpleHistoryConfig'
+
 
 def register(
         model, app=None, manager_name='history', records_class=None,
@@ -23,6 +27,14 @@ def register(
     This method should be used as an alternative to attaching an
     `HistoricalManager` instance directly to `model`.
     """
+    records = _create_history(model, app, manager_name, records_class,
+                              table_name, **records_config)
+    records.setup_relations(model)
+
+
+def _create_history(model, app=None, manager_name='history',
+                    records_class=None, table_name=None, **records_config):
+    """Create the historical model of `model`, leaving its relations."""
     from . import models
 
     if records_class is None:
@@ -35,16 +47,61 @@ def register(
     records.add_extra_methods(model)
     records.finalize(model)
     models.registered_models[model._meta.db_table] = model
-    records.setup_m2m_history(model)
-    records.create_fake_m2m(model)
+    return records
+
+
+def dependency_order(model_list):
+    """
+    Order `model_list` so that every model comes after the models of the
+    list it has foreign keys to, keeping the list order otherwise.
+
+    Cycles of foreign keys are broken in list order.
+    """
+    index = dict((model, i) for i, model in enumerate(model_list))
+    waiting = {}
+    dependents = dict((model, []) for model in model_list)
+    for model in model_list:
+        targets = set(field.rel.to for field in model._meta.fields
+                      if field.rel is not None and field.rel.to in index and
+                      field.rel.to is not model)
+        waiting[model] = len(targets)
+        for target in targets:
+            dependents[target].append(model)
+    available = [(index[model], model) for model in model_list
+                 if not waiting[model]]
+    heapq.heapify(available)
+    ordered = []
+    done = set()
+    remaining = iter(model_list)
+    while len(ordered) < len(model_list):
+        if not available:  # a cycle: take the first model left
+            model = next(model for model in remaining if model not in done)
+            available.append((index[model], model))
+        position, model = heapq.heappop(available)
+        if model in done:
+            continue
+        done.add(model)
+        ordered.append(model)
+        for dependent in dependents[model]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(available, (index[dependent], dependent))
+    return ordered
 
 
 def register_model_list(model_list):
+    """
+    Register every model of `model_list` for history tracking.
+
+    The historical models are created in `dependency_order`, then the
+    history of the relations of all the models is set up in one pass.
+    """
     from . import models
 
     models.future_register_models = model_list
-    for mdl in model_list:
-        register(mdl)
+    models.setup_relations([
+        (_create_history(model), model, True)
+        for model in dependency_order(model_list)])
 
 
 def init_historical_records_from_model(model, is_m2m=False):
@@ -58,7 +115,7 @@ def init_historical_records_from_model(model, is_m2m=False):
         for field in real_instance_fields:
             query_list.append(Q(**{field: getattr(real_instance, field)}))
         query = reduce(lambda x, y: x & y, query_list, Q())
-        if historical_models.registered_historical_models[model.__name__].objects.filter(query).exists():
+        if historical_models.history_registry.get(model).objects.filter(query).exists():
             continue
         else:
             if is_m2m:
@@ -77,10 +134,10 @@ def init_historical_records_from_model(model, is_m2m=False):
 def init_historical_records():
     from . import models
 
-    for model_name, hist_model in models.registered_historical_models.items():
+    for model, hist_model in list(models.history_registry.items()):
         if not hist_model.is_m2m:
-            init_historical_records_from_model(get_model(hist_model._meta.app_label, model_name))
+            init_historical_records_from_model(model)
 
-    for model_name, hist_model in models.registered_historical_models.items():
+    for model, hist_model in list(models.history_registry.items()):
         if hist_model.is_m2m:
-            init_historical_records_from_model(get_model(hist_model._meta.app_label, model_name), is_m2m=True)
+            init_historical_records_from_model(model, is_m2m=True)
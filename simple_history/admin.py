@@ -1,13 +1,18 @@
 from __future__ import unicode_literals
 
+from datetime import datetime, time
+import re
+
 from django import http
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.admin import helpers
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import NoReverseMatch, reverse
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.text import capfirst
 from django.utils.html import mark_safe
 from django.utils.translation import ugettext as _
@@ -19,15 +24,89 @@ try:
 except ImportError:  # Django < 1.7
     from django.contrib.admin.util import unquote
 
+from .cache import get_snapshot_cache, record_values
+from .export import EXPORT_FORMATS, export_history
+from .manager import (diff_records, get_field_attnames, get_target_field,
+                      instance_from_values, keyset_filter, keyset_order)
+
 USER_NATURAL_KEY = tuple(
     key.lower() for key in settings.AUTH_USER_MODEL.split('.', 1))
 
 SIMPLE_HISTORY_EDIT = getattr(settings, 'SIMPLE_HISTORY_EDIT', False)
 
+# Characters replaced in the object ids put in export file names.
+UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class HistoryPage(object):
+    """A keyset-paginated page of historical records.
+
+    ``newer_cursor`` and ``older_cursor`` identify the first and last
+    records on the page when there are more records in that direction.
+    """
+
+    def __init__(self, object_list, newer_cursor=None, older_cursor=None):
+        self.object_list = object_list
+        self.newer_cursor = newer_cursor
+        self.older_cursor = older_cursor
+
+    def has_other_pages(self):
+        return bool(self.newer_cursor or self.older_cursor)
+
+
+def make_cursor(record):
+    return '%s_%s' % (record.history_date.isoformat(), record.history_id)
+
+
+def parse_cursor(cursor):
+    """Return ``(history_date, history_id)`` or ``None`` if invalid."""
+    history_date, _, history_id = (cursor or '').rpartition('_')
+    try:
+        history_date = parse_datetime(history_date)
+        history_id = int(history_id)
+    except ValueError:
+        return None
+    if history_date is None:
+        return None
+    return history_date, history_id
+
+
+def parse_history_date(value):
+    """Parse a date or datetime from the query string, else ``None``."""
+    try:
+        history_date = parse_datetime(value or '')
+        if history_date is None:
+            day = parse_date(value or '')
+            if day is None:
+                return None
+            history_date = datetime.combine(day, time())
+    except ValueError:
+        return None
+    if settings.USE_TZ and timezone.is_naive(history_date):
+        history_date = timezone.make_aware(history_date)
+    return history_date
+
+
+def page_url(request, **params):
+    """Return the query string of ``request`` with another page cursor."""
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    query.update(params)
+    return '?%s' % query.urlencode()
+
 
 class SimpleHistoryAdmin(admin.ModelAdmin):
     object_history_template = "simple_history/object_history.html"
     object_history_form_template = "simple_history/object_history_form.html"
+    recent_history_template = "simple_history/recent_history.html"
+    object_history_compare_template = (
+        "simple_history/object_history_compare.html")
+    history_export_chunk_size = 1000
+    history_list_per_page = 100
+    # Names of the tracked model's fields loaded for every row of the
+    # history list, e.g. the ones used by its __str__. None loads them all.
+    history_list_fields = None
 
     def get_urls(self):
         """Returns the additional urls used by the Reversion admin."""
@@ -35,7 +114,21 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         admin_site = self.admin_site
         opts = self.model._meta
         info = opts.app_label, opts.model_name
+        # Object ids in admin URLs have "_" quoted, so the model-wide pages
+        # cannot be mistaken for the change page of an object.
         history_urls = [
+            url("^_history/$",
+                admin_site.admin_view(self.recent_history_view),
+                name='%s_%s_recent_history' % info),
+            url("^_history/export/$",
+                admin_site.admin_view(self.export_history_view),
+                name='%s_%s_export_history' % info),
+            url("^([^/]+)/history/export/$",
+                admin_site.admin_view(self.export_history_view),
+                name='%s_%s_export_object_history' % info),
+            url("^([^/]+)/history/([^/]+)/compare/([^/]+)/$",
+                admin_site.admin_view(self.history_compare_view),
+                name='%s_%s_compare_history' % info),
             url("^([^/]+)/history/([^/]+)/$",
                 admin_site.admin_view(self.history_form_view),
                 name='%s_%s_simple_history' % info),
@@ -52,32 +145,300 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         history = getattr(model, model._meta.simple_history_manager_attribute)
         object_id = unquote(object_id)
         action_list = history.filter(**{pk_name: object_id})
-        # If no history was found, see whether this object even exists.
+        history_page = self.paginate_history(request, action_list)
         try:
             obj = model.objects.get(**{pk_name: object_id})
         except model.DoesNotExist:
-            try:
-                obj = action_list.latest('history_date').instance
-            except action_list.model.DoesNotExist:
-                raise http.Http404
-        content_type = ContentType.objects.get_by_natural_key(
-            *USER_NATURAL_KEY)
-        admin_user_view = 'admin:%s_%s_change' % (content_type.app_label,
-                                                  content_type.model)
+            # The object was deleted; show it as of its latest record.
+            obj = self._get_deleted_instance(action_list, history_page)
+        admin_user_view = 'admin:%s_%s_change' % USER_NATURAL_KEY
+        revert_view = '%s:%s_%s_simple_history' % (
+            self.admin_site.name, app_label, opts.model_name)
+        compare_view = '%s:%s_%s_compare_history' % (
+            self.admin_site.name, app_label, opts.model_name)
+        older_actions = history_page.object_list[1:] + [None]
+        for action, older in zip(history_page.object_list, older_actions):
+            action.admin_revert_url = reverse(
+                revert_view, args=(obj.pk, action.pk),
+                current_app=request.current_app)
+            action.admin_compare_url = None
+            if older is not None:
+                action.admin_compare_url = reverse(
+                    compare_view, args=(obj.pk, older.pk, action.pk),
+                    current_app=request.current_app)
+            action.admin_user_url = None
+            if action.history_user_id is not None:
+                try:
+                    action.admin_user_url = reverse(
+                        admin_user_view, args=(action.history_user_id,),
+                        current_app=request.current_app)
+                except NoReverseMatch:
+                    pass
         context = {
             'title': _('Change history: %s') % force_text(obj),
-            'action_list': action_list,
+            'action_list': history_page.object_list,
+            'history_page': history_page,
             'module_name': capfirst(force_text(opts.verbose_name_plural)),
             'object': obj,
             'root_path': getattr(self.admin_site, 'root_path', None),
             'app_label': app_label,
             'opts': opts,
-            'admin_user_view': admin_user_view
+            'admin_user_view': admin_user_view,
+            'export_urls': self.get_export_urls(request),
         }
         context.update(extra_context or {})
         return render(request, template_name=self.object_history_template,
                       dictionary=context, current_app=request.current_app)
 
+    def recent_history_view(self, request, extra_context=None):
+        """List the history of every object of this model, newest first."""
+        request.current_app = self.admin_site.name
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        model = self.model
+        opts = model._meta
+        history = getattr(model, opts.simple_history_manager_attribute)
+        filters = self.get_recent_history_filters(request)
+        history_page = self.paginate_history(
+            request, history.filter(**filters))
+        url_prefix = '%s:%s_%s_' % (
+            self.admin_site.name, opts.app_label, opts.model_name)
+        admin_user_view = 'admin:%s_%s_change' % USER_NATURAL_KEY
+        for action in history_page.object_list:
+            object_id = getattr(action, opts.pk.attname)
+            action.admin_history_url = reverse(
+                url_prefix + 'history', args=(object_id,),
+                current_app=request.current_app)
+            action.admin_revert_url = reverse(
+                url_prefix + 'simple_history', args=(object_id, action.pk),
+                current_app=request.current_app)
+            action.admin_user_url = None
+            if action.history_user_id is not None:
+                try:
+                    action.admin_user_url = reverse(
+                        admin_user_view, args=(action.history_user_id,),
+                        current_app=request.current_app)
+                except NoReverseMatch:
+                    pass
+        context = {
+            'title': _('Recent changes: %s') % force_text(
+                opts.verbose_name_plural),
+            'action_list': history_page.object_list,
+            'history_page': history_page,
+            'newer_url': page_url(request, after=history_page.newer_cursor)
+            if history_page.newer_cursor else None,
+            'older_url': page_url(request, before=history_page.older_cursor)
+            if history_page.older_cursor else None,
+            'filters': request.GET,
+            'export_urls': self.get_export_urls(request),
+            'history_types': history.model._meta.get_field(
+                'history_type').choices,
+            'module_name': capfirst(force_text(opts.verbose_name_plural)),
+            'root_path': getattr(self.admin_site, 'root_path', None),
+            'app_label': opts.app_label,
+            'opts': opts,
+        }
+        context.update(extra_context or {})
+        return render(request, template_name=self.recent_history_template,
+                      dictionary=context, current_app=request.current_app)
+
+    def export_history_view(self, request, object_id=None):
+        """Stream the history of this model, or of one object, as a file.
+
+        The ``format`` query parameter selects ``csv`` (the default) or
+        ``jsonl`` and ``gzip=1`` compresses the file. The recent history
+        filters apply as well. Objects without history are not found.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise http.Http404
+        compress = request.GET.get('gzip') == '1'
+        opts = self.model._meta
+        history = getattr(self.model, opts.simple_history_manager_attribute)
+        queryset = history.filter(**self.get_recent_history_filters(request))
+        filename = '%s_%s_history' % (opts.app_label, opts.model_name)
+        if object_id is not None:
+            try:
+                object_id = opts.pk.to_python(unquote(object_id))
+            except ValidationError:
+                raise http.Http404
+            if not history.filter(**{opts.pk.attname: object_id}).exists():
+                raise http.Http404
+            queryset = queryset.filter(**{opts.pk.attname: object_id})
+            filename = '%s_%s' % (filename, UNSAFE_FILENAME_CHARS.sub(
+                '_', force_text(object_id)))
+        filename = '%s.%s' % (filename, export_format)
+        if compress:
+            content_type = 'application/gzip'
+            filename += '.gz'
+        else:
+            content_type = '%s; charset=utf-8' % EXPORT_FORMATS[export_format]
+        response = http.StreamingHttpResponse(
+            export_history(queryset, export_format,
+                           chunk_size=self.history_export_chunk_size,
+                           compress=compress),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename="%s"' % filename)
+        return response
+
+    def get_export_urls(self, request):
+        """Return ``(label, url)`` pairs linking to the history exports.
+
+        The URLs are relative to the history pages and keep their filters.
+        """
+        return [
+            (_('CSV'), 'export/' + page_url(request, format='csv')),
+            (_('JSON Lines'), 'export/' + page_url(request, format='jsonl')),
+        ]
+
+    def get_recent_history_filters(self, request):
+        """Return the lookups selected with the recent history filters.
+
+        ``since`` and ``until`` take a date or datetime, ``user`` a user id
+        and ``history_type`` one of ``+``, ``~`` or ``-``. Invalid values
+        are ignored.
+        """
+        history_model = getattr(
+            self.model, self.model._meta.simple_history_manager_attribute
+        ).model
+        filters = {}
+        since = parse_history_date(request.GET.get('since'))
+        if since is not None:
+            filters['history_date__gte'] = since
+        until = parse_history_date(request.GET.get('until'))
+        if until is not None:
+            filters['history_date__lt'] = until
+        user = request.GET.get('user')
+        if user:
+            user_field = get_target_field(
+                history_model._meta.get_field('history_user'))
+            try:
+                filters['history_user'] = user_field.to_python(user)
+            except ValidationError:
+                pass
+        history_type = request.GET.get('history_type')
+        if history_type in dict(history_model._meta.get_field(
+                'history_type').choices):
+            filters['history_type'] = history_type
+        return filters
+
+    def history_compare_view(self, request, object_id, old_version_id,
+                             new_version_id, extra_context=None):
+        """Show the fields that differ between two versions of an object.
+
+        Both versions are read as raw values with a single query; no form
+        is built.
+        """
+        request.current_app = self.admin_site.name
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        model = self.model
+        opts = model._meta
+        history = getattr(model, opts.simple_history_manager_attribute)
+        object_id = unquote(object_id)
+        try:
+            diff = diff_records(
+                history.filter(**{opts.pk.attname: object_id}),
+                old_version_id, new_version_id)
+        except (history.model.DoesNotExist, ValidationError):
+            raise http.Http404
+        url_prefix = '%s:%s_%s_' % (
+            self.admin_site.name, opts.app_label, opts.model_name)
+        for version in (diff.old, diff.new):
+            version['admin_revert_url'] = reverse(
+                url_prefix + 'simple_history',
+                args=(object_id, version['history_id']),
+                current_app=request.current_app)
+        changes = [
+            (capfirst(force_text(field.verbose_name)),
+             self.get_compare_value(field, old_value),
+             self.get_compare_value(field, new_value))
+            for field, old_value, new_value in diff.changes
+        ]
+        context = {
+            'title': _('Compare versions: %s') % force_text(
+                opts.verbose_name),
+            'old': diff.old,
+            'new': diff.new,
+            'changes': changes,
+            'history_url': reverse(url_prefix + 'history',
+                                   args=(object_id,),
+                                   current_app=request.current_app),
+            'object_id': object_id,
+            'module_name': capfirst(force_text(opts.verbose_name_plural)),
+            'root_path': getattr(self.admin_site, 'root_path', None),
+            'app_label': opts.app_label,
+            'opts': opts,
+        }
+        context.update(extra_context or {})
+        return render(request,
+                      template_name=self.object_history_compare_template,
+                      dictionary=context, current_app=request.current_app)
+
+    def get_compare_value(self, field, value):
+        """Return the value of ``field`` as shown on the compare page."""
+        if field.choices:
+            return dict(field.flatchoices).get(value, value)
+        return value
+
+    def get_history_list_queryset(self, queryset):
+        """Restrict the columns loaded for the history list."""
+        queryset = queryset.select_related('history_user')
+        if self.history_list_fields is not None:
+            queryset = queryset.only(
+                'history_id', 'history_date', 'history_type', 'history_user',
+                self.model._meta.pk.name, *self.history_list_fields)
+        return queryset
+
+    def paginate_history(self, request, queryset):
+        """Return a :class:`HistoryPage` of ``queryset``, newest first.
+
+        Pages are selected with the ``before`` and ``after`` cursors in
+        the query string, so every page costs a single indexed query.
+        """
+        per_page = self.history_list_per_page
+        queryset = self.get_history_list_queryset(queryset)
+        after = parse_cursor(request.GET.get('after'))
+        before = parse_cursor(request.GET.get('before'))
+        if after is not None:
+            records = list(keyset_order(
+                keyset_filter(queryset, *after, descending=False),
+            )[:per_page + 1])
+            has_newer, has_older = len(records) > per_page, True
+            records = records[:per_page][::-1]
+        else:
+            if before is not None:
+                queryset = keyset_filter(queryset, *before, descending=True)
+            records = list(keyset_order(
+                queryset, descending=True)[:per_page + 1])
+            has_newer, has_older = before is not None, len(records) > per_page
+            records = records[:per_page]
+        if not records:
+            return HistoryPage(records)
+        return HistoryPage(
+            records,
+            newer_cursor=make_cursor(records[0]) if has_newer else None,
+            older_cursor=make_cursor(records[-1]) if has_older else None,
+        )
+
+    def _get_deleted_instance(self, action_list, history_page):
+        """Rebuild a deleted object from its latest historical record.
+
+        The newest page of the history already holds that record when all
+        of its fields were loaded, which saves a query.
+        """
+        records = history_page.object_list
+        if (records and history_page.newer_cursor is None and
+                self.history_list_fields is None):
+            return records[0].instance
+        try:
+            return action_list.latest('history_date').instance
+        except action_list.model.DoesNotExist:
+            raise http.Http404
+
     def response_change(self, request, obj):
         if '_change_history' in request.POST and SIMPLE_HISTORY_EDIT:
             verbose_name = obj._meta.verbose_name
@@ -101,10 +462,7 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         model = getattr(
             self.model,
             self.model._meta.simple_history_manager_attribute).model
-        obj = get_object_or_404(model, **{
-            original_opts.pk.attname: object_id,
-            'history_id': version_id,
-        }).instance
+        obj = self._get_history_instance(model, object_id, version_id)
         obj._state.adding = False
 
         if not self.has_change_permission(request, obj):
@@ -115,9 +473,6 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         else:
             change_history = False
 
-        if '_change_history' in request.POST and SIMPLE_HISTORY_EDIT:
-            obj = obj.history.get(pk=version_id).instance
-
         formsets = []
         form_class = self.get_form(request, obj)
         if request.method == 'POST':
@@ -155,11 +510,14 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
             'errors': helpers.AdminErrorList(form, formsets),
             'app_label': model._meta.app_label,
             'original_opts': original_opts,
-            'changelist_url': reverse('%s:%s_%s_changelist' % url_triplet),
+            'changelist_url': reverse('%s:%s_%s_changelist' % url_triplet,
+                                      current_app=request.current_app),
             'change_url': reverse('%s:%s_%s_change' % url_triplet,
-                                  args=(obj.pk,)),
+                                  args=(obj.pk,),
+                                  current_app=request.current_app),
             'history_url': reverse('%s:%s_%s_history' % url_triplet,
-                                   args=(obj.pk,)),
+                                   args=(obj.pk,),
+                                   current_app=request.current_app),
             'change_history': change_history,
 
             # Context variables copied from render_change_form
@@ -172,8 +530,7 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
             'has_absolute_url': False,
             'form_url': '',
             'opts': model._meta,
-            'content_type_id': ContentType.objects.get_for_model(
-                self.model).id,
+            'content_type_id': self.get_content_type_id(),
             'save_as': self.save_as,
             'save_on_top': self.save_on_top,
             'root_path': getattr(self.admin_site, 'root_path', None),
@@ -181,6 +538,43 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         return render(request, template_name=self.object_history_form_template,
                       dictionary=context, current_app=request.current_app)
 
+    def get_content_type_id(self):
+        """Return the id of the content type of this model, looked up once
+        per admin instance.
+        """
+        try:
+            return self._content_type_id
+        except AttributeError:
+            self._content_type_id = ContentType.objects.get_for_model(
+                self.model).id
+            return self._content_type_id
+
+    def _get_history_instance(self, history_model, object_id, version_id):
+        """Rebuild the version of the object stored in a historical record.
+
+        The snapshot cache is consulted first when it is enabled.
+        """
+        pk_attname = self.model._meta.pk.attname
+        cache = get_snapshot_cache()
+        if cache is not None:
+            try:
+                history_id = history_model._meta.pk.to_python(version_id)
+            except ValidationError:
+                raise http.Http404
+            values = cache.get(history_model, history_id)
+            if values is not None:
+                pk_index = get_field_attnames(self.model).index(pk_attname)
+                if force_text(values[pk_index]) == force_text(object_id):
+                    return instance_from_values(self.model, values)
+        record = get_object_or_404(history_model, **{
+            pk_attname: object_id,
+            'history_id': version_id,
+        })
+        if cache is not None:
+            cache.set(history_model, record.history_id,
+                      record_values(record, self.model))
+        return record.instance
+
     def save_model(self, request, obj, form, change):
         """Set special model attribute to user for reference after save"""
         obj._history_user = request.user
@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class SimpleHistoryConfig(AppConfig):
+    name = 'simple_history'
+    verbose_name = "Simple history"
+
+    def ready(self):
+        from .models import setup_pending_relations
+        setup_pending_relations()
@@ -0,0 +1,255 @@
+"""
+Archive tier for cold historical records.
+
+Records older than a cutoff are moved out of the database into one
+gzip-compressed JSON Lines segment per model and month, described by a
+small ``index.json``. Instance lookups with ``as_of()`` and
+``most_recent()`` read the segments when the database has no matching
+record.
+"""
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.encoding import force_text
+
+from .cache import evict_snapshots, invalidate_latest
+from .export import (HistoryJSONEncoder, get_converters, get_export_fields,
+                     read_history)
+from .manager import get_referencing_fields, keyset_chunks
+
+ARCHIVE_DIR_SETTING = 'SIMPLE_HISTORY_ARCHIVE_DIR'
+INDEX_NAME = 'index.json'
+
+
+def _file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class HistoryArchive(object):
+    """Monthly compressed segments of archived historical records.
+
+    Each tracked model gets a directory named ``<app_label>.<model_name>``
+    holding ``<YYYY-MM>.jsonl.gz`` segments and an ``index.json`` with the
+    date range, row count, object primary keys, size and SHA-256 checksum
+    of every segment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def model_path(self, history_model):
+        opts = history_model.instance_type._meta
+        return os.path.join(self.path, '%s.%s' % (opts.app_label,
+                                                  opts.model_name))
+
+    def read_index(self, history_model):
+        """Return the index of ``history_model``'s segments by month."""
+        path = os.path.join(self.model_path(history_model), INDEX_NAME)
+        try:
+            with open(path) as f:
+                return dict((segment['month'], segment)
+                            for segment in json.load(f)['segments'])
+        except (IOError, OSError):
+            return {}
+
+    def write_index(self, history_model, index):
+        directory = self.model_path(history_model)
+        path = os.path.join(directory, INDEX_NAME)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'segments': [index[month] for month in sorted(index)]},
+                      f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+
+    def archive(self, queryset, chunk_size=1000):
+        """Move the records of ``queryset`` into the archive.
+
+        Every chunk of records is appended to its segments as complete
+        gzip members, synced to disk and recorded in the index before it
+        is deleted from the database. Records referenced
+        by other tables are left in the database, along with the newer
+        records of their object, so that the records in the database are
+        always newer than the archived ones. Returns the number of records
+        archived.
+        """
+        history_model = queryset.model
+        pk_attname = history_model.instance_type._meta.pk.attname
+        kept = self._oldest_referenced(queryset, pk_attname)
+        fields = get_export_fields(history_model)
+        directory = self.model_path(history_model)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = self.read_index(history_model)
+        encoder = HistoryJSONEncoder()
+        archived = 0
+        for chunk in keyset_chunks(queryset.values(*fields), chunk_size):
+            chunk = [row for row in chunk if row[pk_attname] not in kept or
+                     (row['history_date'], row['history_id']) <
+                     kept[row[pk_attname]]]
+            if not chunk:
+                continue
+            months = {}
+            for row in chunk:
+                months.setdefault(row['history_date'].strftime('%Y-%m'),
+                                  []).append(row)
+            for month, rows in sorted(months.items()):
+                path = os.path.join(directory, '%s.jsonl.gz' % month)
+                size = self._append_member(
+                    path, index.get(month, {}).get('size'),
+                    [encoder.encode(row) for row in rows])
+                self._add_to_index(index, month, rows, pk_attname)
+                index[month]['size'] = size
+                index[month]['sha256'] = _file_checksum(path)
+            self.write_index(history_model, index)
+            history_ids = [row['history_id'] for row in chunk]
+            history_model._default_manager.filter(
+                history_id__in=history_ids).delete()
+            evict_snapshots(history_model, history_ids)
+            for pk in set(row[pk_attname] for row in chunk):
+                invalidate_latest(history_model, pk)
+            archived += len(chunk)
+        return archived
+
+    def _append_member(self, path, size, lines):
+        """Append ``lines`` to a segment as one complete gzip member and
+        sync it to disk, returning the new size of the segment.
+
+        The segment is first cut back to ``size``, its size in the index,
+        dropping whatever an interrupted run appended after it.
+        """
+        with open(path, 'ab') as f:
+            if size is not None:
+                f.truncate(size)
+            member = gzip.GzipFile(fileobj=f, mode='wb')
+            try:
+                for line in lines:
+                    member.write(('%s\n' % line).encode('utf-8'))
+            finally:
+                member.close()
+            f.flush()
+            os.fsync(f.fileno())
+            return os.fstat(f.fileno()).st_size
+
+    def _oldest_referenced(self, queryset, pk_attname):
+        """Map the objects having records of ``queryset`` referenced by
+        other tables to the ``(history_date, history_id)`` of the oldest.
+        """
+        oldest = {}
+        history_model = queryset.model
+        for related_model, attname in get_referencing_fields(history_model):
+            referenced = queryset.filter(
+                history_id__in=related_model._default_manager.values(attname))
+            for pk, history_date, history_id in referenced.values_list(
+                    pk_attname, 'history_date', 'history_id').iterator():
+                key = history_date, history_id
+                if pk not in oldest or key < oldest[pk]:
+                    oldest[pk] = key
+        return oldest
+
+    def _add_to_index(self, index, month, rows, pk_attname):
+        """Record ``rows`` in the index entry of their month's segment,
+        including the primary keys of their objects. Segments indexed
+        before the primary keys were recorded are left without them.
+        """
+        for row in rows:
+            history_date = row['history_date'].isoformat()
+            segment = index.setdefault(month, {
+                'month': month,
+                'file': '%s.jsonl.gz' % month,
+                'rows': 0,
+                'start': history_date,
+                'end': history_date,
+                'pks': [],
+            })
+            segment['rows'] += 1
+            segment['start'] = min(segment['start'], history_date)
+            segment['end'] = max(segment['end'], history_date)
+        if 'pks' in segment:
+            segment['pks'] = sorted(set(segment['pks']).union(
+                force_text(row[pk_attname]) for row in rows))
+
+    def find(self, history_model, pk, date=None):
+        """Return the latest archived record of object ``pk``, or ``None``.
+
+        Only records dated ``date`` or earlier are considered when it is
+        given, and only the segments holding records of the object are
+        read. The record is returned as a dictionary of Python values.
+        """
+        directory = self.model_path(history_model)
+        pk_attname = history_model.instance_type._meta.pk.attname
+        date_field = history_model._meta.get_field('history_date')
+        pk = force_text(pk)
+        segments = sorted(self.read_index(history_model).values(),
+                          key=lambda segment: segment['month'], reverse=True)
+        for segment in segments:
+            if 'pks' in segment and pk not in segment['pks']:
+                continue
+            if (date is not None and
+                    date_field.to_python(segment['start']) > date):
+                continue
+            best_key = best = None
+            for row in read_history(os.path.join(directory, segment['file']),
+                                    'jsonl'):
+                if force_text(row[pk_attname]) != pk:
+                    continue
+                history_date = date_field.to_python(row['history_date'])
+                if date is not None and history_date > date:
+                    continue
+                key = history_date, row['history_id']
+                if best_key is None or key > best_key:
+                    best_key, best = key, row
+            if best is not None:
+                converters = get_converters(history_model)
+                return dict((attname, converters[attname](value))
+                            for attname, value in best.items()
+                            if attname in converters)
+        return None
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """Return the archive configured with ``SIMPLE_HISTORY_ARCHIVE_DIR``,
+    or ``None`` when archiving is disabled.
+    """
+    global _archive
+    if _archive is None:
+        path = getattr(settings, ARCHIVE_DIR_SETTING, None)
+        if path is None:
+            return None
+        with _archive_lock:
+            if _archive is None:
+                _archive = HistoryArchive(path)
+    return _archive
+
+
+def find_archived_record(history_model, pk, date=None):
+    """Look up an archived record if the archive is enabled."""
+    archive = get_archive()
+    if archive is None:
+        return None
+    return archive.find(history_model, pk, date)
+
+
+def _reset_archive(setting, **kwargs):
+    global _archive
+    if setting == ARCHIVE_DIR_SETTING:
+        _archive = None
+
+
+setting_changed.connect(_reset_archive)
@@ -0,0 +1,318 @@
+"""
+Caches for reconstructed historical snapshots.
+
+Historical records do not change once written, so the field values of a
+record can be cached by ``history_id`` and reused to rebuild instances of
+the tracked model without querying the database again.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import hashlib
+import sys
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.signals import setting_changed
+from django.db import connections, router, transaction
+from django.utils.encoding import force_bytes
+
+SNAPSHOT_CACHE_SETTING = 'SIMPLE_HISTORY_SNAPSHOT_CACHE'
+AS_OF_CACHE_SETTING = 'SIMPLE_HISTORY_AS_OF_CACHE'
+
+
+class SnapshotCache(object):
+    """Process-local LRU cache of historical field values.
+
+    Maps ``(historical model, history_id)`` to the tuple of values of the
+    tracked model's concrete fields. The cache holds at most
+    ``max_entries`` snapshots and, when ``max_bytes`` is set, roughly that
+    many bytes of values; the least recently used snapshots are evicted
+    first.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Drop every snapshot and reset the counters."""
+        with self._lock:
+            self._data = OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, model, history_id):
+        """Return the cached values or ``None``."""
+        key = (model, history_id)
+        with self._lock:
+            try:
+                values, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = (values, size)
+            self.hits += 1
+            return values
+
+    def set(self, model, history_id, values):
+        """Store ``values`` for the given historical record."""
+        key = (model, history_id)
+        values = tuple(values)
+        size = sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (values, size)
+            self.size += size
+            while (len(self._data) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self.size > self.max_bytes)):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def discard(self, model, history_ids):
+        """Drop the snapshots of the given historical records."""
+        with self._lock:
+            for history_id in history_ids:
+                old = self._data.pop((model, history_id), None)
+                if old is not None:
+                    self.size -= old[1]
+
+    def stats(self):
+        """Return the counters as a dictionary, e.g. for monitoring."""
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class AsOfCache(object):
+    """Point-in-time cache backed by the Django cache framework.
+
+    Snapshots are stored under the ``history_id`` they were resolved to,
+    so every date resolving to the same record shares one entry. A
+    per-object "latest" key remembers the newest record of each object;
+    it is invalidated whenever history is written for that object. An
+    invalidation may be marked pending so that no process caches the
+    object's latest record before the write commits.
+    """
+
+    PENDING = 'pending'
+
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT,
+                 key_prefix='simple_history'):
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, history_model, kind, value):
+        opts = history_model._meta
+        digest = hashlib.md5(force_bytes(value)).hexdigest()
+        return '%s:%s.%s:%s:%s' % (self.key_prefix, opts.app_label,
+                                   opts.model_name, kind, digest)
+
+    def get_latest(self, history_model, pk):
+        """Return ``(history_id, history_date, history_type)`` or ``None``.
+        """
+        latest = self.cache.get(self.make_key(history_model, 'latest', pk))
+        if latest == self.PENDING:
+            return None
+        return latest
+
+    def set_latest(self, history_model, pk, latest):
+        """Cache the latest record unless an invalidation is pending."""
+        self.cache.add(self.make_key(history_model, 'latest', pk),
+                       tuple(latest), self.timeout)
+
+    def invalidate_latest(self, history_model, pk, pending=False):
+        key = self.make_key(history_model, 'latest', pk)
+        if pending:
+            self.cache.set(key, self.PENDING, self.timeout)
+        else:
+            self.cache.delete(key)
+
+    def get_snapshot(self, history_model, history_id):
+        """Return the cached field values or ``None``."""
+        return self.cache.get(
+            self.make_key(history_model, 'snapshot', history_id))
+
+    def set_snapshot(self, history_model, history_id, values):
+        self.cache.set(self.make_key(history_model, 'snapshot', history_id),
+                       tuple(values), self.timeout)
+
+    def delete_snapshots(self, history_model, history_ids):
+        self.cache.delete_many([
+            self.make_key(history_model, 'snapshot', history_id)
+            for history_id in history_ids])
+
+
+_snapshot_cache = None
+_snapshot_cache_lock = threading.Lock()
+_as_of_cache = None
+
+
+def get_snapshot_cache():
+    """Return the configured snapshot cache, or ``None`` when disabled.
+
+    The cache is enabled with the ``SIMPLE_HISTORY_SNAPSHOT_CACHE``
+    setting, a dictionary with optional ``MAX_ENTRIES`` and ``MAX_BYTES``
+    keys.
+    """
+    global _snapshot_cache
+    if _snapshot_cache is None:
+        options = getattr(settings, SNAPSHOT_CACHE_SETTING, None)
+        if options is None:
+            return None
+        with _snapshot_cache_lock:
+            if _snapshot_cache is None:
+                _snapshot_cache = SnapshotCache(
+                    max_entries=options.get('MAX_ENTRIES', 1000),
+                    max_bytes=options.get('MAX_BYTES'),
+                )
+    return _snapshot_cache
+
+
+def get_as_of_cache():
+    """Return the configured point-in-time cache, or ``None``.
+
+    The cache is enabled with the ``SIMPLE_HISTORY_AS_OF_CACHE`` setting,
+    a dictionary with optional ``CACHE`` (cache alias), ``TIMEOUT`` and
+    ``KEY_PREFIX`` keys.
+    """
+    global _as_of_cache
+    if _as_of_cache is None:
+        options = getattr(settings, AS_OF_CACHE_SETTING, None)
+        if options is None:
+            return None
+        _as_of_cache = AsOfCache(
+            alias=options.get('CACHE', 'default'),
+            timeout=options.get('TIMEOUT', DEFAULT_TIMEOUT),
+            key_prefix=options.get('KEY_PREFIX', 'simple_history'),
+        )
+    return _as_of_cache
+
+
+_pending_writes = threading.local()
+
+
+def _pending_entries(using):
+    """Return the ``(history model, pk)`` pairs whose history was written
+    in the current transaction of this thread on ``using``.
+    """
+    try:
+        entries = _pending_writes.entries
+    except AttributeError:
+        entries = _pending_writes.entries = {}
+    return entries.setdefault(using, set())
+
+
+def _end_pending_writes(using):
+    """Forget the pending invalidations once the transaction on ``using``
+    has ended, deleting the latest entries whether it committed or
+    rolled back.
+    """
+    entries = _pending_entries(using)
+    if not entries or connections[using].in_atomic_block:
+        return
+    as_of_cache = get_as_of_cache()
+    if as_of_cache is not None:
+        for history_model, pk in entries:
+            as_of_cache.invalidate_latest(history_model, pk)
+    entries.clear()
+
+
+def _invalidate_committed(using, history_model, pk):
+    _pending_entries(using).discard((history_model, pk))
+    as_of_cache = get_as_of_cache()
+    if as_of_cache is not None:
+        as_of_cache.invalidate_latest(history_model, pk)
+
+
+def latest_pending(history_model, pk):
+    """Return whether this thread wrote history for the object in a
+    transaction that has not ended yet.
+
+    The records read inside that transaction may be rolled back, so they
+    must not be cached.
+    """
+    using = router.db_for_write(history_model)
+    _end_pending_writes(using)
+    return (history_model, pk) in _pending_entries(using)
+
+
+def invalidate_latest(history_model, pk):
+    """Forget the cached latest record of an object, if caching is on.
+
+    Inside a transaction the entry is marked pending, so that neither
+    this transaction nor other processes, which still read the previous
+    latest record, cache it until the transaction ends. The entry is
+    deleted when the transaction commits or, after a rollback or without
+    ``transaction.on_commit()`` (Django < 1.9), the next time this thread
+    uses the cache.
+    """
+    as_of_cache = get_as_of_cache()
+    if as_of_cache is None:
+        return
+    using = router.db_for_write(history_model)
+    _end_pending_writes(using)
+    if not connections[using].in_atomic_block:
+        as_of_cache.invalidate_latest(history_model, pk)
+        return
+    as_of_cache.invalidate_latest(history_model, pk, pending=True)
+    _pending_entries(using).add((history_model, pk))
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(lambda: _invalidate_committed(using, history_model, pk),
+                  using=using)
+
+
+def evict_snapshots(history_model, history_ids):
+    """Forget the cached snapshots of deleted historical records."""
+    history_ids = list(history_ids)
+    snapshot_cache = get_snapshot_cache()
+    if snapshot_cache is not None:
+        snapshot_cache.discard(history_model, history_ids)
+    as_of_cache = get_as_of_cache()
+    if as_of_cache is not None and history_ids:
+        as_of_cache.delete_snapshots(history_model, history_ids)
+
+
+def record_values(record, model):
+    """Return the tracked field values stored in a historical record."""
+    from .manager import get_field_attnames
+
+    return tuple(getattr(record, attname)
+                 for attname in get_field_attnames(model))
+
+
+def _reset_caches(setting, **kwargs):
+    global _snapshot_cache, _as_of_cache
+    if setting == SNAPSHOT_CACHE_SETTING:
+        _snapshot_cache = None
+    elif setting == AS_OF_CACHE_SETTING:
+        _as_of_cache = None
+
+
+setting_changed.connect(_reset_caches)
@@ -0,0 +1,264 @@
+"""
+Streaming export and import of historical records.
+
+Records are read in keyset-paginated chunks of ``values()`` and serialized
+one chunk at a time, so exporting a table of any size uses a constant
+amount of memory. Exported files are loaded back in batches with
+``bulk_create``.
+"""
+from __future__ import unicode_literals
+
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import zlib
+
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.utils import six
+from django.utils.encoding import force_bytes, force_text
+
+from .manager import get_target_field, keyset_chunks
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+class _Echo(object):
+    """File-like object returning what is written to it, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def get_export_fields(history_model):
+    """Return the attnames of the columns exported for ``history_model``."""
+    return [field.attname for field in history_model._meta.concrete_fields]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    value = force_text(value)
+    if six.PY2:
+        value = value.encode('utf-8')
+    return value
+
+
+def _csv_lines(chunks, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_csv_value(field) for field in fields])
+    for chunk in chunks:
+        yield ''.join(
+            writer.writerow([_csv_value(row[field]) for field in fields])
+            for row in chunk)
+
+
+class HistoryJSONEncoder(DjangoJSONEncoder):
+    """JSON encoder keeping the microseconds of times and datetimes."""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(HistoryJSONEncoder, self).default(o)
+
+
+def _jsonl_lines(chunks, fields):
+    encoder = HistoryJSONEncoder()
+    for chunk in chunks:
+        yield ''.join(
+            '%s\n' % encoder.encode(
+                dict((field, row[field]) for field in fields))
+            for row in chunk)
+
+
+def gzip_stream(chunks, compresslevel=6):
+    """Compress an iterable of strings into gzip data on the fly."""
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(force_bytes(chunk))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _read_chunks(queryset, chunk_size):
+    fields = get_export_fields(queryset.model)
+    return fields, keyset_chunks(queryset.values(*fields), chunk_size)
+
+
+def _serialize(chunks, fields, format):
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %r" % format)
+    if format == 'csv':
+        return _csv_lines(chunks, fields)
+    return _jsonl_lines(chunks, fields)
+
+
+def export_history(queryset, format='csv', chunk_size=1000, compress=False):
+    """Serialize the historical records of ``queryset`` as they are read.
+
+    Returns an iterator of strings in ``format`` (``'csv'`` or
+    ``'jsonl'``), or of gzip-compressed bytes when ``compress`` is true.
+    Records are exported in ``(history_date, history_id)`` order.
+    """
+    fields, chunks = _read_chunks(queryset, chunk_size)
+    lines = _serialize(chunks, fields, format)
+    if compress:
+        return gzip_stream(lines)
+    return lines
+
+
+def export_to_file(queryset, path, format='jsonl', chunk_size=1000,
+                   compress=True):
+    """Write the export of ``queryset`` to the file at ``path``.
+
+    Returns ``(rows, size, sha256)``: the number of records written, the
+    size of the file in bytes and the hex SHA-256 digest of its content.
+    """
+    fields, chunks = _read_chunks(queryset, chunk_size)
+    rows = [0]
+
+    def counted(chunks):
+        for chunk in chunks:
+            rows[0] += len(chunk)
+            yield chunk
+
+    data = _serialize(counted(chunks), fields, format)
+    if compress:
+        data = gzip_stream(data)
+    checksum = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as f:
+        for block in data:
+            block = force_bytes(block)
+            f.write(block)
+            checksum.update(block)
+            size += len(block)
+    return rows[0], size, checksum.hexdigest()
+
+
+def get_file_format(path):
+    """Guess the format of an export file from its name, else ``None``."""
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1].lower()
+    if extension in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    return None
+
+
+def _read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line.decode('utf-8'))
+
+
+def _read_csv(f):
+    if six.PY2:
+        reader = csv.reader(f)
+        header = [force_text(cell) for cell in next(reader, [])]
+        for row in reader:
+            yield dict(zip(header, (force_text(cell) for cell in row)))
+    else:
+        for row in csv.DictReader(io.TextIOWrapper(
+                f, encoding='utf-8', newline='')):
+            yield row
+
+
+def read_history(path, format=None):
+    """Iterate over the records of an export file as dictionaries.
+
+    Files ending in ``.gz`` are decompressed. ``format`` defaults to the
+    one guessed from the file name.
+    """
+    format = format or get_file_format(path)
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown import format for %s" % path)
+    opener = gzip.open if path.endswith('.gz') else io.open
+    with opener(path, 'rb') as f:
+        reader = _read_csv if format == 'csv' else _read_jsonl
+        for row in reader(f):
+            yield row
+
+
+def get_converters(history_model, blank_is_null=False):
+    """Map the attnames of ``history_model`` to functions converting
+    exported values back to Python values.
+    """
+    converters = {}
+    for field in history_model._meta.concrete_fields:
+        target = field
+        if getattr(field, 'rel', None) is not None:
+            target = get_target_field(field)
+
+        def convert(value, field=field, target=target):
+            if value is None or (value == '' and blank_is_null and
+                                 field.null):
+                return None
+            return target.to_python(value)
+
+        converters[field.attname] = convert
+    return converters
+
+
+def bulk_import(history_model, rows, batch_size=1000, atomic=False,
+                blank_is_null=False, using=None):
+    """Insert historical records from dictionaries with ``bulk_create``.
+
+    Every value, including ``history_id``, ``history_date``,
+    ``history_type`` and ``history_user_id``, is kept as given. Records are
+    inserted ``batch_size`` at a time, each batch in its own transaction
+    when ``atomic`` is true. ``blank_is_null`` turns empty strings into
+    ``None`` for nullable fields, as written by the CSV export. Columns
+    unknown to ``history_model`` are ignored.
+
+    Returns the number of records inserted.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer.")
+    using = using or router.db_for_write(history_model)
+    converters = get_converters(history_model, blank_is_null)
+    manager = history_model._default_manager.db_manager(using)
+    count = 0
+
+    def insert(batch):
+        if atomic:
+            with transaction.atomic(using=using):
+                manager.bulk_create(batch)
+        else:
+            manager.bulk_create(batch)
+        return len(batch)
+
+    batch = []
+    for row in rows:
+        batch.append(history_model(**dict(
+            (attname, converters[attname](value))
+            for attname, value in row.items() if attname in converters)))
+        if len(batch) >= batch_size:
+            count += insert(batch)
+            batch = []
+    if batch:
+        count += insert(batch)
+
+    # Explicit primary keys leave the sequences of some backends behind.
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(
+        no_style(), [history_model])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+    return count
@@ -0,0 +1,345 @@
+"""
+Maintenance of historical tables: compaction and consistency checks.
+"""
+from __future__ import unicode_literals
+
+import multiprocessing
+
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+try:
+    from django.apps import apps
+except ImportError:  # Django < 1.7
+    from django.db.models.loading import get_model
+else:
+    get_model = apps.get_model
+
+from .cache import evict_snapshots, invalidate_latest
+from .export import get_export_fields
+from .manager import get_field_attnames, get_referencing_fields
+from .models import fake_m2m_models, history_registry
+
+
+def timeline_chunks(queryset, chunk_size=1000):
+    """Yield ``values()`` chunks of ``queryset`` ordered by object.
+
+    Records are ordered by ``(<tracked primary key>, history_date,
+    history_id)``, i.e. one object's timeline after the other, and every
+    chunk continues after the last key seen, like
+    :func:`~simple_history.manager.keyset_chunks`.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    history_model = queryset.model
+    pk_attname = history_model.instance_type._meta.pk.attname
+    queryset = queryset.order_by(
+        pk_attname, 'history_date', 'history_id',
+    ).values(*get_export_fields(history_model))
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        pk, history_date = last[pk_attname], last['history_date']
+        chunk = list(queryset.filter(
+            Q(**{'%s__gt' % pk_attname: pk}) |
+            Q(**{pk_attname: pk, 'history_date__gt': history_date}) |
+            Q(**{pk_attname: pk, 'history_date': history_date,
+                 'history_id__gt': last['history_id']})
+        )[:chunk_size])
+
+
+def _delete_duplicate_links(link_model, attname, record_ids):
+    """Delete the fake m2m rows made identical by rewiring ``attname``."""
+    others = [field.attname for field in link_model._meta.concrete_fields
+              if field.is_relation and field.attname != attname]
+    duplicates = _duplicate_rows(link_model, attname, record_ids, others,
+                                 ('pk',))
+    if duplicates:
+        link_model._default_manager.filter(pk__in=duplicates).delete()
+
+
+def _delete_duplicate_m2m_records(m2m_history_model, attname, record_ids):
+    """Delete the m2m history records made identical by rewiring
+    ``attname``, i.e. pointing at the same records of both sides, keeping
+    the oldest.
+    """
+    relations = history_registry.relations(m2m_history_model.instance_type)
+    others = [m2m_history_model._meta.get_field(name).attname
+              for name in relations.m2m_history_fields]
+    others.remove(attname)
+    duplicates = _duplicate_rows(m2m_history_model, attname, record_ids,
+                                 others, ('history_date', 'history_id'))
+    if not duplicates:
+        return
+    manager = m2m_history_model._default_manager
+    pk_attname = m2m_history_model.instance_type._meta.pk.attname
+    pks = set(manager.filter(history_id__in=duplicates).values_list(
+        pk_attname, flat=True))
+    manager.filter(history_id__in=duplicates).delete()
+    evict_snapshots(m2m_history_model, duplicates)
+    for pk in pks:
+        invalidate_latest(m2m_history_model, pk)
+
+
+def _duplicate_rows(model, attname, record_ids, others, ordering):
+    """Return the primary keys of the rows of ``model`` pointing at
+    ``record_ids`` with ``attname`` that repeat the ``others`` columns of
+    a row coming before them in ``ordering``.
+    """
+    seen = set()
+    duplicates = []
+    rows = model._default_manager.filter(**{
+        '%s__in' % attname: record_ids,
+    }).order_by(*ordering).values_list('pk', attname, *others)
+    for row in rows:
+        if row[1:] in seen:
+            duplicates.append(row[0])
+        else:
+            seen.add(row[1:])
+    return duplicates
+
+
+def _merge_records(history_model, merged):
+    """Point references to duplicate records at their survivor and delete
+    the duplicates. ``merged`` maps survivor ids to lists of duplicates.
+    """
+    survivor_of = dict((duplicate, survivor)
+                       for survivor, duplicates in merged.items()
+                       for duplicate in duplicates)
+    link_models = set(value[1] for value in fake_m2m_models.values())
+    for related_model, attname in get_referencing_fields(history_model):
+        manager = related_model._default_manager
+        referenced = set(manager.filter(**{
+            '%s__in' % attname: list(survivor_of),
+        }).values_list(attname, flat=True))
+        survivors = set()
+        for duplicate in referenced:
+            survivors.add(survivor_of[duplicate])
+            manager.filter(**{attname: duplicate}).update(
+                **{attname: survivor_of[duplicate]})
+        if not survivors:
+            continue
+        if related_model in link_models:
+            _delete_duplicate_links(related_model, attname, list(survivors))
+        elif getattr(related_model, 'is_m2m', False):
+            _delete_duplicate_m2m_records(related_model, attname,
+                                          list(survivors))
+    history_model._default_manager.filter(
+        history_id__in=list(survivor_of)).delete()
+
+
+def compact_history(history_model, chunk_size=1000, dry_run=False):
+    """Collapse runs of consecutive identical records of every object.
+
+    Records are identical when all their columns but ``history_id`` and
+    ``history_date`` are equal. The earliest record of each run is kept;
+    rows of relation history (fake m2m rows and the ``history_<Model>``
+    columns of m2m history) pointing to the others are moved to it, and
+    those becoming identical are deleted but for the first. With
+    ``dry_run`` nothing is changed.
+
+    Returns ``(scanned, removed)`` record counts.
+    """
+    pk_attname = history_model.instance_type._meta.pk.attname
+    compared = [attname for attname in get_export_fields(history_model)
+                if attname not in ('history_id', 'history_date')]
+    using = router.db_for_write(history_model)
+    scanned = removed = 0
+    previous_values = survivor = None
+    for chunk in timeline_chunks(history_model._default_manager.all(),
+                                 chunk_size):
+        merged = {}
+        pks = set()
+        for row in chunk:
+            values = tuple(row[attname] for attname in compared)
+            if values == previous_values:
+                merged.setdefault(survivor, []).append(row['history_id'])
+                pks.add(row[pk_attname])
+            else:
+                previous_values, survivor = values, row['history_id']
+        scanned += len(chunk)
+        removed += sum(len(duplicates) for duplicates in merged.values())
+        if merged and not dry_run:
+            with transaction.atomic(using=using):
+                _merge_records(history_model, merged)
+            evict_snapshots(history_model, [
+                duplicate for duplicates in merged.values()
+                for duplicate in duplicates])
+            for pk in pks:
+                invalidate_latest(history_model, pk)
+    return scanned, removed
+
+
+def latest_records(queryset):
+    """Restrict a queryset of historical records to the latest record of
+    each object, with a single ``NOT EXISTS`` query.
+    """
+    history_model = queryset.model
+    qn = connections[queryset.db].ops.quote_name
+    pk_column = history_model._meta.get_field(
+        history_model.instance_type._meta.pk.attname).column
+    where = (
+        "NOT EXISTS (SELECT 1 FROM {table} later "
+        "WHERE later.{pk} = {table}.{pk} AND ("
+        "later.{date} > {table}.{date} OR "
+        "(later.{date} = {table}.{date} AND later.{id} > {table}.{id})))"
+    ).format(table=qn(history_model._meta.db_table), pk=qn(pk_column),
+             date=qn('history_date'), id=qn('history_id'))
+    return queryset.extra(where=[where])
+
+
+def pk_ranges(model, chunk_size=1000):
+    """Split the primary keys of ``model`` into ``(low, high)`` ranges.
+
+    ``low`` is exclusive and ``high`` inclusive; ``None`` leaves a side
+    unbounded, so the ranges cover every possible key between them.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    queryset = model._default_manager.order_by('pk').values_list(
+        'pk', flat=True)
+    low = None
+    while True:
+        if low is not None:
+            keys = queryset.filter(pk__gt=low)
+        else:
+            keys = queryset
+        high = list(keys[chunk_size - 1:chunk_size])
+        if not high:
+            yield low, None
+            return
+        yield low, high[0]
+        low = high[0]
+
+
+class VerifyResult(object):
+    """Outcome of comparing live objects with their latest history.
+
+    ``missing`` lists the primary keys of objects without history,
+    ``stale`` those whose latest record differs from the object and
+    ``orphaned``, when checked, those of deleted objects whose history does
+    not end with a deletion. ``repaired`` counts the records written to fix
+    them.
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.missing = []
+        self.stale = []
+        self.orphaned = []
+        self.repaired = 0
+
+    def update(self, other):
+        self.checked += other.checked
+        self.missing.extend(other.missing)
+        self.stale.extend(other.stale)
+        self.orphaned.extend(other.orphaned)
+        self.repaired += other.repaired
+
+    def is_consistent(self):
+        return not (self.missing or self.stale or self.orphaned)
+
+
+def _in_range(queryset, field, low, high):
+    if low is not None:
+        queryset = queryset.filter(**{'%s__gt' % field: low})
+    if high is not None:
+        queryset = queryset.filter(**{'%s__lte' % field: high})
+    return queryset
+
+
+def verify_range(model, history_model, low, high, repair=False,
+                 orphans=False):
+    """Compare the objects with primary keys in ``(low, high]`` with their
+    latest historical records, and with ``orphans`` look for the history of
+    deleted objects not ending with a deletion. Returns a
+    :class:`VerifyResult`.
+    """
+    attnames = get_field_attnames(model)
+    pk_attname = model._meta.pk.attname
+    pk_index = attnames.index(pk_attname)
+    live = dict(
+        (values[pk_index], values) for values in _in_range(
+            model._default_manager.all(), 'pk', low, high,
+        ).values_list(*attnames))
+    latest = dict(
+        (row[pk_index], (row[:-1], row[-1])) for row in latest_records(
+            _in_range(history_model._default_manager.all(), pk_attname,
+                      low, high),
+        ).values_list(*(attnames + ('history_type',))))
+    result = VerifyResult()
+    result.checked = len(live)
+    repairs = []
+    for pk, values in live.items():
+        if pk not in latest:
+            result.missing.append(pk)
+            repairs.append((values, '+'))
+        elif latest[pk][1] == '-' or latest[pk][0] != values:
+            result.stale.append(pk)
+            repairs.append((values, '~'))
+    if orphans:
+        for pk, (values, history_type) in latest.items():
+            if pk not in live and history_type != '-':
+                result.orphaned.append(pk)
+                repairs.append((values, '-'))
+    if repair and repairs:
+        history_date = now()
+        history_model._default_manager.bulk_create([
+            history_model(history_date=history_date, history_type=history_type,
+                          **dict(zip(attnames, values)))
+            for values, history_type in repairs])
+        for values, _ in repairs:
+            invalidate_latest(history_model, values[pk_index])
+        result.repaired = len(repairs)
+    return result
+
+
+def _verify_range_job(args):
+    app_label, model_name, low, high, repair, orphans = args
+    model = get_model(app_label, model_name)
+    history_model = getattr(
+        model, model._meta.simple_history_manager_attribute).model
+    return verify_range(model, history_model, low, high, repair, orphans)
+
+
+def verify_history(model, history_model, chunk_size=1000, workers=1,
+                   repair=False, orphans=False):
+    """Check that the latest historical record of every object matches it.
+
+    The objects are compared in primary key ranges of ``chunk_size``
+    objects, each with two queries, in ``workers`` processes when more
+    than one. With ``repair``, the missing records are bulk-created with
+    the current date: ``+`` records for objects without history and ``~``
+    for stale ones.
+
+    Deleting an object does not write a ``-`` record, so the history of
+    deleted objects is only checked to end with one with ``orphans``, e.g.
+    for history imported from a project recording deletions. The missing
+    ``-`` records are then repaired as well.
+
+    Returns a :class:`VerifyResult`.
+    """
+    result = VerifyResult()
+    ranges = pk_ranges(model, chunk_size)
+    if workers > 1:
+        opts = model._meta
+        jobs = [(opts.app_label, opts.model_name, low, high, repair,
+                 orphans) for low, high in ranges]
+        # Worker processes must open their own database connections.
+        connections.close_all()
+        pool = multiprocessing.Pool(workers)
+        try:
+            for partial in pool.imap_unordered(_verify_range_job, jobs):
+                result.update(partial)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for low, high in ranges:
+            result.update(verify_range(model, history_model, low, high,
+                                       repair, orphans))
+    return result
@@ -0,0 +1,120 @@
+from datetime import datetime, time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+try:
+    from django.apps import apps
+except ImportError:  # Django < 1.7
+    from django.db.models.loading import get_model
+else:
+    get_model = apps.get_model
+
+from ... import models
+from . import _populate_utils as utils
+
+
+def model_label(model):
+    """Return the ``app_label.model_name`` label of ``model``."""
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def parse_date_option(value):
+    """Parse a date or datetime given on the command line."""
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is not None:
+                parsed = datetime.combine(day, time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise CommandError("Invalid date: %r" % value)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class HistoryModelCommand(BaseCommand):
+    """Base for commands operating on the history of a list of models."""
+
+    args = "<app.model app.model ...>"
+
+    COMMAND_HINT = "Please specify a model or use the --auto option"
+    MODEL_NOT_FOUND = "Unable to find model"
+    MODEL_NOT_HISTORICAL = "No history model found"
+    NO_REGISTERED_MODELS = "No registered models were found\n"
+    INVALID_MODEL_ARG = "An invalid model was specified"
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--auto',
+            action='store_true',
+            dest='auto',
+            default=False,
+            help="Automatically search for models with the "
+                 "HistoricalRecords field type",
+        ),
+    )
+
+    def get_models(self, args, options):
+        """Return the ``(model, history_model)`` pairs to process.
+
+        The pairs are sorted by model label so output is deterministic.
+        """
+        if args:
+            to_process = set(self._handle_model_list(*args))
+        elif options['auto']:
+            to_process = set(self._registered_models())
+            if not to_process:
+                self.stdout.write(self.NO_REGISTERED_MODELS)
+        else:
+            self.stdout.write(self.COMMAND_HINT)
+            to_process = set()
+        return sorted(to_process, key=lambda pair: model_label(pair[0]))
+
+    def _registered_models(self):
+        for model in models.registered_models.values():
+            try:    # avoid issues with mutli-table inheritance
+                history_model = utils.get_history_model_for_model(model)
+            except utils.NotHistorical:
+                continue
+            yield (model, history_model)
+
+    def _handle_model_list(self, *args):
+        failing = False
+        for natural_key in args:
+            try:
+                model, history = self._model_from_natural_key(natural_key)
+            except ValueError as e:
+                failing = True
+                self.stderr.write("{error}\n".format(error=e))
+            else:
+                if not failing:
+                    yield (model, history)
+        if failing:
+            raise CommandError(self.INVALID_MODEL_ARG)
+
+    def _model_from_natural_key(self, natural_key):
+        try:
+            app_label, model = natural_key.split(".", 1)
+        except ValueError:
+            model = None
+        else:
+            try:
+                model = get_model(app_label, model)
+            except LookupError:  # Django >= 1.7
+                model = None
+        if not model:
+            raise ValueError(self.MODEL_NOT_FOUND +
+                             " < {model} >\n".format(model=natural_key))
+        try:
+            history_model = utils.get_history_model_for_model(model)
+        except utils.NotHistorical:
+            raise ValueError(self.MODEL_NOT_HISTORICAL +
+                             " < {model} >\n".format(model=natural_key))
+        return model, history_model
@@ -0,0 +1,70 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from ...archive import HistoryArchive, get_archive
+from ._base import HistoryModelCommand, model_label, parse_date_option
+
+
+class Command(HistoryModelCommand):
+    help = ("Moves historical records older than a cutoff from the database "
+            "into compressed monthly archive segments")
+
+    ARCHIVED = "Archived {rows} records of {model} to {path}\n"
+    NO_ARCHIVE = ("No archive directory; set SIMPLE_HISTORY_ARCHIVE_DIR or "
+                  "use --archive-dir")
+    NO_CUTOFF = "Please specify the cutoff with --before or --days"
+
+    option_list = HistoryModelCommand.option_list + (
+        make_option(
+            '--before',
+            dest='before',
+            default=None,
+            help="Archive records with a history_date before this date or "
+                 "datetime",
+        ),
+        make_option(
+            '--days',
+            dest='days',
+            type='int',
+            default=None,
+            help="Archive records older than this number of days",
+        ),
+        make_option(
+            '--archive-dir',
+            dest='archive_dir',
+            default=None,
+            help="Directory of the archive; defaults to the "
+                 "SIMPLE_HISTORY_ARCHIVE_DIR setting",
+        ),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=1000,
+            help="Number of records moved per query",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['archive_dir']:
+            archive = HistoryArchive(options['archive_dir'])
+        else:
+            archive = get_archive()
+            if archive is None:
+                raise CommandError(self.NO_ARCHIVE)
+        if options['before']:
+            before = parse_date_option(options['before'])
+        elif options['days'] is not None:
+            before = timezone.now() - timedelta(days=options['days'])
+        else:
+            raise CommandError(self.NO_CUTOFF)
+        for model, history_model in self.get_models(args, options):
+            rows = archive.archive(
+                history_model.objects.filter(history_date__lt=before),
+                chunk_size=options['chunk_size'])
+            self.stdout.write(self.ARCHIVED.format(
+                rows=rows, model=model_label(model),
+                path=archive.model_path(history_model)))
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from ...maintenance import compact_history
+from ._base import HistoryModelCommand, model_label
+
+
+class Command(HistoryModelCommand):
+    help = ("Collapses runs of consecutive identical historical records of "
+            "each object, keeping the earliest")
+
+    COMPACTED = "Compacted {model}: {removed} of {scanned} records reclaimed\n"
+    DRY_RUN = ("Would compact {model}: {removed} of {scanned} records "
+               "reclaimable\n")
+
+    option_list = HistoryModelCommand.option_list + (
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=1000,
+            help="Number of records scanned per query",
+        ),
+        make_option(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Only report how many records would be reclaimed",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        message = self.DRY_RUN if options['dry_run'] else self.COMPACTED
+        total = 0
+        for model, history_model in self.get_models(args, options):
+            scanned, removed = compact_history(
+                history_model, chunk_size=options['chunk_size'],
+                dry_run=options['dry_run'])
+            total += removed
+            self.stdout.write(message.format(
+                model=model_label(model), removed=removed, scanned=scanned))
+        if not options['dry_run']:
+            self.stdout.write("Reclaimed {rows} records\n".format(rows=total))
@@ -0,0 +1,91 @@
+import json
+import os
+from optparse import make_option
+
+from django.utils import timezone
+
+from ...export import HistoryJSONEncoder, export_to_file
+from ._base import HistoryModelCommand, model_label, parse_date_option
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class Command(HistoryModelCommand):
+    help = ("Exports the history of models to gzip-compressed JSON Lines "
+            "files with a manifest of row counts and checksums")
+
+    EXPORTED = "Exported {rows} records of {model} to {file}\n"
+
+    option_list = HistoryModelCommand.option_list + (
+        make_option(
+            '--since',
+            dest='since',
+            default=None,
+            help="Only export records with a history_date on or after this "
+                 "date or datetime",
+        ),
+        make_option(
+            '--until',
+            dest='until',
+            default=None,
+            help="Only export records with a history_date before this date "
+                 "or datetime",
+        ),
+        make_option(
+            '--output-dir',
+            dest='output_dir',
+            default='.',
+            help="Directory to write the files and the manifest to",
+        ),
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=1000,
+            help="Number of records read per query",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        to_process = self.get_models(args, options)
+        if not to_process:
+            return
+        since = until = None
+        filters = {}
+        if options['since']:
+            since = parse_date_option(options['since'])
+            filters['history_date__gte'] = since
+        if options['until']:
+            until = parse_date_option(options['until'])
+            filters['history_date__lt'] = until
+        output_dir = options['output_dir']
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        manifest = {
+            'created': timezone.now(),
+            'since': since,
+            'until': until,
+            'format': 'jsonl',
+            'compression': 'gzip',
+            'files': [],
+        }
+        for model, history_model in to_process:
+            label = model_label(model)
+            filename = '%s.jsonl.gz' % label
+            rows, size, checksum = export_to_file(
+                history_model.objects.filter(**filters),
+                os.path.join(output_dir, filename),
+                chunk_size=options['chunk_size'])
+            manifest['files'].append({
+                'model': label,
+                'file': filename,
+                'rows': rows,
+                'bytes': size,
+                'sha256': checksum,
+            })
+            self.stdout.write(self.EXPORTED.format(
+                rows=rows, model=label, file=filename))
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, cls=HistoryJSONEncoder, indent=2,
+                      sort_keys=True)
@@ -0,0 +1,89 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError
+
+from ...models import fake_m2m_models
+from ...stats import estimated_count, history_stats
+from ._base import HistoryModelCommand, model_label
+
+
+class Command(HistoryModelCommand):
+    help = ("Reports the size, versions per object, daily growth and write "
+            "amplification of historical tables")
+
+    SIZE = "{model}: {rows}{estimated} records of {objects} objects\n"
+    VERSIONS = "  versions per object: {percentiles}\n"
+    GROWTH = "  last {days} days: {rows} records, {average:.1f} per day\n"
+    DAY = "    {day}: {rows}\n"
+    AMPLIFICATION = ("  write amplification: {amplification} relation rows "
+                     "per record{linked}\n")
+    LINK = "{model}: {rows}{estimated} rows linking {left} and {right}\n"
+
+    option_list = HistoryModelCommand.option_list + (
+        make_option(
+            '--days',
+            dest='days',
+            type='int',
+            default=7,
+            help="Number of days of growth to report",
+        ),
+        make_option(
+            '--exact',
+            action='store_true',
+            dest='exact',
+            default=False,
+            help="Count rows instead of reading the planner estimates",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError("--days must not be negative")
+        verbosity = int(options.get('verbosity', 1))
+        processed = set()
+        for model, history_model in self.get_models(args, options):
+            processed.add(model)
+            stats = history_stats(model, history_model, days=options['days'],
+                                  exact=options['exact'])
+            self.write_stats(stats, options['days'], verbosity)
+        links = set((from_model, to_model, link_model)
+                    for (from_model, link_model, _), (to_model, _, _)
+                    in fake_m2m_models.items()
+                    if from_model in processed or to_model in processed)
+        for from_model, to_model, link_model in sorted(
+                links, key=lambda link: link[2].__name__):
+            rows, estimated = estimated_count(link_model, options['exact'])
+            self.stdout.write(self.LINK.format(
+                model=link_model.__name__, rows=rows,
+                estimated=' (estimated)' if estimated else '',
+                left=model_label(from_model), right=model_label(to_model)))
+
+    def write_stats(self, stats, days, verbosity):
+        self.stdout.write(self.SIZE.format(
+            model=model_label(stats.model), rows=stats.rows,
+            estimated=' (estimated)' if stats.estimated else '',
+            objects=stats.objects))
+        self.stdout.write(self.VERSIONS.format(percentiles=', '.join(
+            '{label} {value}'.format(
+                label='max' if rank == 100 else 'p%d' % rank,
+                value='-' if value is None else value)
+            for rank, value in stats.percentiles)))
+        total = sum(rows for day, rows in stats.per_day)
+        self.stdout.write(self.GROWTH.format(
+            days=days, rows=total,
+            average=float(total) / days if days else 0.0))
+        if verbosity > 1:
+            for day, rows in stats.per_day:
+                self.stdout.write(self.DAY.format(day=day, rows=rows))
+        if stats.amplification is None:
+            amplification = '-'
+        else:
+            amplification = '{0:.2f}'.format(stats.amplification)
+        linked = ', '.join(
+            '{model} {rows}'.format(model=model.__name__, rows=rows)
+            for model, rows in sorted(stats.linked.items(),
+                                      key=lambda item: item[0].__name__)
+            if rows)
+        self.stdout.write(self.AMPLIFICATION.format(
+            amplification=amplification,
+            linked=' ({0})'.format(linked) if linked else ''))
@@ -0,0 +1,86 @@
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...export import bulk_import, get_file_format, read_history
+from ._base import HistoryModelCommand, model_label
+
+
+class Command(HistoryModelCommand):
+    args = "<file file ...>"
+    help = ("Loads historical records from JSON Lines or CSV files, e.g. "
+            "written by export_history, with batched bulk inserts")
+
+    COMMAND_HINT = "Please specify the files to import"
+    MODEL_HINT = ("Cannot tell the model of {file}; name it "
+                  "<app_label>.<model_name>.jsonl[.gz] or use --model")
+    IMPORTED = ("Imported {rows} records of {model} from {file} in "
+                "{seconds:.2f}s ({rate:.0f} records/s)\n")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--model',
+            dest='model',
+            default=None,
+            help="The app_label.model_name whose history the files hold; "
+                 "by default it is taken from each file name",
+        ),
+        make_option(
+            '--format',
+            dest='format',
+            default=None,
+            choices=['jsonl', 'csv'],
+            help="The format of the files; by default it is taken from "
+                 "each file name",
+        ),
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            type='int',
+            default=1000,
+            help="Number of records inserted per query",
+        ),
+        make_option(
+            '--atomic',
+            action='store_true',
+            dest='atomic',
+            default=False,
+            help="Insert every batch in its own transaction",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError(self.COMMAND_HINT)
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be a positive integer")
+        jobs = [(path, self._get_history_model(path, options['model']))
+                for path in args]
+        for path, (model, history_model) in jobs:
+            file_format = options['format'] or get_file_format(path)
+            if file_format is None:
+                raise CommandError("Unknown format of %s; use --format" % path)
+            started = time.time()
+            rows = bulk_import(
+                history_model, read_history(path, file_format),
+                batch_size=options['batch_size'], atomic=options['atomic'],
+                blank_is_null=file_format == 'csv')
+            seconds = time.time() - started
+            self.stdout.write(self.IMPORTED.format(
+                rows=rows, model=model_label(model), file=path,
+                seconds=seconds, rate=rows / seconds if seconds else 0))
+
+    def _get_history_model(self, path, natural_key):
+        if natural_key is None:
+            name = os.path.basename(path)
+            if name.endswith('.gz'):
+                name = name[:-3]
+            natural_key = os.path.splitext(name)[0]
+            if natural_key.count('.') != 1:
+                raise CommandError(self.MODEL_HINT.format(file=path))
+        try:
+            return self._model_from_natural_key(natural_key)
+        except ValueError as e:
+            raise CommandError(str(e).strip())
@@ -0,0 +1,81 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError
+
+from ...maintenance import verify_history
+from ._base import HistoryModelCommand, model_label
+
+
+class Command(HistoryModelCommand):
+    help = ("Checks that the latest historical record of every object "
+            "matches the object, optionally repairing the history")
+
+    REPORT = ("{model}: {checked} objects checked, {missing} missing "
+              "baselines, {stale} stale{orphans}\n")
+    ORPHANS = ", {orphaned} orphaned"
+    REPAIRED = "{model}: wrote {rows} historical records\n"
+    INCONSISTENT = "Inconsistent history found"
+
+    option_list = HistoryModelCommand.option_list + (
+        make_option(
+            '--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=1000,
+            help="Number of objects compared per primary key range",
+        ),
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=1,
+            help="Number of processes comparing ranges in parallel",
+        ),
+        make_option(
+            '--orphans',
+            action='store_true',
+            dest='orphans',
+            default=False,
+            help="Also report deleted objects whose history does not end "
+                 "with a deletion",
+        ),
+        make_option(
+            '--repair',
+            action='store_true',
+            dest='repair',
+            default=False,
+            help="Write the missing historical records",
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be a positive integer")
+        inconsistent = False
+        for model, history_model in self.get_models(args, options):
+            label = model_label(model)
+            result = verify_history(
+                model, history_model, chunk_size=options['chunk_size'],
+                workers=options['workers'], repair=options['repair'],
+                orphans=options['orphans'])
+            orphans = ''
+            if options['orphans']:
+                orphans = self.ORPHANS.format(orphaned=len(result.orphaned))
+            self.stdout.write(self.REPORT.format(
+                model=label, checked=result.checked,
+                missing=len(result.missing), stale=len(result.stale),
+                orphans=orphans))
+            if int(options.get('verbosity', 1)) > 1:
+                for name in ('missing', 'stale', 'orphaned'):
+                    pks = getattr(result, name)
+                    if pks:
+                        self.stdout.write("  {name}: {pks}\n".format(
+                            name=name, pks=', '.join(
+                                str(pk) for pk in sorted(pks))))
+            if options['repair']:
+                self.stdout.write(self.REPAIRED.format(
+                    model=label, rows=result.repaired))
+            elif not result.is_consistent():
+                inconsistent = True
+        if inconsistent:
+            raise CommandError(self.INCONSISTENT)
@@ -1,6 +1,179 @@
 from __future__ import unicode_literals
 
+import warnings
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+from .cache import get_as_of_cache, get_snapshot_cache, latest_pending
+
+RECORD_FIELDS = ('history_id', 'history_date', 'history_type')
+
+_field_attnames = {}
+
+
+def get_field_attnames(model):
+    """Return the attnames of ``model``'s concrete fields in order.
+
+    The result is computed once per model and cached.
+    """
+    try:
+        return _field_attnames[model]
+    except KeyError:
+        attnames = tuple(f.attname for f in model._meta.concrete_fields)
+        _field_attnames[model] = attnames
+        return attnames
+
+
+def instance_from_values(model, values, db=None):
+    """Build a ``model`` instance from its concrete field values.
+
+    ``values`` must follow the order of :func:`get_field_attnames`.
+    """
+    if hasattr(model, 'from_db'):
+        return model.from_db(db, get_field_attnames(model), values)
+    return model(*values)  # Django < 1.8
+
+
+def keyset_order(queryset, descending=False):
+    """Order ``queryset`` by the ``(history_date, history_id)`` key."""
+    if descending:
+        return queryset.order_by('-history_date', '-history_id')
+    return queryset.order_by('history_date', 'history_id')
+
+
+def keyset_filter(queryset, history_date, history_id, descending=False):
+    """Restrict ``queryset`` to rows sorting after the given key.
+
+    The leading ``history_date`` range keeps the condition usable by an
+    index on ``(history_date, history_id)``.
+    """
+    if descending:
+        return queryset.filter(history_date__lte=history_date).exclude(
+            history_date=history_date, history_id__gte=history_id)
+    return queryset.filter(history_date__gte=history_date).exclude(
+        history_date=history_date, history_id__lte=history_id)
+
+
+def keyset_chunks(queryset, chunk_size=1000, descending=False):
+    """Yield lists of at most ``chunk_size`` historical records.
+
+    Each chunk is fetched with its own query that continues after the
+    last ``(history_date, history_id)`` seen, so memory use does not
+    grow with the number of records. Querysets of ``values()``
+    dictionaries are supported as long as they include both key fields.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+    queryset = keyset_order(queryset, descending)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        if isinstance(last, dict):
+            key = last['history_date'], last['history_id']
+        else:
+            key = last.history_date, last.history_id
+        chunk = list(keyset_filter(
+            queryset, *key, descending=descending)[:chunk_size])
+
+
+def get_referencing_fields(history_model):
+    """Return ``(model, attname)`` of the foreign keys pointing to
+    ``history_model``, e.g. from the history of relations.
+    """
+    return [
+        (related.related_model, related.field.attname)
+        for related in history_model._meta.get_fields(include_hidden=True)
+        if related.auto_created and not related.concrete and
+        (related.one_to_many or related.one_to_one)
+    ]
+
+
+def get_target_field(field):
+    """Return the field the relation ``field`` points to, e.g. the primary
+    key of the model of a foreign key.
+    """
+    try:
+        rel = field.remote_field
+    except AttributeError:  # Django < 1.9
+        rel = field.rel
+    return rel.get_related_field()
+
+
+class RecordDiff(object):
+    """The differences between two historical records of an object.
+
+    ``old`` and ``new`` map the history fields of both records, e.g.
+    ``history_date``; ``changes`` lists ``(field, old_value, new_value)``
+    for every tracked field whose value differs.
+    """
+
+    def __init__(self, old, new, changes):
+        self.old = old
+        self.new = new
+        self.changes = changes
+
+
+HISTORY_FIELDS = ('history_id', 'history_date', 'history_type',
+                  'history_user_id')
+
+
+def diff_records(queryset, old_history_id, new_history_id):
+    """Compare two historical records of ``queryset`` with one query.
+
+    Raises the historical model's ``DoesNotExist`` if either record is
+    missing from ``queryset``.
+    """
+    history_model = queryset.model
+    model = history_model.instance_type
+    to_python = history_model._meta.pk.to_python
+    ids = to_python(old_history_id), to_python(new_history_id)
+    rows = dict(
+        (row[0], row) for row in queryset.filter(
+            history_id__in=ids).values_list(
+                *(HISTORY_FIELDS + get_field_attnames(model))))
+    try:
+        old, new = rows[ids[0]], rows[ids[1]]
+    except KeyError:
+        raise history_model.DoesNotExist(
+            "%s matching query does not exist." %
+            history_model._meta.object_name)
+    offset = len(HISTORY_FIELDS)
+    changes = [
+        (field, old_value, new_value)
+        for field, old_value, new_value in zip(
+            model._meta.concrete_fields, old[offset:], new[offset:])
+        if old_value != new_value
+    ]
+    return RecordDiff(dict(zip(HISTORY_FIELDS, old)),
+                      dict(zip(HISTORY_FIELDS, new)), changes)
+
+
+class HistoricalQuerySet(models.QuerySet):
+    """QuerySet of historical records.
+
+    ``latest()`` and ``earliest()`` without a field name break ties
+    between records of the same ``history_date`` by ``history_id``.
+    """
+
+    def latest(self, field_name=None):
+        if field_name not in (None, 'history_date'):
+            return super(HistoricalQuerySet, self).latest(field_name)
+        return self._first_by('-history_date', '-history_id')
+
+    def earliest(self, field_name=None):
+        if field_name not in (None, 'history_date'):
+            return super(HistoricalQuerySet, self).earliest(field_name)
+        return self._first_by('history_date', 'history_id')
+
+    def _first_by(self, *ordering):
+        assert self.query.can_filter(), \
+            "Cannot change a query once a slice has been taken."
+        return self.order_by(*ordering)[:1].get()
 
 
 class HistoryDescriptor(object):
@@ -13,7 +186,7 @@ class HistoryDescriptor(object):
         return HistoryManager(self.model, instance)
 
 
-class HistoryManager(models.Manager):
+class HistoryManager(models.Manager.from_queryset(HistoricalQuerySet)):
     def __init__(self, model, instance=None):
         super(HistoryManager, self).__init__()
         self.model = model
@@ -42,19 +215,50 @@ class HistoryManager(models.Manager):
         if not self.instance:
             raise TypeError("Can't use most_recent() without a %s instance." %
                             self.model._meta.object_name)
-        tmp = []
-        for field in self.instance._meta.fields:
-            if isinstance(field, models.ForeignKey):
-                tmp.append(field.name + "_id")
+        model = self.instance.__class__
+        snapshot_cache = get_snapshot_cache()
+        as_of_cache = get_as_of_cache()
+        if snapshot_cache is None and as_of_cache is None:
+            try:
+                values = self.get_queryset().values_list(
+                    *get_field_attnames(model))[0]
+            except IndexError:
+                pass
             else:
-                tmp.append(field.name)
-        fields = tuple(tmp)
-        try:
-            values = self.get_queryset().values_list(*fields)[0]
-        except IndexError:
-            raise self.instance.DoesNotExist("%s has no historical record." %
-                                             self.instance._meta.object_name)
-        return self.instance.__class__(*values)
+                return instance_from_values(model, values,
+                                            self.instance._state.db)
+        else:
+            latest = self._latest(as_of_cache)
+            if latest is not None:
+                return self._snapshot_instance(latest[0], snapshot_cache,
+                                               as_of_cache)
+        record = self._archived_record()
+        if record is not None:
+            return self._archived_instance(record)
+        raise self.instance.DoesNotExist("%s has no historical record." %
+                                         self.instance._meta.object_name)
+
+    def iter_history(self, chunk_size=1000, since=None, until=None,
+                     descending=False):
+        """Iterate over historical records in chunks.
+
+        Records are yielded oldest first (newest first with
+        ``descending=True``) and fetched ``chunk_size`` at a time.
+        ``since`` is inclusive and ``until`` is exclusive.
+        """
+        queryset = self.get_queryset()
+        if since is not None:
+            queryset = queryset.filter(history_date__gte=since)
+        if until is not None:
+            queryset = queryset.filter(history_date__lt=until)
+        for chunk in keyset_chunks(queryset, chunk_size, descending):
+            for record in chunk:
+                yield record
+
+    def diff(self, old_history_id, new_history_id):
+        """Return a :class:`RecordDiff` between two historical records."""
+        return diff_records(self.get_queryset(), old_history_id,
+                            new_history_id)
 
     def as_of(self, date):
         """Get a snapshot as of a specific date.
@@ -65,18 +269,129 @@ class HistoryManager(models.Manager):
         """
         if not self.instance:
             return self._as_of_set(date)
-        queryset = self.get_queryset().filter(history_date__lte=date)
+        snapshot_cache = get_snapshot_cache()
+        as_of_cache = get_as_of_cache()
+        if snapshot_cache is None and as_of_cache is None:
+            try:
+                history_obj = self.get_queryset().filter(
+                    history_date__lte=date)[0]
+            except IndexError:
+                return self._archived_as_of(date)
+            self._check_not_deleted(history_obj.history_type)
+            return history_obj.instance
         try:
-            history_obj = queryset[0]
+            history_id, _, history_type = self._cached_as_of(date,
+                                                             as_of_cache)
         except IndexError:
+            return self._archived_as_of(date)
+        self._check_not_deleted(history_type)
+        return self._snapshot_instance(history_id, snapshot_cache,
+                                       as_of_cache)
+
+    def _cached_as_of(self, date, as_of_cache):
+        """Return ``(history_id, history_date, history_type)`` of the
+        latest record as of ``date``, answering from the cached latest
+        record when it is not newer than ``date``. Raises ``IndexError``
+        when there is no such record.
+        """
+        if as_of_cache is not None:
+            latest = self._latest(as_of_cache)
+            if latest is not None and self._comparable(date) >= latest[1]:
+                return latest
+        return self._fetch_record(
+            self.get_queryset().filter(history_date__lte=date))
+
+    def _comparable(self, date):
+        """Make ``date`` naive or aware like the stored history dates,
+        the way ``DateTimeField.get_prep_value()`` does.
+        """
+        if settings.USE_TZ and timezone.is_naive(date):
+            warnings.warn("as_of() received a naive datetime (%s) while "
+                          "time zone support is active." % date,
+                          RuntimeWarning)
+            return timezone.make_aware(date, timezone.get_default_timezone())
+        if not settings.USE_TZ and timezone.is_aware(date):
+            return timezone.make_naive(date, timezone.get_default_timezone())
+        return date
+
+    def _archived_as_of(self, date):
+        record = self._archived_record(date)
+        if record is None:
             raise self.instance.DoesNotExist(
                 "%s had not yet been created." %
                 self.instance._meta.object_name)
-        if history_obj.history_type == '-':
+        self._check_not_deleted(record['history_type'])
+        return self._archived_instance(record)
+
+    def _check_not_deleted(self, history_type):
+        if history_type == '-':
             raise self.instance.DoesNotExist(
                 "%s had already been deleted." %
                 self.instance._meta.object_name)
-        return history_obj.instance
+
+    def _fetch_record(self, queryset):
+        """Return ``(history_id, history_date, history_type)`` of the first
+        record of ``queryset``, leaving the field values to the caches.
+        Raises ``IndexError`` when ``queryset`` is empty.
+        """
+        return queryset.values_list(*RECORD_FIELDS)[0]
+
+    def _latest(self, as_of_cache):
+        """Return ``(history_id, history_date, history_type)`` of the
+        newest record of the instance, or ``None`` without history.
+        """
+        latest = None
+        if as_of_cache is not None:
+            latest = as_of_cache.get_latest(self.model, self.instance.pk)
+        if latest is None:
+            try:
+                latest = self._fetch_record(self.get_queryset())
+            except IndexError:
+                return None
+            if (as_of_cache is not None and
+                    not latest_pending(self.model, self.instance.pk)):
+                as_of_cache.set_latest(self.model, self.instance.pk, latest)
+        return latest
+
+    def _snapshot_instance(self, history_id, snapshot_cache, as_of_cache):
+        """Rebuild the instance stored in a record, consulting the
+        process-local cache, then the shared cache, then the database.
+        Values read while this thread's transaction has written history
+        for the instance are not cached, since it may be rolled back.
+        """
+        model = self.instance.__class__
+        values = None
+        if snapshot_cache is not None:
+            values = snapshot_cache.get(self.model, history_id)
+        if values is None and as_of_cache is not None:
+            values = as_of_cache.get_snapshot(self.model, history_id)
+            if values is not None and snapshot_cache is not None:
+                snapshot_cache.set(self.model, history_id, values)
+        if values is None:
+            values = self.get_super_queryset().filter(
+                history_id=history_id,
+            ).values_list(*get_field_attnames(model)).get()
+            if as_of_cache is None:
+                snapshot_cache.set(self.model, history_id, values)
+            elif not latest_pending(self.model, self.instance.pk):
+                if snapshot_cache is not None:
+                    snapshot_cache.set(self.model, history_id, values)
+                as_of_cache.set_snapshot(self.model, history_id, values)
+        return instance_from_values(model, values, self.instance._state.db)
+
+    def _archived_record(self, date=None):
+        """Return the latest archived record of the instance as of
+        ``date``, or ``None`` when there is none or no archive.
+        """
+        from .archive import find_archived_record
+
+        return find_archived_record(self.model, self.instance.pk, date)
+
+    def _archived_instance(self, record):
+        model = self.instance.__class__
+        return instance_from_values(
+            model, [record[attname] for attname in get_field_attnames(model)],
+            self.instance._state.db)
 
     def _as_of_set(self, date):
         model = type(self.model().instance)  # a bit of a hack to get the model
@@ -0,0 +1,290 @@
+"""
+Per-model metrics of history writes.
+
+The signal handlers and write methods of ``HistoricalRecords`` are
+measured when the ``SIMPLE_HISTORY_METRICS`` setting is true: the number
+of calls, the history rows written, the queries issued and the wall time
+are added up per model and operation. Measurements include the nested
+writes, e.g. ``post_save`` includes its ``create_historical_record``.
+
+With the ``SIMPLE_HISTORY_SLOW_WRITE_LOG`` setting, the calls of
+``create_historical_record`` and ``m2m_changed`` taking longer or issuing
+more queries than a threshold are logged with their SQL.
+"""
+from __future__ import unicode_literals
+
+from collections import deque
+from functools import wraps
+from timeit import default_timer
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+
+from .signals import history_write_measured
+
+METRICS_SETTING = 'SIMPLE_HISTORY_METRICS'
+SLOW_WRITE_LOG_SETTING = 'SIMPLE_HISTORY_SLOW_WRITE_LOG'
+SLOW_WRITE_OPERATIONS = ('create_historical_record', 'm2m_changed')
+# SQLite on older Django logs "QUERY = '...' - PARAMS = (...)".
+WRITE_STATEMENT = re.compile(r"\s*(?:QUERY = ')?(?:INSERT|UPDATE|DELETE)\b",
+                             re.IGNORECASE)
+
+
+class OperationMetrics(object):
+    """Totals of one operation on one model."""
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.queries = 0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'rows': self.rows,
+                'queries': self.queries, 'seconds': self.seconds}
+
+
+class WriteMetrics(object):
+    """Process-wide totals of the measured history writes, keyed by
+    ``(model, operation)``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Reset every total."""
+        with self._lock:
+            self._data = {}
+
+    def add(self, measurement):
+        key = (measurement.model, measurement.operation)
+        with self._lock:
+            totals = self._data.get(key)
+            if totals is None:
+                totals = self._data[key] = OperationMetrics()
+            totals.calls += 1
+            totals.rows += measurement.rows
+            totals.queries += len(measurement.queries)
+            totals.seconds += measurement.seconds
+
+    def get(self, model, operation):
+        """Return the :class:`OperationMetrics` of ``operation`` on
+        ``model``, zero when it was not measured.
+        """
+        with self._lock:
+            totals = self._data.get((model, operation))
+            if totals is None:
+                return OperationMetrics()
+            copy = OperationMetrics()
+            copy.__dict__.update(totals.__dict__)
+            return copy
+
+    def as_dict(self):
+        """Return ``{'app_label.model': {operation: totals}}`` with the
+        totals as dictionaries, e.g. for exporting.
+        """
+        result = {}
+        with self._lock:
+            for (model, operation), totals in self._data.items():
+                label = '%s.%s' % (model._meta.app_label,
+                                   model._meta.model_name)
+                result.setdefault(label, {})[operation] = totals.as_dict()
+        return result
+
+
+_local = threading.local()
+
+
+class Measurement(object):
+    """Measure the queries and wall time of a block.
+
+    The queries of every database connection of the current thread are
+    captured in ``queries`` (the entries of ``connection.queries``);
+    ``rows`` counts the INSERT, UPDATE and DELETE statements among them,
+    history being written one row per statement. Captured queries are
+    kept in ``connection.queries`` only when it was logging already.
+    ``propagations`` counts the writes to relation history reported with
+    :func:`propagated` by kind, and ``outermost`` tells whether no other
+    measurement was in progress on the thread.
+    """
+
+    def __init__(self, model, operation, instance=None):
+        self.model = model
+        self.operation = operation
+        self.instance = instance
+        self.queries = []
+        self.rows = 0
+        self.seconds = 0.0
+        self.propagations = {}
+
+    def __enter__(self):
+        try:
+            self.outermost = not _local.measurements
+            _local.measurements.append(self)
+        except AttributeError:
+            self.outermost = True
+            _local.measurements = [self]
+        self._logs = []
+        for connection in connections.all():
+            self._logs.append((connection, connection.queries_log,
+                               connection.queries_logged,
+                               connection.force_debug_cursor))
+            connection.queries_log = deque(
+                maxlen=connection.queries_log.maxlen)
+            connection.force_debug_cursor = True
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = default_timer() - self._start
+        _local.measurements.remove(self)
+        for connection, log, logged, force_debug_cursor in self._logs:
+            captured = connection.queries_log
+            self.queries.extend(captured)
+            if logged:
+                log.extend(captured)
+            connection.queries_log = log
+            connection.force_debug_cursor = force_debug_cursor
+        self.rows = sum(1 for query in self.queries
+                        if WRITE_STATEMENT.match(query['sql']))
+
+
+def propagated(kind, count=1):
+    """Count ``count`` propagations of a history write to relation history
+    (``'m2m'`` or ``'fake_m2m'``) for the measurements in progress.
+    """
+    for measurement in getattr(_local, 'measurements', ()):
+        measurement.propagations[kind] = (
+            measurement.propagations.get(kind, 0) + count)
+
+
+class SlowWriteLog(object):
+    """Log the measured history writes exceeding ``ms`` milliseconds or
+    ``queries`` queries to the ``simple_history.slow_writes`` logger, with
+    the model, primary key, propagations to relation history and SQL.
+    """
+
+    logger = logging.getLogger('simple_history.slow_writes')
+
+    def __init__(self, ms=None, queries=None):
+        self.ms = ms
+        self.queries = queries
+
+    def is_slow(self, measurement):
+        return (
+            (self.ms is not None and measurement.seconds * 1000 > self.ms) or
+            (self.queries is not None and
+             len(measurement.queries) > self.queries))
+
+    def log(self, measurement):
+        model = measurement.model
+        self.logger.warning(
+            "Slow history write: %s of %s.%s pk=%s took %.1f ms, "
+            "%d queries, %d rows, %d m2m and %d fake m2m propagations\n%s",
+            measurement.operation, model._meta.app_label,
+            model._meta.model_name, getattr(measurement.instance, 'pk', None),
+            measurement.seconds * 1000, len(measurement.queries),
+            measurement.rows, measurement.propagations.get('m2m', 0),
+            measurement.propagations.get('fake_m2m', 0),
+            '\n'.join('  (%s) %s' % (query['time'], query['sql'])
+                      for query in measurement.queries),
+            extra={'measurement': measurement})
+
+
+_write_metrics = None
+_slow_write_log = None
+# Objects with a ``record(measurement)`` method, receiving the outermost
+# measured calls while registered, e.g. ``testing.HistoryQueries``.
+recorders = []
+_measuring = False
+_configured = False
+
+
+def _configure():
+    global _write_metrics, _slow_write_log, _measuring, _configured
+    if getattr(settings, METRICS_SETTING, False):
+        _write_metrics = WriteMetrics()
+    options = getattr(settings, SLOW_WRITE_LOG_SETTING, None)
+    if options is not None:
+        _slow_write_log = SlowWriteLog(ms=options.get('MS'),
+                                       queries=options.get('QUERIES'))
+    _measuring = _write_metrics is not None or _slow_write_log is not None
+    _configured = True
+
+
+def get_write_metrics():
+    """Return the :class:`WriteMetrics` of this process, or ``None`` when
+    the ``SIMPLE_HISTORY_METRICS`` setting is not true.
+    """
+    if not _configured:
+        _configure()
+    return _write_metrics
+
+
+def get_slow_write_log():
+    """Return the :class:`SlowWriteLog` configured with the
+    ``SIMPLE_HISTORY_SLOW_WRITE_LOG`` setting, a dictionary with optional
+    ``MS`` and ``QUERIES`` thresholds, or ``None``.
+    """
+    if not _configured:
+        _configure()
+    return _slow_write_log
+
+
+def measured(operation):
+    """Decorate a ``HistoricalRecords`` method to measure its calls for
+    the write metrics and the slow write log.
+
+    The model is the ``sender`` of signal handlers, otherwise the model
+    of the instance passed first.
+    """
+    logged = operation in SLOW_WRITE_OPERATIONS
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not _configured:
+                _configure()
+            if not _measuring and not recorders:
+                return method(self, *args, **kwargs)
+            write_metrics, slow_write_log = _write_metrics, _slow_write_log
+            if write_metrics is None and not logged and not recorders:
+                return method(self, *args, **kwargs)
+            instance = kwargs['instance'] if 'instance' in kwargs else args[0]
+            model = kwargs.get('sender') or instance._meta.concrete_model
+            with Measurement(model, operation, instance) as measurement:
+                result = method(self, *args, **kwargs)
+            if write_metrics is not None:
+                write_metrics.add(measurement)
+                history_write_measured.send(
+                    sender=model, model=model, operation=operation,
+                    instance=instance, rows=measurement.rows,
+                    queries=len(measurement.queries),
+                    duration=measurement.seconds)
+            if logged and slow_write_log is not None and \
+                    slow_write_log.is_slow(measurement):
+                slow_write_log.log(measurement)
+            if measurement.outermost:
+                for recorder in list(recorders):
+                    recorder.record(measurement)
+            return result
+        return wrapper
+    return decorator
+
+
+def _reset_metrics(setting, **kwargs):
+    global _write_metrics, _slow_write_log, _measuring, _configured
+    if setting in (METRICS_SETTING, SLOW_WRITE_LOG_SETTING):
+        _write_metrics = None
+        _slow_write_log = None
+        _measuring = False
+        _configured = False
+
+
+setting_changed.connect(_reset_metrics)
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import copy
+from functools import reduce
 import importlib
 import threading
 
@@ -30,12 +31,165 @@ else:  # south configuration for CustomForeignKeyField
         [], ["^simple_history.models.CustomForeignKeyField"])
 
 from . import exceptions
-from .manager import HistoryDescriptor
+from .cache import invalidate_latest
+from .manager import (HistoricalQuerySet, HistoryDescriptor,
+                      get_field_attnames, instance_from_values,
+                      keyset_filter, keyset_order)
+from .metrics import measured, propagated
 
 registered_models = {}
 future_register_models = []
 registered_historical_models = {}
 fake_m2m_models = {}
+fake_m2m_relations = set()
+pending_relation_setup = []
+
+
+class ModelRelations(object):
+    """The relations of a tracked model followed when writing its history.
+
+    ``foreign_keys`` lists ``(field, history_model)`` for every foreign key
+    of the model, with ``None`` when the related model is not tracked, and
+    ``history_fks`` those to tracked models. ``m2m_throughs`` lists
+    ``(through, related_model)`` for the many to many relations whose
+    through model has m2m history. ``fake_from`` and ``fake_to`` list
+    ``(link_model, accessor, other_history_model)`` for the fake m2m
+    relations the model is on the foreign key side, respectively the
+    other side, of.
+    """
+
+    def __init__(self, registry, model):
+        self.history_model = registry.get(model)
+        self.foreign_keys = [
+            (field, registry.get(field.rel.to))
+            for field in model._meta.fields
+            if isinstance(field, models.ForeignKey)]
+        self.history_fks = [(field, history_model)
+                            for field, history_model in self.foreign_keys
+                            if history_model is not None]
+        self.m2m_history_fields = [
+            'history_%s' % field.rel.to.__name__
+            for field, history_model in self.history_fks]
+        self.m2m_throughs = []
+        for rel in model._meta.related_objects:
+            through_history = registry.get(rel.through) \
+                if rel.many_to_many else None
+            if through_history is not None and through_history.is_m2m:
+                self.m2m_throughs.append((rel.through, rel.related_model))
+        self.fake_from = []
+        self.fake_to = []
+        for key, value in fake_m2m_models.items():
+            if key[0] is model:
+                self.fake_from.append(
+                    (key[1], model._meta.get_field(key[2]).attname,
+                     registry.get(value[0])))
+            elif value[0] is model:
+                self.fake_to.append((value[1], value[2],
+                                     registry.get(key[0])))
+
+
+class HistoryRegistry(object):
+    """The historical models of the tracked models.
+
+    Models are looked up by class, or by ``app_label.model_name`` label,
+    so same-named models of different apps do not collide. The
+    :class:`ModelRelations` of every model are worked out on first use
+    and kept until the registry changes.
+    """
+
+    def __init__(self):
+        self.history_models = {}
+        self.labels = {}
+        self._relations = {}
+        self._through_fields = {}
+
+    def register(self, model, history_model):
+        opts = model._meta
+        self.history_models[model] = history_model
+        self.labels['%s.%s' % (opts.app_label, opts.model_name)] = model
+        self.clear_relations()
+
+    def clear_relations(self):
+        self._relations = {}
+
+    def get(self, model, default=None):
+        """Return the historical model of ``model``, or ``default``."""
+        return self.history_models.get(model, default)
+
+    def get_by_label(self, label, default=None):
+        """Return the historical model of the model labelled
+        ``app_label.model_name``, or ``default``.
+        """
+        model = self.labels.get(label.lower())
+        if model is None:
+            return default
+        return self.history_models[model]
+
+    def __contains__(self, model):
+        return model in self.history_models
+
+    def __iter__(self):
+        return iter(self.history_models)
+
+    def items(self):
+        return self.history_models.items()
+
+    def relations(self, model):
+        """Return the :class:`ModelRelations` of a tracked model."""
+        try:
+            return self._relations[model]
+        except KeyError:
+            relations = self._relations[model] = ModelRelations(self, model)
+            return relations
+
+    def through_fields(self, through):
+        """Return ``(name, related_model)`` for the foreign keys declared
+        by a through model.
+        """
+        try:
+            return self._through_fields[through]
+        except KeyError:
+            fields = self._through_fields[through] = [
+                (field.name, field.rel.to)
+                for field in through._meta.local_fields
+                if isinstance(field, models.ForeignKey)]
+            return fields
+
+
+history_registry = HistoryRegistry()
+
+
+def setup_relations(entries):
+    """Set up the history of the relations of ``(records, model,
+    fake_m2m)`` entries, or queue it while the models are being imported.
+
+    Relations are found with ``_meta.get_fields()``, which needs every
+    model to be loaded, so the queue is set up in a single pass from
+    ``AppConfig.ready()`` or before the first history write.
+    """
+    pending_relation_setup.extend(entries)
+    try:
+        models_ready = apps.models_ready
+    except NameError:  # Django < 1.7
+        models_ready = True
+    if models_ready:
+        setup_pending_relations()
+
+
+def setup_pending_relations():
+    """Set up the relation history queued while the models were loading.
+
+    The through models of many to many relations are registered for every
+    queued model first, then the fake m2m models are created.
+    """
+    while pending_relation_setup:
+        batch = list(pending_relation_setup)
+        del pending_relation_setup[:]
+        for records, cls, fake_m2m in batch:
+            records.setup_m2m_history(cls)
+        for records, cls, fake_m2m in batch:
+            if fake_m2m:
+                records.create_fake_m2m(cls)
 
 
 class HistoricalRecords(object):
@@ -43,12 +197,13 @@ class HistoricalRecords(object):
 
     def __init__(self, verbose_name=None, bases=(models.Model,),
                  user_related_name='+', table_name=None, inherit=False,
-                 is_m2m=False):
+                 is_m2m=False, index_together=None):
         self.user_set_verbose_name = verbose_name
         self.user_related_name = user_related_name
         self.table_name = table_name
         self.inherit = inherit
         self.is_m2m = is_m2m
+        self.index_together = index_together
         try:
             if isinstance(bases, six.string_types):
                 raise TypeError
@@ -62,7 +217,7 @@ class HistoricalRecords(object):
         self.cls = cls
         models.signals.class_prepared.connect(self.finalize, weak=False)
         self.add_extra_methods(cls)
-        self.setup_m2m_history(cls)
+        self.setup_relations(cls, fake_m2m=False)
 
     def add_extra_methods(self, cls):
         def save_without_historical_record(self, *args, **kwargs):
@@ -81,22 +236,20 @@ class HistoricalRecords(object):
         setattr(cls, 'save_without_historical_record',
                 save_without_historical_record)
 
+    def setup_relations(self, cls, fake_m2m=True):
+        """Set up the history of the relations of ``cls``, see
+        :func:`setup_relations`.
+        """
+        setup_relations([(self, cls, fake_m2m)])
+
     def setup_m2m_history(self, cls):
-        m2m_history_fields = [m2m.name for m2m in cls._meta.many_to_many]
-        for attr in dir(cls):
-            if hasattr(cls, attr) and hasattr(getattr(cls, attr), 'related') and getattr(cls,
-                                                                                         attr).related.many_to_many:
-                m2m_history_fields.append(attr)
-        if m2m_history_fields:
-            assert (isinstance(m2m_history_fields, list) or isinstance(m2m_history_fields,
-                                                                       tuple)), 'm2m_history_fields must be a list or tuple'
-        for field_name in m2m_history_fields:
-            if hasattr(getattr(cls, field_name), 'field'):
-                field = getattr(cls, field_name).field
-            else:
-                field = getattr(cls, field_name).related.field
+        for field in cls._meta.get_fields():
+            if not field.many_to_many:
+                continue
+            if field.auto_created and not field.concrete:  # reverse side
+                field = field.field
             assert isinstance(field, models.fields.related.ManyToManyField), (
-                '%s must be a ManyToManyField' % field_name)
+                '%s must be a ManyToManyField' % field.name)
             if field.rel.related_model._meta.db_table in registered_models \
                 and field.rel.to._meta.db_table in registered_models:
                 if not sum([isinstance(item, HistoricalRecords) for item in field.rel.through.__dict__.values()]) and \
@@ -168,6 +321,7 @@ class HistoricalRecords(object):
         historical_model = python_2_unicode_compatible(type(str(name), self.bases, attrs))
         historical_model.is_m2m = self.is_m2m
         registered_historical_models[model.__name__] = historical_model
+        history_registry.register(model, historical_model)
         return historical_model
 
     def copy_fields(self, model):
@@ -230,10 +384,15 @@ class HistoricalRecords(object):
                     [getattr(self, opts.pk.attname), self.history_id])
 
         def get_instance(self):
-            return model(**{
-                field.attname: getattr(self, field.attname)
-                for field in fields.values()
-                })
+            return self.history_object
+
+        def get_prev_record(self):
+            """Previous historical record of the same object, or None."""
+            return adjacent_record(self, model, descending=True)
+
+        def get_next_record(self):
+            """Next historical record of the same object, or None."""
+            return adjacent_record(self, model, descending=False)
 
         extra_fields = {
             'history_id': models.AutoField(primary_key=True),
@@ -246,8 +405,11 @@ class HistoricalRecords(object):
                 ('~', 'Changed'),
                 ('-', 'Deleted'),
             )),
+            'objects': HistoricalQuerySet.as_manager(),
             'history_object': HistoricalObjectDescriptor(model),
             'instance': property(get_instance),
+            'prev_record': property(get_prev_record),
+            'next_record': property(get_next_record),
             'instance_type': model,
             'revert_url': revert_url,
             '__str__': lambda self: '%s as of %s' % (self.history_object,
@@ -255,10 +417,10 @@ class HistoricalRecords(object):
         }
         if self.is_m2m:
             for field in model._meta.fields:
-                if isinstance(field, models.ForeignKey) and field.rel.to.__name__ in registered_historical_models:
+                if isinstance(field, models.ForeignKey) and field.rel.to in history_registry:
                     extra_fields.update({
                         'history_{}'.format(field.rel.to.__name__): models.ForeignKey(
-                            registered_historical_models[field.rel.to.__name__],
+                            history_registry.get(field.rel.to),
                             null=True, default=None)
                     })
         # else:
@@ -280,6 +442,7 @@ class HistoricalRecords(object):
         meta_fields = {
             'ordering': ('-history_date', '-history_id'),
             'get_latest_by': 'history_date',
+            'index_together': self.get_index_together(model),
         }
         if self.user_set_verbose_name:
             name = self.user_set_verbose_name
@@ -289,6 +452,21 @@ class HistoricalRecords(object):
         meta_fields['verbose_name'] = name
         return meta_fields
 
+    def get_index_together(self, model):
+        """
+        Returns the composite indexes of the historical model.
+
+        By default the timeline of a single object and the timeline of
+        the whole model are indexed in ``Meta.ordering`` order.
+        """
+        if self.index_together is not None:
+            return self.index_together
+        return (
+            (model._meta.pk.name, 'history_date', 'history_id'),
+            ('history_date', 'history_id'),
+        )
+
+    @measured('post_save')
     def post_save(self, instance, created, **kwargs):
         if not created and hasattr(instance, 'skip_history_when_saving'):
             return
@@ -297,10 +475,11 @@ class HistoricalRecords(object):
 
     def pre_save(self, instance, **kwargs):
         if not self.is_m2m and instance.pk is not None and \
-            not registered_historical_models[instance._meta.model.__name__].objects.filter(id=instance.id).exists() and \
+            not history_registry.get(instance._meta.concrete_model).objects.filter(id=instance.id).exists() and \
             not kwargs.get('raw', False):
             self.create_historical_record(instance._meta.model.objects.get(pk=instance.pk), '+')
 
+    @measured('post_delete')
     def post_delete(self, instance, **kwargs):
         # При удалении не будет создаваться historical_record с типом "-"
         # if self.is_m2m:
@@ -308,14 +487,14 @@ class HistoricalRecords(object):
         # else:
         #     self.create_historical_record(instance, '-')
 
+    @measured('m2m_changed')
     def m2m_changed(self, action, instance, sender, **kwargs):
         source_field_name, target_field_name = None, None
-        for field_name, field_value in sender.__dict__.items():
-            if isinstance(field_value, models.fields.related.ReverseSingleRelatedObjectDescriptor):
-                if field_value.field.related.model == kwargs['model']:
-                    target_field_name = field_name
-                elif field_value.field.related.model == type(instance):
-                    source_field_name = field_name
+        for field_name, related_model in history_registry.through_fields(sender):
+            if related_model == kwargs['model']:
+                target_field_name = field_name
+            elif related_model == type(instance):
+                source_field_name = field_name
         items = sender.objects.filter(**{source_field_name: instance})
         if kwargs.get('pk_set'):
             items = items.filter(**{target_field_name + '__id__in': kwargs['pk_set']})
@@ -327,152 +506,120 @@ class HistoricalRecords(object):
             elif action in ['pre_remove', 'pre_clear']:
                 self.remove_historical_record(item)
 
+    @measured('create_historical_record')
     def create_historical_record(self, instance, history_type):
-        if registered_historical_models[instance._meta.model.__name__].is_m2m:
-            for field in instance._meta.fields:
-                if isinstance(field, models.ForeignKey) and field.rel.to.__name__ in registered_historical_models:
-                    if not registered_historical_models[field.rel.to.__name__].objects.all().filter(
-                        id=getattr(instance, field.name).id).exists():
-                        self.create_historical_record(getattr(instance, field.name), '+')
+        if pending_relation_setup:
+            setup_pending_relations()
+        relations = history_registry.relations(instance._meta.concrete_model)
+        history_model = relations.history_model
+        if history_model.is_m2m:
+            for field, field_history_model in relations.history_fks:
+                if not field_history_model.objects.filter(
+                        id=getattr(instance, field.attname)).exists():
+                    self.create_historical_record(getattr(instance, field.name), '+')
         history_date = getattr(instance, '_history_date', now())
         history_user = self.get_history_user(instance)
         manager = getattr(instance, self.manager_name)
         attrs = {}
         for field in instance._meta.fields:
             attrs[field.attname] = getattr(instance, field.attname)
-            if registered_historical_models[instance._meta.model.__name__].is_m2m:
-                if isinstance(field, models.ForeignKey):
-                    real_model_name = field.rel.to.__name__
-                    if real_model_name not in registered_historical_models:
-                        continue
-                    real_record_id = getattr(instance, field.attname)
-                    history_records = registered_historical_models[real_model_name].objects.filter(id=real_record_id)
-                    if history_records.exists():
-                        attrs['history_{}'.format(real_model_name)] = history_records.latest('history_date')
-
-        if registered_historical_models[instance._meta.model.__name__].is_m2m:
-            query_list = []
-            real_field_names = [f.name for f in instance._meta.fields]
-            for field in registered_historical_models[instance._meta.model.__name__]._meta.fields:
-                if isinstance(field, models.ForeignKey) and field.name not in real_field_names and \
-                        field.name != 'history_user':
-                    query_list.append(Q(**{field.name: attrs[field.name]}))
-                query = reduce(lambda x, y: x & y, query_list, Q())
-            if registered_historical_models[instance._meta.model.__name__].objects.filter(query).exists():
+
+        if history_model.is_m2m:
+            for field, field_history_model in relations.history_fks:
+                latest = field_history_model.objects.filter(
+                    id=getattr(instance, field.attname)).first()
+                if latest is not None:
+                    attrs['history_{}'.format(field.rel.to.__name__)] = latest
+            query_list = [Q(**{name: attrs[name]})
+                          for name in relations.m2m_history_fields]
+            query = reduce(lambda x, y: x & y, query_list, Q())
+            if history_model.objects.filter(query).exists():
                 return
 
         manager.create(history_date=history_date, history_type=history_type, history_user=history_user, **attrs)
+        invalidate_latest(manager.model, instance.pk)
 
-        if registered_historical_models[instance._meta.model.__name__].is_m2m:
+        if history_model.is_m2m:
             return
 
-        # if history_type == '+':
-        #     for f_key in instance._meta.related_objects:
-        #         real_model_name = f_key.related_model.__name__
-        #         if real_model_name not in registered_historical_models:
-        #             continue
-        #         # Выбираем объекты, ссылающиеся на данную модель
-        #         q_dict = {f_key.field.name: instance}
-        #         query = f_key.related_model.objects.all().filter(**q_dict)
-        #         for q in query:
-        #             if not registered_historical_models[real_model_name].objects.all().filter(id=q.id).exists():
-        #                 self.create_historical_record(q, '+')
-        #     for m2m in instance._meta.many_to_many:
-        #         if m2m.related_model.__name__ in registered_historical_models:
-        #             for q in getattr(instance, m2m.name).all():
-        #                 if not registered_historical_models[m2m.related_model.__name__].objects.filter(
-        #                     id=q.id).exists():
-        #                     self.create_historical_record(q, '+')
-
         # Посылаем сигнал m2m change всем связям m2m, что бы обновить изменения
-        for rel in instance._meta.related_objects:
-            if rel.many_to_many and rel.through.__name__ in registered_historical_models and registered_historical_models[rel.through.__name__].is_m2m:
-                models.signals.m2m_changed.send(rel.through, instance=instance, model=rel.related_model, action='post_add')
+        for through, related_model in relations.m2m_throughs:
+            models.signals.m2m_changed.send(through, instance=instance, model=related_model, action='post_add')
+        if relations.m2m_throughs:
+            propagated('m2m', len(relations.m2m_throughs))
         # Смотрим, есть ли наша модель в fake m2m
-        for f_m2m_key, f_m2m_value in fake_m2m_models.items():
-            if f_m2m_key[0] is instance._meta.model:
-                to_inst = getattr(instance, f_m2m_key[2])
-                if to_inst is None:
-                    continue
-                to_hist_insts = registered_historical_models[to_inst._meta.model.__name__].objects.filter(
-                    id=to_inst.id)
-                from_hist_items = registered_historical_models[instance._meta.model.__name__].objects.filter(
-                    id=instance.id).order_by('-history_date')
-                if to_hist_insts.exists() and from_hist_items.exists():
-                    if from_hist_items.count() > 1:
-                        prev_hist_item = from_hist_items[1]
-                        buf_fake_m2m_attrs = {
-                            registered_historical_models[to_inst._meta.model.__name__].__name__: to_hist_insts.latest('history_date'),
-                            registered_historical_models[instance._meta.model.__name__].__name__: prev_hist_item,
-                        }
-                        f_m2m_key[1].objects.filter(**buf_fake_m2m_attrs).delete()
-                    buf_fake_m2m_attrs = {
-                        registered_historical_models[to_inst._meta.model.__name__].__name__: to_hist_insts.latest('history_date'),
-                        registered_historical_models[instance._meta.model.__name__].__name__: from_hist_items[0],
+        for fake_m2m_model, attname, to_hist_model in relations.fake_from:
+            to_id = getattr(instance, attname)
+            if to_id is None:
+                continue
+            to_latest = to_hist_model.objects.filter(id=to_id).first()
+            from_hist_items = list(history_model.objects.filter(
+                id=instance.id).order_by('-history_date')[:2])
+            if to_latest is not None and from_hist_items:
+                if len(from_hist_items) > 1:
+                    fake_m2m_model.objects.filter(**{
+                        to_hist_model.__name__: to_latest,
+                        history_model.__name__: from_hist_items[1],
+                    }).delete()
+                fake_m2m_attrs = {
+                    to_hist_model.__name__: to_latest,
+                    history_model.__name__: from_hist_items[0],
+                }
+                if not fake_m2m_model.objects.filter(**fake_m2m_attrs).exists():
+                    fake_m2m_model(**fake_m2m_attrs).save()
+                    propagated('fake_m2m')
+        to_latest = None
+        for fake_m2m_model, accessor, from_hist_model in relations.fake_to:
+            for from_id in getattr(instance, accessor).values_list('pk', flat=True):
+                if to_latest is None:
+                    to_latest = history_model.objects.filter(id=instance.id).first()
+                    if to_latest is None:
+                        return
+                from_latest = from_hist_model.objects.filter(id=from_id).first()
+                if from_latest is not None:
+                    fake_m2m_attrs = {
+                        from_hist_model.__name__: from_latest,
+                        history_model.__name__: to_latest,
                     }
-                    if not f_m2m_key[1].objects.filter(**buf_fake_m2m_attrs).exists():
-                        f_m2m_key[1](**buf_fake_m2m_attrs).save()
-
-            elif f_m2m_value[0] is instance._meta.model:
-                for from_inst in getattr(instance, f_m2m_value[2]).all():
-                    fake_m2m_model = f_m2m_value[1]
-                    from_hist_model = registered_historical_models[f_m2m_key[0].__name__]
-                    to_hist_model = registered_historical_models[f_m2m_value[0].__name__]
-                    to_hist_insts = to_hist_model.objects.filter(id=instance.id)
-                    from_hist_insts = from_hist_model.objects.filter(id=from_inst.id)
-                    if from_hist_insts.exists() and to_hist_insts.exists():
-                        fake_m2m_attrs = {
-                            from_hist_model.__name__: from_hist_insts.latest('history_date'),
-                            to_hist_model.__name__: to_hist_insts.latest('history_date'),
-                        }
-                        if not fake_m2m_model.objects.filter(**fake_m2m_attrs).exists():
-                            fake_m2m_model(**fake_m2m_attrs).save()
-
+                    if not fake_m2m_model.objects.filter(**fake_m2m_attrs).exists():
+                        fake_m2m_model(**fake_m2m_attrs).save()
+                        propagated('fake_m2m')
 
     def create_fake_m2m(self, model):
-        if not self.is_m2m:
-            for attr in dir(model):
-                if hasattr(model, attr) and hasattr(getattr(model, attr), 'field'):
-                    fld = getattr(model, attr).field
-                    if fld.is_relation and not fld.many_to_many and \
-                            fld.rel.model.__name__ in registered_historical_models and \
-                            not registered_historical_models[fld.rel.model.__name__].is_m2m:
-                        to_model = fld.rel.model
-                        if fld.rel.related_name == '+':
-                            continue
-                        if fld.rel.related_name is not None:
-                            to_name = fld.rel.related_name
-                        else:
-                            to_name = '{}_set'.format(fld.rel.name)
-                        from_model = model
-                        from_name = fld.name
-                    else:
-                        continue
-                elif hasattr(model, attr) and hasattr(getattr(model, attr), 'related'):
-                    rel = getattr(model, attr).related
-                    if rel.is_relation and not rel.field.many_to_many and \
-                            rel.field.model.__name__ in registered_historical_models and \
-                            not registered_historical_models[rel.field.model.__name__].is_m2m:
-                        from_model = rel.field.model
-                        from_name = rel.field.name
-                        to_model = model
-                        to_name = attr
-                    else:
-                        continue
-                else:
-                    continue
-                to_hist_model = registered_historical_models[to_model.__name__]
-                from_hist_model = registered_historical_models[from_model.__name__]
-                attrs = {
-                    u'__module__': from_model.__module__,
-                    'history_id': models.AutoField(primary_key=True),
-                    from_hist_model.__name__: models.ForeignKey(to=from_hist_model, related_name='+'),
-                    to_hist_model.__name__: models.ForeignKey(to=to_hist_model, related_name='+'),
-                    '__str__': lambda self: '%s' % self.__name__
-                }
-                name = '{}_{}_fake'.format(from_hist_model.__name__, to_hist_model.__name__)
-                historical_model = python_2_unicode_compatible(type(str(name), self.bases, attrs))
-                fake_m2m_models[(from_model, historical_model, from_name)] = (to_model, historical_model, to_name)
+        if self.is_m2m:
+            return
+        for field in model._meta.get_fields():
+            if not field.is_relation or field.many_to_many:
+                continue
+            if field.auto_created and not field.concrete:  # reverse side
+                from_model, from_name = field.related_model, field.field.name
+                to_model, to_name = model, field.get_accessor_name()
+            elif field.rel is None or field.rel.related_name == '+':
+                continue
+            else:
+                from_model, from_name = model, field.name
+                to_model = field.related_model
+                to_name = field.rel.related_name or '{}_set'.format(
+                    field.rel.name)
+            from_hist_model = history_registry.get(from_model)
+            to_hist_model = history_registry.get(to_model)
+            if from_hist_model is None or to_hist_model is None or \
+                    from_hist_model.is_m2m or to_hist_model.is_m2m:
+                continue
+            if (from_model, from_name) in fake_m2m_relations:
+                continue  # already set up from the other model
+            attrs = {
+                u'__module__': from_model.__module__,
+                'history_id': models.AutoField(primary_key=True),
+                from_hist_model.__name__: models.ForeignKey(to=from_hist_model, related_name='+'),
+                to_hist_model.__name__: models.ForeignKey(to=to_hist_model, related_name='+'),
+                '__str__': lambda self: '%s' % self.__name__
+            }
+            name = '{}_{}_fake'.format(from_hist_model.__name__, to_hist_model.__name__)
+            historical_model = python_2_unicode_compatible(type(str(name), self.bases, attrs))
+            fake_m2m_models[(from_model, historical_model, from_name)] = (to_model, historical_model, to_name)
+            fake_m2m_relations.add((from_model, from_name))
+            history_registry.clear_relations()
 
     def get_history_user(self, instance):
         """Get the modifying user from instance or middleware."""
@@ -486,50 +633,68 @@ class HistoricalRecords(object):
             except AttributeError:
                 return None
 
+    @measured('remove_historical_record')
     def remove_historical_record(self, item):
-        if registered_historical_models[item._meta.model.__name__].is_m2m:
+        if pending_relation_setup:
+            setup_pending_relations()
+        relations = history_registry.relations(item._meta.concrete_model)
+        history_model = relations.history_model
+        invalidate_latest(history_model, item.pk)
+        if history_model.is_m2m:
             query_list = []
-            for field in item._meta.fields:
-                if isinstance(field, models.ForeignKey):
-                    real_model_name = field.rel.to.__name__
-                    if real_model_name not in registered_historical_models:
-                        return
-                    historical_rel_instances = registered_historical_models[real_model_name].objects.filter(
-                        id=getattr(item, field.attname))
-                    if historical_rel_instances.exists():
-                        query_list.append(
-                            Q(**{'history_{}'.format(real_model_name): historical_rel_instances.latest('history_date')}))
+            for field, field_history_model in relations.foreign_keys:
+                if field_history_model is None:
+                    return
+                latest = field_history_model.objects.filter(
+                    id=getattr(item, field.attname)).first()
+                if latest is not None:
+                    query_list.append(Q(**{
+                        'history_{}'.format(field.rel.to.__name__): latest}))
             query = reduce(lambda x, y: x & y, query_list, Q())
-            res_query = registered_historical_models[item._meta.model.__name__].objects.filter(query)
-            if res_query.exists():
-                res_query.delete()
+            history_model.objects.filter(query).delete()
         else:
-            history_model = registered_historical_models[item._meta.model.__name__]
             last_history_item = history_model.objects.filter(id=item.id)\
                 .latest('history_date')
-            for f_m2m_key, f_m2m_value in fake_m2m_models.items():
+            for fake_m2m_model, _, another_model in \
+                    relations.fake_from + relations.fake_to:
                 buf = []
-                if f_m2m_key[0] is item._meta.model:
-                    res = f_m2m_key[1].objects.filter(**{history_model.__name__: last_history_item})
-                    for itm in res:
-                        another_model = registered_historical_models[f_m2m_value[0].__name__]
-                        another_item = getattr(itm, another_model.__name__)
-                        another_latest_instance = another_model.objects.filter(**{'id': another_item.id}).latest('history_date')
-                        if another_latest_instance == another_item:
-                            buf.append(itm)
-                elif f_m2m_value[0] is item._meta.model:
-                    res = f_m2m_value[1].objects.filter(**{history_model.__name__: last_history_item})
-                    for itm in res:
-                        another_model = registered_historical_models[f_m2m_key[0].__name__]
-                        another_item = getattr(itm, another_model.__name__)
-                        another_latest_instance = another_model.objects.filter(**{'id': another_item.id}).latest(
-                            'history_date')
-                        if another_latest_instance == another_item:
-                            buf.append(itm)
+                res = fake_m2m_model.objects.filter(**{history_model.__name__: last_history_item})
+                for itm in res:
+                    another_item = getattr(itm, another_model.__name__)
+                    another_latest_instance = another_model.objects.filter(**{'id': another_item.id}).latest('history_date')
+                    if another_latest_instance == another_item:
+                        buf.append(itm)
                 for bf in range(len(buf)):
                     buf[bf].delete()
 
 
+def adjacent_record(record, model, descending):
+    """Return the record next to ``record`` in its object's timeline.
+
+    The neighbour is fetched with a single query ordered by
+    ``(history_date, history_id)`` and cached on both records.
+    """
+    if descending:
+        cache_name, reverse_cache_name = '_prev_record', '_next_record'
+    else:
+        cache_name, reverse_cache_name = '_next_record', '_prev_record'
+    try:
+        return getattr(record, cache_name)
+    except AttributeError:
+        pass
+    pk_attname = model._meta.pk.attname
+    queryset = record.__class__._default_manager.filter(**{
+        pk_attname: getattr(record, pk_attname),
+    })
+    queryset = keyset_filter(queryset, record.history_date,
+                             record.history_id, descending)
+    adjacent = keyset_order(queryset, descending).first()
+    setattr(record, cache_name, adjacent)
+    if adjacent is not None:
+        setattr(adjacent, reverse_cache_name, record)
+    return adjacent
+
+
 def transform_field(field):
     """Customize field appropriately for use in historical model"""
     field.name = field.attname
@@ -567,10 +732,32 @@ def convert_auto_field(field):
 
 
 class HistoricalObjectDescriptor(object):
+    """Rebuild the tracked model instance from a historical record.
+
+    The instance is built once per historical record and cached on it.
+    Fields deferred on the historical record keep their default values.
+    """
     def __init__(self, model):
         self.model = model
 
     def __get__(self, instance, owner):
-        values = (getattr(instance, f.attname)
-                  for f in self.model._meta.fields)
-        return self.model(*values)
+        if instance is None:
+            return self
+        try:
+            return instance._history_object_cache
+        except AttributeError:
+            pass
+        attnames = get_field_attnames(self.model)
+        deferred = getattr(instance, 'get_deferred_fields', set)()
+        if deferred:
+            # Build from the loaded fields only rather than fetching each
+            # deferred field with its own query.
+            obj = self.model(**dict(
+                (attname, getattr(instance, attname))
+                for attname in attnames if attname not in deferred))
+        else:
+            values = [getattr(instance, attname) for attname in attnames]
+            obj = instance_from_values(self.model, values,
+                                       instance._state.db)
+        instance._history_object_cache = obj
+        return obj
@@ -0,0 +1,10 @@
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+# Sent after every history write measured by ``simple_history.metrics``,
+# with the ``model`` written, the ``operation`` (the name of the
+# ``HistoricalRecords`` method), the ``instance`` and the ``rows``,
+# ``queries`` and ``duration`` (in seconds) of the write.
+history_write_measured = Signal(providing_args=[
+    'model', 'operation', 'instance', 'rows', 'queries', 'duration'])
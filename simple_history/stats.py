@@ -0,0 +1,197 @@
+"""
+Size and growth statistics of historical tables.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from django.db import connections, router
+from django.db.models import Count, F
+from django.utils import six
+from django.utils.dateparse import parse_date
+from django.utils.timezone import now
+
+from .manager import get_referencing_fields
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def estimated_count(model, exact=False):
+    """Return ``(rows, estimated)`` for the table of ``model``.
+
+    On PostgreSQL and MySQL the planner statistics are read instead of
+    counting, unless ``exact`` is true or the table was never analyzed.
+    ``estimated`` tells which of both was used.
+    """
+    using = router.db_for_read(model)
+    connection = connections[using]
+    if not exact:
+        if connection.vendor == 'postgresql':
+            sql = ("SELECT reltuples FROM pg_class "
+                   "WHERE oid = to_regclass(%s)")
+        elif connection.vendor == 'mysql':
+            sql = ("SELECT table_rows FROM information_schema.tables "
+                   "WHERE table_schema = DATABASE() AND table_name = %s")
+        else:
+            sql = None
+        if sql is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] is not None and row[0] > 0:
+                return int(row[0]), True
+    return model._default_manager.using(using).count(), False
+
+
+def versions_per_object(history_model):
+    """Return the number of objects having each number of records.
+
+    The result is a list of ``(versions, objects)`` pairs sorted by
+    ``versions``, computed by the database in one query.
+    """
+    using = router.db_for_read(history_model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_column = history_model._meta.get_field(
+        history_model.instance_type._meta.pk.attname).column
+    sql = (
+        "SELECT versions, COUNT(*) FROM ("
+        "SELECT COUNT(*) AS versions FROM {table} GROUP BY {pk}"
+        ") counts GROUP BY versions ORDER BY versions"
+    ).format(table=qn(history_model._meta.db_table), pk=qn(pk_column))
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return [(int(versions), int(objects))
+                for versions, objects in cursor.fetchall()]
+
+
+def percentiles(histogram, ranks=PERCENTILES):
+    """Return the nearest-rank percentiles of a ``(value, count)``
+    histogram sorted by value, as a list of ``(rank, value)`` pairs.
+    """
+    total = sum(count for value, count in histogram)
+    result = []
+    for rank in ranks:
+        if not total:
+            result.append((rank, None))
+            continue
+        position = max(1, -(-rank * total // 100))
+        seen = 0
+        for value, count in histogram:
+            seen += count
+            if seen >= position:
+                result.append((rank, value))
+                break
+    return result
+
+
+def _as_date(value):
+    if isinstance(value, six.string_types):
+        return parse_date(value[:10])
+    if isinstance(value, datetime):
+        value = value.date()
+    return value
+
+
+def rows_per_day(history_model, since):
+    """Return ``(date, rows)`` for every day from ``since`` until today,
+    counting the records dated that day.
+    """
+    using = router.db_for_read(history_model)
+    connection = connections[using]
+    column = '%s.%s' % (
+        connection.ops.quote_name(history_model._meta.db_table),
+        connection.ops.quote_name('history_date'))
+    counts = history_model._default_manager.using(using).filter(
+        history_date__gte=since,
+    ).extra(
+        select={'day': connection.ops.date_trunc_sql('day', column)},
+    ).values('day').annotate(rows=Count('history_id')).order_by()
+    by_day = {}
+    for row in counts:
+        day = _as_date(row['day'])
+        by_day[day] = by_day.get(day, 0) + row['rows']
+    day, today = _as_date(since), _as_date(now())
+    result = []
+    while day <= today:
+        result.append((day, by_day.get(day, 0)))
+        day += timedelta(days=1)
+    return result
+
+
+def write_amplification(history_model, since):
+    """Count the rows of relation history written along with the records
+    of ``history_model`` dated ``since`` or later.
+
+    A row of relation history (fake m2m models and m2m history) points to
+    the latest records of the objects it links and is written by the save
+    of the newest of them; it is counted for that record only. Returns
+    ``(saves, linked)`` where ``saves`` is the number of records and
+    ``linked`` maps every model of relation history to its row count.
+    """
+    records = history_model._default_manager.filter(history_date__gte=since)
+    saves = records.count()
+    linked = {}
+    for related_model, attname in get_referencing_fields(history_model):
+        rows = related_model._default_manager.filter(**{
+            '%s__in' % attname: records.values('history_id'),
+        })
+        history_fields = [
+            field for field in related_model._meta.concrete_fields
+            if field.is_relation and hasattr(field.rel.to, 'instance_type')]
+        name = [field.name for field in history_fields
+                if field.attname == attname][0]
+        for field in history_fields:
+            if field.name != name:
+                rows = rows.filter(**{
+                    '%s__history_date__gte' % name:
+                        F('%s__history_date' % field.name),
+                })
+        linked[related_model] = linked.get(related_model, 0) + rows.count()
+    return saves, linked
+
+
+class HistoryStats(object):
+    """Statistics of the historical table of one tracked model.
+
+    ``rows`` is the table size, ``estimated`` when read from the planner
+    statistics; ``objects`` the number of objects with history and
+    ``percentiles`` the ``(rank, versions)`` percentiles of records per
+    object. ``per_day`` lists ``(date, rows)`` over the window and
+    ``saves``/``linked`` are the :func:`write_amplification` counts.
+    """
+
+    def __init__(self, model, history_model):
+        self.model = model
+        self.history_model = history_model
+        self.rows = 0
+        self.estimated = False
+        self.objects = 0
+        self.percentiles = []
+        self.per_day = []
+        self.saves = 0
+        self.linked = {}
+
+    @property
+    def amplification(self):
+        """Average number of relation history rows written per record."""
+        if not self.saves:
+            return None
+        return float(sum(self.linked.values())) / self.saves
+
+
+def history_stats(model, history_model, days=7, exact=False,
+                  ranks=PERCENTILES):
+    """Collect :class:`HistoryStats` for ``model`` over the last ``days``
+    calendar days, today included.
+    """
+    today = now().replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - timedelta(days=days - 1)
+    stats = HistoryStats(model, history_model)
+    stats.rows, stats.estimated = estimated_count(history_model, exact)
+    histogram = versions_per_object(history_model)
+    stats.objects = sum(objects for versions, objects in histogram)
+    stats.percentiles = percentiles(histogram, ranks)
+    stats.per_day = rows_per_day(history_model, since)
+    stats.saves, stats.linked = write_amplification(history_model, since)
+    return stats
@@ -0,0 +1,104 @@
+"""
+Test helpers measuring the queries issued by history capture.
+
+The queries of the history writes (the signal handlers of
+``HistoricalRecords`` and what they call) are counted apart from the
+queries of the application, so a test can bound the cost of history for
+a model::
+
+    class PollTest(HistoryQueriesMixin, TestCase):
+        def test_save(self):
+            with self.assertHistoryQueries(Poll, 3):
+                poll.save()
+
+With pytest, use the ``assert_history_queries`` fixture, made available
+by importing ``assert_history_queries_fixture`` in ``conftest.py``.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import threading
+
+from . import metrics
+
+try:
+    import pytest
+except ImportError:  # pytest not present
+    pytest = None
+
+
+class HistoryQueries(object):
+    """Context manager capturing the queries of the history writes of
+    ``model``, or of every model when ``model`` is ``None``.
+
+    ``captured_queries`` lists the queries (entries of
+    ``connection.queries``) of the writes made by the current thread;
+    ``measurements`` the :class:`~simple_history.metrics.Measurement` of
+    each write. Writes nested in another history write, like the history
+    of many to many relations written along with an object's, are counted
+    with that write.
+    """
+
+    def __init__(self, model=None):
+        self.model = model
+        self.measurements = []
+        self.captured_queries = []
+
+    def __enter__(self):
+        self._thread = threading.current_thread()
+        metrics.recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics.recorders.remove(self)
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def record(self, measurement):
+        if threading.current_thread() is not self._thread:
+            return
+        if self.model is not None and \
+                measurement.model is not self.model._meta.concrete_model:
+            return
+        self.measurements.append(measurement)
+        self.captured_queries.extend(measurement.queries)
+
+    def describe(self):
+        return '\n'.join(
+            '%d. %s' % (i, query['sql'])
+            for i, query in enumerate(self.captured_queries, start=1))
+
+
+@contextmanager
+def assert_history_queries(model=None, max_queries=0,
+                           failure_exception=AssertionError):
+    """Fail when the history writes of ``model`` made in the block issue
+    more than ``max_queries`` queries.
+    """
+    with HistoryQueries(model) as queries:
+        yield queries
+    if len(queries) > max_queries:
+        raise failure_exception(
+            "%d history queries executed, at most %d expected\n"
+            "Captured queries were:\n%s" % (
+                len(queries), max_queries, queries.describe()))
+
+
+class HistoryQueriesMixin(object):
+    """``TestCase`` mixin adding :meth:`assertHistoryQueries`."""
+
+    def assertHistoryQueries(self, model, max_queries):
+        """Return a context manager failing the test when the history
+        writes of ``model`` in the block issue more than ``max_queries``
+        queries.
+        """
+        return assert_history_queries(model, max_queries,
+                                      self.failureException)
+
+
+if pytest is not None:
+    @pytest.fixture(name='assert_history_queries')
+    def assert_history_queries_fixture():
+        """pytest fixture returning :func:`assert_history_queries`."""
+        return assert_history_queries
@@ -279,6 +279,17 @@ class ContactRegister(models.Model):
 register(ContactRegister, table_name='contacts_register_history')
 
 
+class Tag(models.Model):
+    name = models.CharField(max_length=30)
+    history = HistoricalRecords()
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=100)
+    tags = models.ManyToManyField(Tag)
+    history = HistoricalRecords()
+
+
 ###############################################################################
 #
 # Inheritance examples
@@ -1,13 +1,21 @@
 from datetime import datetime, timedelta
+import csv
+import gzip
+import io
+import json
 
 from mock import patch, ANY
 from django_webtest import WebTest
+from django.contrib import admin as admin_module
 from django.contrib.admin import AdminSite
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.messages.storage.fallback import FallbackStorage
+from django.db import connection
 from django.db.transaction import atomic
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.test import TestCase
 from django.test.client import RequestFactory
-from django import VERSION
+from django import VERSION, http
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.utils.encoding import force_text
@@ -24,6 +32,7 @@ except ImportError:  # Django < 1.7
 
 from simple_history.models import HistoricalRecords
 from simple_history.admin import SimpleHistoryAdmin
+from .. import other_admin
 from ..models import Book, Person, Poll, State, Employee
 
 
@@ -542,3 +551,410 @@ class AdminSiteTest(WebTest):
         mock_render.assert_called_once_with(
             request, template_name=admin.object_history_form_template,
             dictionary=context, current_app=admin_site.name)
+
+
+class HistoryViewPaginationTest(WebTest):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.poll = Poll(question="0", pub_date=today)
+        self.poll._history_user = self.user
+        self.poll.save()
+        self.poll_admin = admin_module.site._registry[Poll]
+
+    def save_versions(self, count):
+        for i in range(count):
+            self.poll.question = str(i)
+            self.poll._history_user = self.user
+            self.poll.save()
+
+    def login(self):
+        form = self.app.get(reverse('admin:index')).maybe_follow().form
+        form['username'] = self.user.username
+        form['password'] = 'pass'
+        return form.submit()
+
+    def revert_urls(self, response):
+        urls = [get_history_url(self.poll, i)
+                for i in range(self.poll.history.count())]
+        return [url for url in urls if url in response.unicode_normal_body]
+
+    def test_keyset_pages(self):
+        self.save_versions(4)
+        self.login()
+        with patch.object(self.poll_admin, 'history_list_per_page', 2):
+            newest = self.app.get(get_history_url(self.poll))
+            self.assertEqual(len(self.revert_urls(newest)), 2)
+            self.assertNotIn('Newer', newest.unicode_normal_body)
+            middle = newest.click('Older')
+            self.assertEqual(len(self.revert_urls(middle)), 2)
+            oldest = middle.click('Older')
+            self.assertEqual(self.revert_urls(oldest),
+                             [get_history_url(self.poll, 0)])
+            self.assertNotIn('Older', oldest.unicode_normal_body)
+            back = oldest.click('Newer')
+            self.assertEqual(self.revert_urls(back),
+                             self.revert_urls(middle))
+        pages = self.revert_urls(newest) + self.revert_urls(middle)
+        self.assertEqual(len(set(pages)), 4)
+
+    def test_invalid_cursor_shows_first_page(self):
+        self.login()
+        response = self.app.get(get_history_url(self.poll) +
+                                '?before=invalid')
+        self.assertEqual(self.revert_urls(response),
+                         [get_history_url(self.poll, 0)])
+
+    def count_history_view_queries(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            self.poll_admin.history_view(request, str(self.poll.pk))
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        self.save_versions(2)
+        few = self.count_history_view_queries()
+        self.save_versions(20)
+        self.assertEqual(self.count_history_view_queries(), few)
+
+    def test_history_list_fields(self):
+        self.save_versions(2)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with patch.object(self.poll_admin, 'history_list_fields', []):
+            with patch('simple_history.admin.render') as mock_render:
+                self.poll_admin.history_view(request, str(self.poll.pk))
+        action_list = mock_render.call_args[1]['dictionary']['action_list']
+        self.assertEqual(len(action_list), 3)
+        with self.assertNumQueries(0):
+            for action in action_list:
+                self.assertEqual(action.history_object.pk, self.poll.pk)
+                self.assertEqual(action.history_user, self.user)
+
+
+class AdminLookupCacheTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.poll = Poll(question="why?", pub_date=today)
+        self.poll._history_user = self.user
+        self.poll.save()
+        self.poll.question = "how?"
+        self.poll._history_user = self.user
+        self.poll.save()
+        self.poll_admin = SimpleHistoryAdmin(Poll, admin_module.site)
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def render_history(self):
+        with patch('simple_history.admin.render') as mock_render:
+            self.poll_admin.history_view(self.request, str(self.poll.pk))
+        return mock_render.call_args[1]['dictionary']['action_list']
+
+    def test_history_view_urls(self):
+        action_list = self.render_history()
+        self.assertEqual(action_list[0].admin_revert_url,
+                         get_history_url(self.poll, 1))
+        self.assertEqual(
+            action_list[0].admin_user_url,
+            reverse('admin:custom_user_customuser_change',
+                    args=(self.user.pk,)))
+        # The history page and the live object.
+        with self.assertNumQueries(2):
+            self.render_history()
+
+    def test_user_urls_of_current_admin_site(self):
+        state = State()
+        state._history_user = self.user
+        state.save()
+        state_admin = other_admin.site._registry[State]
+        with patch('simple_history.admin.render') as mock_render:
+            state_admin.history_view(self.request, str(state.pk))
+        [action] = mock_render.call_args[1]['dictionary']['action_list']
+        self.assertEqual(action.admin_revert_url,
+                         get_history_url(state, 0, site="other_admin"))
+        # The other admin site does not register users.
+        self.assertIsNone(action.admin_user_url)
+
+    def test_content_type_looked_up_once(self):
+        version_id = self.poll.history.all()[0].pk
+        with patch('simple_history.admin.render') as mock_render:
+            self.poll_admin.history_form_view(
+                self.request, str(self.poll.pk), version_id)
+            with patch.object(ContentType.objects,
+                              'get_for_model') as get_for_model:
+                self.poll_admin.history_form_view(
+                    self.request, str(self.poll.pk), version_id)
+        self.assertFalse(get_for_model.called)
+        context = mock_render.call_args[1]['dictionary']
+        self.assertEqual(context['content_type_id'],
+                         ContentType.objects.get_for_model(Poll).id)
+        self.assertEqual(context['change_url'],
+                         reverse('admin:tests_poll_change',
+                                 args=(self.poll.pk,)))
+
+
+class HistoryViewQueriesTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.poll = Poll.objects.create(question="why?", pub_date=today)
+        self.poll.question = "how?"
+        self.poll.save()
+        self.version_id = self.poll.history.order_by('history_id')[0].pk
+        self.poll_admin = SimpleHistoryAdmin(Poll, admin_module.site)
+        # Prime the per-admin content type lookup.
+        self.revert_form(RequestFactory().get('/'))
+
+    def revert_form(self, request):
+        request.user = self.user
+        request.session = 'session'
+        request._messages = FallbackStorage(request)
+        with patch('simple_history.admin.render'):
+            return self.poll_admin.history_form_view(
+                request, str(self.poll.pk), self.version_id)
+
+    def test_get_revert_form(self):
+        # The historical row.
+        with self.assertNumQueries(1):
+            self.revert_form(RequestFactory().get('/'))
+
+    def test_post_revert_form(self):
+        request = RequestFactory().post('/', {
+            'question': 'why?', 'pub_date_0': '2021-01-01',
+            'pub_date_1': '10:00:00'})
+        # The historical row, the update and its history record, the
+        # choices tracked on the poll's history and the admin log entry.
+        with self.assertNumQueries(5):
+            response = self.revert_form(request)
+        self.assertEqual(response.status_code, 302)
+
+    def test_post_change_history(self):
+        request = RequestFactory().post('/', {
+            '_change_history': True, 'question': 'why?',
+            'pub_date_0': '2021-01-01', 'pub_date_1': '10:00:00'})
+        with patch('simple_history.admin.SIMPLE_HISTORY_EDIT', True):
+            with self.assertNumQueries(5):
+                response = self.revert_form(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/')
+
+    def test_history_view_of_deleted_object(self):
+        person = Person.objects.create(name="Sandra Hale")
+        person.name = "Sandra Lee"
+        person.save()
+        person_id = person.pk
+        person.delete()
+        person_admin = SimpleHistoryAdmin(Person, admin_module.site)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with patch('simple_history.admin.render') as mock_render:
+            # The history page and the live object; the deleted object is
+            # rebuilt from the first record on the page.
+            with self.assertNumQueries(2):
+                person_admin.history_view(request, str(person_id))
+        context = mock_render.call_args[1]['dictionary']
+        self.assertEqual(context['object'].name, "Sandra Lee")
+
+
+class RecentHistoryViewTest(WebTest):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.other_user = User.objects.create_superuser(
+            'other_login', 'o@example.com', 'pass')
+        self.why = Poll(question="why?", pub_date=today)
+        self.why._history_user = self.user
+        self.why.save()
+        self.how = Poll(question="how?", pub_date=today)
+        self.how._history_user = self.other_user
+        self.how.save()
+        self.how.question = "how so?"
+        self.how._history_user = self.user
+        self.how.save()
+        self.url = reverse('admin:tests_poll_recent_history')
+        form = self.app.get(reverse('admin:index')).maybe_follow().form
+        form['username'] = self.user.username
+        form['password'] = 'pass'
+        form.submit()
+
+    def listed(self, response):
+        return [action.history_id
+                for action in response.context['action_list']]
+
+    def test_lists_changes_of_every_object(self):
+        response = self.app.get(self.url)
+        self.assertEqual(self.listed(response), [
+            self.how.history.all()[0].history_id,
+            self.how.history.all()[1].history_id,
+            self.why.history.get().history_id,
+        ])
+        self.assertIn(get_history_url(self.why),
+                      response.unicode_normal_body)
+        self.assertIn(get_history_url(self.how, 1),
+                      response.unicode_normal_body)
+
+    def test_filters(self):
+        response = self.app.get(self.url, {'history_type': '~'})
+        self.assertEqual(self.listed(response),
+                         [self.how.history.all()[0].history_id])
+        response = self.app.get(self.url, {'user': self.other_user.pk})
+        self.assertEqual(self.listed(response),
+                         [self.how.history.all()[1].history_id])
+        response = self.app.get(self.url, {'since': '2000-01-01',
+                                           'until': '2000-01-02'})
+        self.assertEqual(self.listed(response), [])
+        response = self.app.get(self.url, {'user': 'nobody',
+                                           'history_type': 'x',
+                                           'since': '2000-13-45'})
+        self.assertEqual(len(self.listed(response)), 3)
+
+    def test_pages_keep_filters(self):
+        with patch.object(admin_module.site._registry[Poll],
+                          'history_list_per_page', 1):
+            newest = self.app.get(self.url, {'user': self.user.pk})
+            older = newest.click('Older')
+        self.assertEqual(self.listed(newest),
+                         [self.how.history.all()[0].history_id])
+        self.assertEqual(self.listed(older),
+                         [self.why.history.get().history_id])
+        self.assertEqual(older.request.GET['user'], str(self.user.pk))
+        self.assertNotIn('Older', older.unicode_normal_body)
+
+    def test_requires_change_permission(self):
+        self.app.get(reverse('admin:tests_person_recent_history'),
+                     status=403)
+
+    def test_object_named_history(self):
+        book = Book.objects.create(isbn="history")
+        response = self.app.get(reverse('admin:tests_book_change',
+                                        args=[quote(book.pk)]))
+        self.assertEqual(response.context['original'], book)
+        self.assertEqual(reverse('admin:tests_book_recent_history'),
+                         '/admin/tests/book/_history/')
+
+
+class ExportHistoryViewTest(WebTest):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.poll = Poll.objects.create(question="why, \"really\"?",
+                                        pub_date=today)
+        self.poll.question = "how?"
+        self.poll.save()
+        self.other = Poll.objects.create(question="what?", pub_date=today)
+        form = self.app.get(reverse('admin:index')).maybe_follow().form
+        form['username'] = self.user.username
+        form['password'] = 'pass'
+        form.submit()
+
+    def test_csv(self):
+        response = self.app.get(reverse('admin:tests_poll_export_history'))
+        self.assertEqual(response.content_type, 'text/csv')
+        self.assertIn('tests_poll_history.csv',
+                      response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(response.text)))
+        self.assertEqual(rows[0], [
+            'id', 'question', 'pub_date', 'history_id', 'history_date',
+            'history_user_id', 'history_type'])
+        self.assertEqual([row[1] for row in rows[1:]],
+                         ['why, "really"?', 'how?', 'what?'])
+        self.assertEqual(rows[1][2], today.isoformat())
+
+    def test_object_jsonl_gzip(self):
+        url = reverse('admin:tests_poll_export_object_history',
+                      args=(self.poll.pk,))
+        with patch.object(admin_module.site._registry[Poll],
+                          'history_export_chunk_size', 1):
+            response = self.app.get(url, {'format': 'jsonl', 'gzip': '1'})
+        self.assertEqual(response.content_type, 'application/gzip')
+        self.assertIn('tests_poll_history_%s.jsonl.gz' % self.poll.pk,
+                      response['Content-Disposition'])
+        lines = gzip.GzipFile(
+            fileobj=io.BytesIO(response.body)).read().decode('utf-8')
+        records = [json.loads(line) for line in lines.splitlines()]
+        self.assertEqual(
+            [(r['question'], r['history_type']) for r in records],
+            [('why, "really"?', '+'), ('how?', '~')])
+
+    def test_filters_apply(self):
+        response = self.app.get(reverse('admin:tests_poll_export_history'),
+                                {'format': 'jsonl', 'history_type': '~'})
+        self.assertEqual(len(response.text.splitlines()), 1)
+
+    def test_object_id_sanitized_in_filename(self):
+        Book.objects.create(isbn='a\nb"c')
+        response = self.app.get(reverse(
+            'admin:tests_book_export_object_history',
+            args=('a_0Ab_22c',)))
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="tests_book_history_a_b_c.csv"')
+
+    def test_unknown_object(self):
+        for object_id in ('999', 'abc'):
+            self.app.get(reverse('admin:tests_poll_export_object_history',
+                                 args=(object_id,)), status=404)
+
+    def test_unknown_format(self):
+        self.app.get(reverse('admin:tests_poll_export_history'),
+                     {'format': 'xml'}, status=404)
+
+    def test_requires_change_permission(self):
+        self.app.get(reverse('admin:tests_person_export_history'),
+                     status=403)
+
+    def test_linked_from_history_page(self):
+        response = self.app.get(get_history_url(self.poll))
+        export = response.click('JSON Lines')
+        self.assertEqual(len(export.text.splitlines()), 2)
+
+
+class HistoryCompareViewTest(WebTest):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('user_login',
+                                                  'u@example.com', 'pass')
+        self.poll = Poll.objects.create(question="why?", pub_date=today)
+        self.poll.question = "how?"
+        self.poll.save()
+        self.old, self.new = self.poll.history.order_by('history_id')
+        self.poll_admin = SimpleHistoryAdmin(Poll, admin_module.site)
+
+    def compare(self, old_version_id, new_version_id):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with patch('simple_history.admin.render') as mock_render:
+            self.poll_admin.history_compare_view(
+                request, str(self.poll.pk), old_version_id, new_version_id)
+        return mock_render.call_args[1]['dictionary']
+
+    def test_single_query(self):
+        self.compare(self.old.pk, self.new.pk)
+        with self.assertNumQueries(1):
+            context = self.compare(self.old.pk, self.new.pk)
+        self.assertEqual(context['changes'],
+                         [('Question', "why?", "how?")])
+        self.assertEqual(context['new']['admin_revert_url'],
+                         get_history_url(self.poll, 1))
+
+    def test_missing_version(self):
+        other = Poll.objects.create(question="what?", pub_date=today)
+        self.assertRaises(http.Http404, self.compare, self.old.pk,
+                          other.history.get().pk)
+        self.assertRaises(http.Http404, self.compare, self.old.pk, 'x')
+
+    def test_linked_from_history_page(self):
+        form = self.app.get(reverse('admin:index')).maybe_follow().form
+        form['username'] = self.user.username
+        form['password'] = 'pass'
+        form.submit()
+        response = self.app.get(get_history_url(self.poll))
+        compare = response.click('Compare with previous')
+        self.assertEqual(compare.context['changes'],
+                         [('Question', "why?", "how?")])
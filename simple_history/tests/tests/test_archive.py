@@ -0,0 +1,225 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from django.core import management
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from six.moves import cStringIO as StringIO
+
+from simple_history import archive
+from simple_history.archive import INDEX_NAME, HistoryArchive, get_archive
+from simple_history.cache import get_snapshot_cache, record_values
+from simple_history.manager import get_referencing_fields
+from ..models import Choice, Poll
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        settings_override = override_settings(
+            SIMPLE_HISTORY_ARCHIVE_DIR=self.archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.poll = Poll.objects.create(question="january",
+                                        pub_date=datetime(2015, 1, 1))
+        for question in ("february", "next year"):
+            self.poll.question = question
+            self.poll.save()
+        records = self.poll.history.order_by('history_id')
+        for record, history_date in zip(records, (datetime(2015, 1, 10),
+                                                  datetime(2015, 2, 10),
+                                                  datetime(2016, 1, 10))):
+            Poll.history.filter(history_id=record.history_id).update(
+                history_date=history_date)
+
+    def archive(self, before):
+        return get_archive().archive(
+            Poll.history.filter(history_date__lt=before), chunk_size=1)
+
+    def read_index(self):
+        with open(os.path.join(self.archive_dir, 'tests.poll',
+                               INDEX_NAME)) as f:
+            return json.load(f)['segments']
+
+
+class HistoryArchiveTest(ArchiveTestCase):
+
+    def test_archive(self):
+        self.assertEqual(self.archive(datetime(2016, 1, 1)), 2)
+        self.assertEqual(
+            list(self.poll.history.values_list('question', flat=True)),
+            ["next year"])
+        segments = self.read_index()
+        self.assertEqual(
+            [(s['file'], s['rows'], s['start']) for s in segments],
+            [('2015-01.jsonl.gz', 1, '2015-01-10T00:00:00'),
+             ('2015-02.jsonl.gz', 1, '2015-02-10T00:00:00')])
+        with open(os.path.join(self.archive_dir, 'tests.poll',
+                               segments[0]['file']), 'rb') as f:
+            self.assertEqual(segments[0]['sha256'],
+                             hashlib.sha256(f.read()).hexdigest())
+
+    def test_evicts_snapshots(self):
+        record = self.poll.history.order_by('history_id')[0]
+        with override_settings(SIMPLE_HISTORY_SNAPSHOT_CACHE={}):
+            cache = get_snapshot_cache()
+            cache.set(Poll.history.model, record.history_id,
+                      record_values(record, Poll))
+            self.archive(datetime(2015, 2, 1))
+            self.assertIsNone(cache.get(Poll.history.model,
+                                        record.history_id))
+
+    def test_as_of_reads_archive(self):
+        self.archive(datetime(2016, 1, 1))
+        history = self.poll.history
+        self.assertEqual(history.as_of(datetime(2015, 1, 20)).question,
+                         "january")
+        self.assertEqual(history.as_of(datetime(2015, 3, 1)).question,
+                         "february")
+        self.assertEqual(history.as_of(datetime(2016, 2, 1)).question,
+                         "next year")
+        self.assertRaises(Poll.DoesNotExist, history.as_of,
+                          datetime(2014, 1, 1))
+
+    def test_most_recent_reads_archive(self):
+        self.archive(datetime(2017, 1, 1))
+        self.assertFalse(self.poll.history.exists())
+        most_recent = self.poll.history.most_recent()
+        self.assertEqual(most_recent.question, "next year")
+        self.assertEqual(most_recent.pk, self.poll.pk)
+
+    def test_archive_in_steps(self):
+        self.archive(datetime(2015, 2, 1))
+        self.archive(datetime(2015, 2, 11))
+        self.archive(datetime(2015, 2, 11))
+        self.assertEqual([s['rows'] for s in self.read_index()], [1, 1])
+        self.assertEqual(
+            self.poll.history.as_of(datetime(2015, 3, 1)).question,
+            "february")
+
+    def test_drops_data_of_interrupted_run(self):
+        self.archive(datetime(2015, 2, 1))
+        path = os.path.join(self.archive_dir, 'tests.poll',
+                            '2015-01.jsonl.gz')
+        with open(path, 'ab') as f:
+            f.write(b'\x1f\x8b\x08 partial member')
+        poll = Poll.objects.create(question="late january",
+                                   pub_date=datetime(2015, 1, 1))
+        poll.history.update(history_date=datetime(2015, 1, 20))
+        self.archive(datetime(2015, 2, 1))
+        segment = self.read_index()[0]
+        self.assertEqual(segment['rows'], 2)
+        self.assertEqual(segment['size'], os.path.getsize(path))
+        self.assertEqual(poll.history.most_recent().question,
+                         "late january")
+
+    def test_reads_only_segments_of_the_object(self):
+        poll = Poll.objects.create(question="other",
+                                   pub_date=datetime(2015, 1, 1))
+        poll.history.update(history_date=datetime(2015, 3, 10))
+        self.archive(datetime(2016, 1, 1))
+        self.assertEqual([s['pks'] for s in self.read_index()],
+                         [[str(self.poll.pk)], [str(self.poll.pk)],
+                          [str(poll.pk)]])
+        with patch.object(archive, 'read_history',
+                          wraps=archive.read_history) as read_history:
+            self.assertEqual(
+                self.poll.history.as_of(datetime(2015, 3, 20)).question,
+                "february")
+        self.assertEqual(read_history.call_count, 1)
+
+    def test_reads_segments_indexed_without_pks(self):
+        self.archive(datetime(2016, 1, 1))
+        index = get_archive().read_index(Poll.history.model)
+        for segment in index.values():
+            del segment['pks']
+        get_archive().write_index(Poll.history.model, index)
+        self.assertEqual(
+            self.poll.history.as_of(datetime(2015, 3, 1)).question,
+            "february")
+
+    def test_disabled(self):
+        with override_settings(SIMPLE_HISTORY_ARCHIVE_DIR=None):
+            self.assertIsNone(get_archive())
+            Poll.history.all().delete()
+            self.assertRaises(Poll.DoesNotExist, self.poll.history.as_of,
+                              datetime(2015, 3, 1))
+
+    def test_keeps_referenced_records(self):
+        # Links the choice's record to the poll's latest record.
+        Choice.objects.create(poll=self.poll, choice="yes", votes=0)
+        history_model = Poll.history.model
+        fake_m2m_model = get_referencing_fields(history_model)[0][0]
+        latest = self.poll.history.latest('history_date')
+        HistoryArchive(self.archive_dir).archive(Poll.history.all())
+        self.assertEqual(list(Poll.history.all()), [latest])
+        self.assertEqual(list(fake_m2m_model.objects.values_list(
+            history_model.__name__, flat=True)), [latest.history_id])
+
+    def test_keeps_records_newer_than_referenced(self):
+        Choice.objects.create(poll=self.poll, choice="yes", votes=0)
+        history_model = Poll.history.model
+        fake_m2m_model, attname = get_referencing_fields(history_model)[0]
+        january = self.poll.history.earliest('history_date')
+        fake_m2m_model.objects.update(**{attname: january.history_id})
+        self.assertEqual(self.archive(datetime(2016, 1, 1)), 0)
+        history = self.poll.history
+        self.assertEqual(history.count(), 3)
+        self.assertEqual(history.as_of(datetime(2015, 3, 1)).question,
+                         "february")
+        self.assertEqual(history.most_recent().question, "next year")
+
+    def test_archives_records_older_than_referenced(self):
+        Choice.objects.create(poll=self.poll, choice="yes", votes=0)
+        history_model = Poll.history.model
+        fake_m2m_model, attname = get_referencing_fields(history_model)[0]
+        february = self.poll.history.get(question="february")
+        fake_m2m_model.objects.update(**{attname: february.history_id})
+        self.assertEqual(self.archive(datetime(2017, 1, 1)), 1)
+        history = self.poll.history
+        self.assertEqual(
+            list(history.order_by('history_date').values_list(
+                'question', flat=True)), ["february", "next year"])
+        self.assertEqual(history.as_of(datetime(2015, 1, 20)).question,
+                         "january")
+        self.assertEqual(history.as_of(datetime(2015, 3, 1)).question,
+                         "february")
+        self.assertEqual(history.most_recent().question, "next year")
+
+
+class ArchiveHistoryCommandTest(ArchiveTestCase):
+    command_name = 'archive_history'
+
+    def test_archive(self):
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                before='2016-01-01', stdout=out)
+        self.assertIn("Archived 2 records of tests.poll", out.getvalue())
+        self.assertEqual(self.poll.history.count(), 1)
+
+    def test_archive_dir_option(self):
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_dir)
+        with override_settings(SIMPLE_HISTORY_ARCHIVE_DIR=None):
+            management.call_command(self.command_name, 'tests.poll', days=1,
+                                    archive_dir=other_dir,
+                                    stdout=StringIO())
+        self.assertEqual(self.poll.history.count(), 0)
+        self.assertTrue(os.path.exists(
+            os.path.join(other_dir, 'tests.poll', INDEX_NAME)))
+
+    def test_bad_args(self):
+        self.assertRaises(management.CommandError, management.call_command,
+                          self.command_name, 'tests.poll', stdout=StringIO())
+        with override_settings(SIMPLE_HISTORY_ARCHIVE_DIR=None):
+            self.assertRaises(management.CommandError,
+                              management.call_command, self.command_name,
+                              'tests.poll', days=1, stdout=StringIO())
+        self.assertEqual(self.poll.history.count(), 3)
@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta
+import warnings
+
+from django.contrib.admin import AdminSite
+from django.core.cache import caches
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from mock import patch
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
+
+from simple_history.admin import SimpleHistoryAdmin
+from simple_history.cache import (SnapshotCache, evict_snapshots,
+                                  get_as_of_cache, get_snapshot_cache,
+                                  record_values)
+from simple_history.maintenance import compact_history
+from ..models import Poll, HistoricalPoll, Person
+
+today = datetime(2021, 1, 1, 10, 0)
+
+
+class SnapshotCacheTest(TestCase):
+
+    def test_hits_and_misses(self):
+        cache = SnapshotCache()
+        self.assertIsNone(cache.get(HistoricalPoll, 1))
+        cache.set(HistoricalPoll, 1, (1, 'why?', today))
+        self.assertEqual(cache.get(HistoricalPoll, 1), (1, 'why?', today))
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertTrue(stats['bytes'] > 0)
+
+    def test_entry_limit_evicts_least_recently_used(self):
+        cache = SnapshotCache(max_entries=2)
+        cache.set(HistoricalPoll, 1, (1,))
+        cache.set(HistoricalPoll, 2, (2,))
+        cache.get(HistoricalPoll, 1)
+        cache.set(HistoricalPoll, 3, (3,))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(HistoricalPoll, 2))
+        self.assertEqual(cache.get(HistoricalPoll, 1), (1,))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = SnapshotCache(max_bytes=1000)
+        cache.set(HistoricalPoll, 1, ('x' * 2000,))
+        self.assertEqual(len(cache), 0)
+        for history_id in range(10):
+            cache.set(HistoricalPoll, history_id, ('x' * 200,))
+        self.assertTrue(cache.stats()['bytes'] <= 1000)
+        self.assertTrue(cache.stats()['evictions'] > 0)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_snapshot_cache())
+
+
+@override_settings(SIMPLE_HISTORY_SNAPSHOT_CACHE={'MAX_ENTRIES': 100})
+class SnapshotCacheLookupTest(TestCase):
+
+    def setUp(self):
+        self.poll = Poll.objects.create(question="what?", pub_date=today)
+        self.poll.question = "why?"
+        self.poll.save()
+        self.first, self.second = self.poll.history.order_by('history_id')
+        self.cache = get_snapshot_cache()
+        self.cache.clear()
+
+    def test_as_of(self):
+        date = self.first.history_date + timedelta(microseconds=1)
+        HistoricalPoll.objects.filter(pk=self.second.pk).update(
+            history_date=date + timedelta(days=1))
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll.history.as_of(date).question, "what?")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll.history.as_of(date).question, "what?")
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_most_recent(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll.history.most_recent().question, "why?")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll.history.most_recent().question, "why?")
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_compact_evicts_snapshots(self):
+        self.poll.save()
+        duplicate = self.poll.history.order_by('-history_id')[0]
+        self.cache.set(HistoricalPoll, duplicate.pk,
+                       record_values(duplicate, Poll))
+        self.assertEqual(compact_history(HistoricalPoll), (3, 1))
+        self.assertIsNone(self.cache.get(HistoricalPoll, duplicate.pk))
+
+    def test_history_form_view(self):
+        request = RequestFactory().get('/')
+        request.user = User.objects.create_superuser(
+            'user_login', 'u@example.com', 'pass')
+        admin = SimpleHistoryAdmin(Poll, AdminSite())
+        with patch('simple_history.admin.render'):
+            admin.history_form_view(request, str(self.poll.pk),
+                                    str(self.first.pk))
+            self.assertEqual(self.cache.stats()['misses'], 1)
+            with patch('simple_history.admin.get_object_or_404') as get:
+                admin.history_form_view(request, str(self.poll.pk),
+                                        str(self.first.pk))
+        self.assertFalse(get.called)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+
+AS_OF_CACHE_SETTINGS = {
+    'CACHES': {
+        'history': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'simple-history-tests',
+        },
+    },
+    'SIMPLE_HISTORY_AS_OF_CACHE': {'CACHE': 'history'},
+}
+
+
+@override_settings(**AS_OF_CACHE_SETTINGS)
+class AsOfCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        # Entries of earlier tests may share the primary keys.
+        caches['history'].clear()
+        self.poll = Poll.objects.create(question="what?", pub_date=today)
+        self.poll.question = "why?"
+        self.poll.save()
+        self.first, self.second = self.poll.history.order_by('history_id')
+
+    def test_latest_version(self):
+        date = self.second.history_date + timedelta(days=1)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll.history.as_of(date).question, "why?")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.poll.history.as_of(date).question, "why?")
+            self.assertEqual(self.poll.history.most_recent().question,
+                             "why?")
+
+    def test_older_version_keyed_by_history_id(self):
+        HistoricalPoll.objects.filter(pk=self.second.pk).update(
+            history_date=self.first.history_date + timedelta(days=2))
+        self.poll.history.most_recent()
+        dates = [self.first.history_date + timedelta(hours=hours)
+                 for hours in (1, 2)]
+        with self.assertNumQueries(2):
+            self.assertEqual(self.poll.history.as_of(dates[0]).question,
+                             "what?")
+        # A different date resolving to the same record reuses the entry.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll.history.as_of(dates[1]).question,
+                             "what?")
+        self.assertEqual(
+            get_as_of_cache().get_snapshot(HistoricalPoll, self.first.pk)[1],
+            "what?")
+
+    def test_evict_snapshots(self):
+        as_of_cache = get_as_of_cache()
+        as_of_cache.set_snapshot(HistoricalPoll, self.first.pk, (1, "what?"))
+        evict_snapshots(HistoricalPoll, [self.first.pk])
+        self.assertIsNone(
+            as_of_cache.get_snapshot(HistoricalPoll, self.first.pk))
+
+    def test_not_yet_created(self):
+        date = self.first.history_date - timedelta(days=1)
+        self.assertRaises(Poll.DoesNotExist, self.poll.history.as_of, date)
+
+    def test_save_invalidates_latest(self):
+        self.assertEqual(self.poll.history.most_recent().question, "why?")
+        self.poll.question = "how?"
+        self.poll.save()
+        self.assertEqual(self.poll.history.most_recent().question, "how?")
+        date = self.poll.history.all()[0].history_date
+        self.assertEqual(self.poll.history.as_of(date).question, "how?")
+
+    def test_delete_invalidates_latest(self):
+        as_of_cache = get_as_of_cache()
+        person = Person.objects.create(name="Sandra Hale")
+        person.history.most_recent()
+        history_model = Person.history.model
+        pk = person.pk
+        self.assertIsNotNone(as_of_cache.get_latest(history_model, pk))
+        person.delete()
+        self.assertIsNone(as_of_cache.get_latest(history_model, pk))
+
+    def cache_stale_latest(self):
+        """Cache the previous latest record, as another process reading
+        before the write commits would.
+        """
+        get_as_of_cache().set_latest(
+            HistoricalPoll, self.poll.pk,
+            (self.second.pk, self.second.history_date, '~'))
+
+    def test_pending_until_commit(self):
+        with transaction.atomic():
+            self.poll.question = "how?"
+            self.poll.save()
+            self.cache_stale_latest()
+            self.assertIsNone(
+                get_as_of_cache().get_latest(HistoricalPoll, self.poll.pk))
+        self.assertEqual(self.poll.history.most_recent().question, "how?")
+        self.assertEqual(
+            get_as_of_cache().get_latest(HistoricalPoll, self.poll.pk)[0],
+            self.poll.history.all()[0].pk)
+
+    def test_pending_without_on_commit(self):
+        with patch.object(transaction, 'on_commit', None, create=True):
+            with transaction.atomic():
+                self.poll.question = "how?"
+                self.poll.save()
+                self.cache_stale_latest()
+            self.assertEqual(self.poll.history.most_recent().question,
+                             "how?")
+
+    def test_not_cached_before_rollback(self):
+        as_of_cache = get_as_of_cache()
+        self.poll.history.most_recent()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.poll.question = "how?"
+                self.poll.save()
+                history_id = self.poll.history.all()[0].pk
+                self.assertEqual(self.poll.history.most_recent().question,
+                                 "how?")
+                raise ValueError
+        self.assertIsNone(as_of_cache.get_snapshot(HistoricalPoll,
+                                                   history_id))
+        self.assertEqual(self.poll.history.most_recent().question, "why?")
+        self.assertEqual(
+            as_of_cache.get_latest(HistoricalPoll, self.poll.pk)[0],
+            self.second.pk)
+
+    @override_settings(USE_TZ=True)
+    def test_naive_date_with_time_zones(self):
+        poll = Poll.objects.create(question="what?", pub_date=today)
+        poll.history.most_recent()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(poll.history.as_of(datetime.now()).question,
+                             "what?")
+        self.assertEqual(caught[0].category, RuntimeWarning)
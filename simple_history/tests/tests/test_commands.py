@@ -1,4 +1,10 @@
 from contextlib import contextmanager
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 from six.moves import cStringIO as StringIO
 from datetime import datetime
 try:
@@ -7,12 +13,22 @@ except ImportError:
     from unittest2 import skipUnless
 import django
 from django.test import TestCase
+from mock import patch
 from django.core import management
-from simple_history import models as sh_models
-from simple_history.management.commands import populate_history
+from simple_history import export, maintenance, models as sh_models
+from simple_history.manager import get_referencing_fields
+from simple_history.management.commands import (export_history,
+                                                populate_history)
 
 from .. import models
 
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:  # Django < 1.5
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
+
 
 @contextmanager
 def replace_registry(new_value=None):
@@ -118,3 +134,295 @@ class TestMigrate(TestCase):
     def test_migrate_command(self):
         management.call_command(
             'migrate', 'migration_test_app', fake=True, stdout=StringIO())
+
+
+class TestExportHistory(TestCase):
+    command_name = 'export_history'
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.poll = models.Poll.objects.create(question="what?",
+                                               pub_date=datetime.now())
+        self.poll.question = "why?"
+        self.poll.save()
+        models.Book.objects.create(isbn="9780007117116")
+
+    def export(self, *args, **options):
+        management.call_command(self.command_name, *args,
+                                output_dir=self.output_dir,
+                                stdout=StringIO(), stderr=StringIO(),
+                                **options)
+        with open(os.path.join(self.output_dir,
+                               export_history.MANIFEST_NAME)) as f:
+            return json.load(f)
+
+    def read_export(self, filename):
+        with gzip.open(os.path.join(self.output_dir, filename)) as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def test_export(self):
+        manifest = self.export('tests.poll', 'tests.book', chunk_size=1)
+        self.assertEqual(
+            [(entry['model'], entry['file'], entry['rows'])
+             for entry in manifest['files']],
+            [('tests.book', 'tests.book.jsonl.gz', 1),
+             ('tests.poll', 'tests.poll.jsonl.gz', 2)])
+        entry = manifest['files'][1]
+        with open(os.path.join(self.output_dir, entry['file']), 'rb') as f:
+            data = f.read()
+        self.assertEqual(entry['bytes'], len(data))
+        self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+        records = self.read_export(entry['file'])
+        self.assertEqual([r['question'] for r in records], ["what?", "why?"])
+        self.assertEqual(
+            records[0]['history_date'],
+            self.poll.history.earliest('history_date')
+            .history_date.isoformat())
+
+    def test_date_range(self):
+        last = self.poll.history.latest('history_date')
+        manifest = self.export('tests.poll',
+                               since=last.history_date.isoformat())
+        self.assertEqual(manifest['files'][0]['rows'], 1)
+        self.assertEqual(
+            self.read_export('tests.poll.jsonl.gz')[0]['history_id'],
+            last.history_id)
+        manifest = self.export('tests.poll', until='2000-01-01')
+        self.assertEqual(manifest['files'][0]['rows'], 0)
+
+    def test_invalid_date(self):
+        self.assertRaises(management.CommandError, self.export,
+                          'tests.poll', since='yesterday')
+
+
+class TestImportHistory(TestCase):
+    command_name = 'import_history'
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.user = User.objects.create_user("tester", "t@example.com")
+        poll = models.Poll(question="what?", pub_date=datetime.now())
+        poll._history_user = self.user
+        poll.save()
+        poll.question = "why?"
+        poll.save()
+        self.fields = export.get_export_fields(models.Poll.history.model)
+        self.exported = list(
+            models.Poll.history.order_by('history_id').values_list(
+                *self.fields))
+
+    def export(self, filename, **options):
+        path = os.path.join(self.output_dir, filename)
+        export.export_to_file(models.Poll.history.all(), path, **options)
+        models.Poll.history.all().delete()
+        return path
+
+    def imported(self):
+        return list(models.Poll.history.order_by('history_id').values_list(
+            *self.fields))
+
+    def test_jsonl_round_trip(self):
+        path = self.export('tests.poll.jsonl.gz')
+        out = StringIO()
+        with self.assertNumQueries(2):
+            management.call_command(self.command_name, path, batch_size=1,
+                                    stdout=out, stderr=StringIO())
+        self.assertEqual(self.imported(), self.exported)
+        self.assertIn("Imported 2 records of tests.poll", out.getvalue())
+        self.assertIn("records/s", out.getvalue())
+
+    def test_csv_round_trip(self):
+        path = self.export('history.csv', format='csv', compress=False)
+        management.call_command(self.command_name, path, model='tests.poll',
+                                atomic=True, stdout=StringIO(),
+                                stderr=StringIO())
+        self.assertEqual(self.imported(), self.exported)
+
+    def test_bad_args(self):
+        path = self.export('history.jsonl')
+        for args, options in (((), {}),
+                              ((path,), {}),
+                              ((path,), {'model': 'tests.place'}),
+                              ((path,), {'model': 'tests.poll',
+                                         'batch_size': 0})):
+            self.assertRaises(management.CommandError,
+                              management.call_command, self.command_name,
+                              *args, stdout=StringIO(), stderr=StringIO(),
+                              **options)
+        self.assertEqual(models.Poll.history.count(), 0)
+
+
+class TestCompactHistory(TestCase):
+    command_name = 'compact_history'
+
+    def setUp(self):
+        self.poll = models.Poll.objects.create(question="a",
+                                               pub_date=datetime.now())
+        self.other = models.Poll.objects.create(question="a",
+                                                pub_date=self.poll.pub_date)
+        for question in ("a", "a", "b", "b"):
+            self.poll.question = question
+            self.poll.save()
+            self.other.save()
+
+    def questions(self, poll):
+        return list(poll.history.order_by('history_id').values_list(
+            'history_type', 'question'))
+
+    def test_compact(self):
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                chunk_size=2, stdout=out)
+        self.assertEqual(self.questions(self.poll),
+                         [('+', 'a'), ('~', 'a'), ('~', 'b')])
+        self.assertEqual(self.questions(self.other), [('+', 'a'), ('~', 'a')])
+        self.assertIn("Compacted tests.poll: 5 of 10 records reclaimed",
+                      out.getvalue())
+
+    def test_dry_run(self):
+        out = StringIO()
+        management.call_command(self.command_name, 'tests.poll',
+                                dry_run=True, stdout=out)
+        self.assertEqual(models.Poll.history.count(), 10)
+        self.assertIn("5 of 10 records reclaimable", out.getvalue())
+
+    def test_rewires_relation_history(self):
+        choice = models.Choice.objects.create(poll=self.poll, choice="yes",
+                                              votes=0)
+        history_model = models.Poll.history.model
+        link_model = get_referencing_fields(history_model)[0][0]
+        survivor, duplicate = self.poll.history.order_by(
+            'history_id')[1:3]
+        choice_record = choice.history.get()
+        link_model.objects.all().delete()
+        for record in (survivor, duplicate, duplicate):
+            link_model.objects.create(**{
+                history_model.__name__: record,
+                models.Choice.history.model.__name__: choice_record,
+            })
+        management.call_command(self.command_name, 'tests.poll',
+                                stdout=StringIO())
+        self.assertEqual(
+            list(link_model.objects.values_list(
+                history_model.__name__, flat=True)),
+            [survivor.history_id])
+
+    def test_deduplicates_m2m_history(self):
+        tag = models.Tag.objects.create(name="django")
+        article = models.Article.objects.create(title="news")
+        article.tags.add(tag)
+        tag.save()
+        tag.save()
+        m2m_history = models.Article.tags.through.history
+        self.assertEqual(m2m_history.count(), 3)
+        management.call_command(self.command_name, 'tests.tag',
+                                stdout=StringIO())
+        first, survivor = tag.history.order_by('history_id')
+        self.assertEqual(
+            list(m2m_history.order_by('history_id').values_list(
+                'history_Tag', 'history_Article')),
+            [(first.history_id, article.history.get().history_id),
+             (survivor.history_id, article.history.get().history_id)])
+
+
+class FakePool(object):
+    """Stand-in for ``multiprocessing.Pool`` running the jobs in process,
+    as the test database is not shared with other processes.
+    """
+
+    def __init__(self, workers):
+        FakePool.workers = workers
+
+    def imap_unordered(self, function, iterable):
+        return reversed([function(args) for args in iterable])
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class TestVerifyHistory(TestCase):
+    command_name = 'verify_history'
+
+    def setUp(self):
+        pub_date = datetime.now()
+        self.polls = [models.Poll.objects.create(question=str(i),
+                                                 pub_date=pub_date)
+                      for i in range(4)]
+        models.Poll.history.filter(id=self.polls[1].pk).delete()
+        models.Poll.objects.filter(pk=self.polls[2].pk).update(
+            question="changed")
+        models.Poll.history.create(id=self.polls[-1].pk + 100, question="x",
+                                   pub_date=pub_date, history_date=pub_date,
+                                   history_type='+')
+
+    def verify(self, **options):
+        out = StringIO()
+        try:
+            management.call_command(self.command_name, 'tests.poll',
+                                    chunk_size=2, stdout=out, **options)
+        except management.CommandError:
+            return False, out.getvalue()
+        return True, out.getvalue()
+
+    def test_report(self):
+        consistent, out = self.verify(verbosity=2, orphans=True)
+        self.assertFalse(consistent)
+        self.assertIn("tests.poll: 4 objects checked, 1 missing baselines, "
+                      "1 stale, 1 orphaned", out)
+        self.assertIn("missing: %s" % self.polls[1].pk, out)
+        self.assertIn("stale: %s" % self.polls[2].pk, out)
+        self.assertIn("orphaned: %s" % (self.polls[-1].pk + 100), out)
+
+    def test_repair(self):
+        consistent, out = self.verify(repair=True, orphans=True)
+        self.assertTrue(consistent)
+        self.assertIn("wrote 3 historical records", out)
+        self.assertEqual(
+            self.polls[2].history.most_recent().question, "changed")
+        self.assertEqual(
+            models.Poll.history.filter(history_type='-').count(), 1)
+        consistent, out = self.verify(orphans=True)
+        self.assertTrue(consistent)
+        self.assertIn("0 missing baselines, 0 stale, 0 orphaned", out)
+
+    def test_deleted_objects_not_orphaned_by_default(self):
+        self.polls[0].delete()
+        consistent, out = self.verify(repair=True)
+        self.assertIn("3 objects checked, 1 missing baselines, 1 stale\n",
+                      out)
+        self.assertIn("wrote 2 historical records", out)
+        self.assertFalse(
+            models.Poll.history.filter(history_type='-').exists())
+
+    def test_workers(self):
+        with patch.object(maintenance.multiprocessing, 'Pool', FakePool), \
+                patch.object(maintenance.connections, 'close_all') as close:
+            result = maintenance.verify_history(
+                models.Poll, models.Poll.history.model, chunk_size=1,
+                workers=2, orphans=True)
+        self.assertTrue(close.called)
+        self.assertEqual(FakePool.workers, 2)
+        self.assertEqual(result.checked, 4)
+        self.assertEqual((result.missing, result.stale, result.orphaned),
+                         ([self.polls[1].pk], [self.polls[2].pk],
+                          [self.polls[-1].pk + 100]))
+
+    def test_latest_records_query(self):
+        self.polls[0].question = "new"
+        self.polls[0].save()
+        with self.assertNumQueries(1):
+            latest = list(maintenance.latest_records(
+                self.polls[0].history.all()))
+        self.assertEqual([record.question for record in latest], ["new"])
+
+    def test_pk_ranges(self):
+        pks = [poll.pk for poll in self.polls]
+        self.assertEqual(list(maintenance.pk_ranges(models.Poll, 3)),
+                         [(None, pks[2]), (pks[2], None)])
+        self.assertEqual(list(maintenance.pk_ranges(models.Poll, 4)),
+                         [(None, pks[3]), (pks[3], None)])
@@ -86,3 +86,81 @@ class AsOfAdditionalTestCase(TestCase):
         historical = models.Document.history.as_of(datetime.now()
                                                    + timedelta(days=1))
         self.assertEqual(list(historical), [document1, document2])
+
+
+class IterHistoryTest(TestCase):
+
+    def setUp(self):
+        self.now = datetime.now()
+        self.poll = models.Poll.objects.create(question="what?",
+                                               pub_date=self.now)
+        for i in range(4):
+            self.poll.question = "what %d?" % i
+            self.poll.save()
+        # Give two records the same date to exercise the history_id
+        # tie-breaker.
+        records = list(self.poll.history.order_by('history_id'))
+        for i, record in enumerate(records):
+            record.history_date = self.now + timedelta(days=min(i, 3))
+            record.save()
+        self.ascending = records
+        models.Poll.objects.create(question="other", pub_date=self.now)
+
+    def test_ascending(self):
+        with self.assertNumQueries(3):
+            records = list(self.poll.history.iter_history(chunk_size=2))
+        self.assertEqual(records, self.ascending)
+
+    def test_descending(self):
+        records = list(self.poll.history.iter_history(chunk_size=2,
+                                                      descending=True))
+        self.assertEqual(records, self.ascending[::-1])
+
+    def test_date_range(self):
+        records = list(self.poll.history.iter_history(
+            chunk_size=1,
+            since=self.now + timedelta(days=1),
+            until=self.now + timedelta(days=3),
+        ))
+        self.assertEqual(records, self.ascending[1:3])
+
+    def test_model_history(self):
+        records = list(models.Poll.history.iter_history(chunk_size=4))
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records, list(models.Poll.history.order_by(
+            'history_date', 'history_id')))
+
+    def test_invalid_chunk_size(self):
+        self.assertRaises(ValueError, list,
+                          self.poll.history.iter_history(chunk_size=0))
+
+
+class DiffTest(TestCase):
+
+    def setUp(self):
+        self.now = datetime.now()
+        self.poll = models.Poll.objects.create(question="what?",
+                                               pub_date=self.now)
+        self.poll.question = "why?"
+        self.poll.save()
+        self.old, self.new = self.poll.history.order_by('history_id')
+
+    def test_changed_fields(self):
+        with self.assertNumQueries(1):
+            diff = self.poll.history.diff(self.old.pk, self.new.pk)
+        self.assertEqual(
+            [(field.name, old, new) for field, old, new in diff.changes],
+            [('question', "what?", "why?")])
+        self.assertEqual(diff.old['history_id'], self.old.pk)
+        self.assertEqual(diff.new['history_type'], '~')
+
+    def test_same_record(self):
+        diff = self.poll.history.diff(self.new.pk, self.new.pk)
+        self.assertEqual(diff.changes, [])
+
+    def test_record_of_other_object(self):
+        other = models.Poll.objects.create(question="what?",
+                                           pub_date=self.now)
+        self.assertRaises(
+            self.poll.history.model.DoesNotExist, self.poll.history.diff,
+            self.old.pk, other.history.get().pk)
@@ -0,0 +1,146 @@
+from datetime import datetime
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from simple_history.metrics import (Measurement, SlowWriteLog,
+                                    get_slow_write_log, get_write_metrics,
+                                    propagated)
+from simple_history.signals import history_write_measured
+from ..models import Choice, Poll
+
+today = datetime(2021, 1, 1, 10, 0)
+
+
+@override_settings(SIMPLE_HISTORY_METRICS=True)
+class WriteMetricsTest(TestCase):
+
+    def setUp(self):
+        get_write_metrics().clear()
+        self.measured = []
+        history_write_measured.connect(self.receiver)
+        self.addCleanup(history_write_measured.disconnect, self.receiver)
+
+    def receiver(self, **kwargs):
+        self.measured.append(kwargs)
+
+    def test_per_model_totals(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        Choice.objects.create(poll=poll, choice="not much", votes=0)
+        metrics = get_write_metrics()
+        created = metrics.get(Poll, 'create_historical_record')
+        self.assertEqual(created.calls, 1)
+        self.assertEqual(created.rows, 1)
+        self.assertTrue(created.queries >= created.rows)
+        saved = metrics.get(Poll, 'post_save')
+        self.assertEqual(saved.calls, 1)
+        self.assertEqual(saved.queries, created.queries)
+        self.assertTrue(saved.seconds >= created.seconds > 0)
+        # The history of the choice and its link to the poll history.
+        self.assertEqual(metrics.get(Choice, 'post_save').rows, 2)
+        self.assertEqual(metrics.get(Choice, 'post_delete').calls, 0)
+        self.assertEqual(
+            metrics.as_dict()['tests.poll']['post_save']['calls'], 1)
+
+    def test_signal(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        self.assertEqual([(m['operation'], m['model'], m['instance'])
+                          for m in self.measured], [
+            ('create_historical_record', Poll, poll),
+            ('post_save', Poll, poll),
+        ])
+        self.assertEqual(self.measured[0]['rows'], 1)
+        self.assertTrue(self.measured[0]['queries'] >= 1)
+        self.assertTrue(self.measured[0]['duration'] > 0)
+
+    def test_delete(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        poll.delete()
+        metrics = get_write_metrics()
+        self.assertEqual(metrics.get(Poll, 'post_delete').calls, 1)
+        self.assertEqual(metrics.get(Poll, 'remove_historical_record').calls,
+                         1)
+
+    def test_queries_log_left_alone(self):
+        queries = len(connection.queries_log)
+        Poll.objects.create(question="what's up?", pub_date=today)
+        self.assertEqual(len(connection.queries_log), queries)
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_nested_measurements(self):
+        with Measurement(Poll, 'outer') as outer:
+            with Measurement(Poll, 'inner') as inner:
+                Poll.objects.count()
+            Poll.objects.count()
+        self.assertEqual(len(inner.queries), 1)
+        self.assertEqual(len(outer.queries), 2)
+        self.assertEqual(outer.rows, 0)
+
+    def test_propagations(self):
+        with Measurement(Poll, 'outer') as outer:
+            propagated('m2m', 2)
+            with Measurement(Poll, 'inner') as inner:
+                propagated('fake_m2m')
+        propagated('fake_m2m')
+        self.assertEqual(inner.propagations, {'fake_m2m': 1})
+        self.assertEqual(outer.propagations, {'m2m': 2, 'fake_m2m': 1})
+
+
+@patch.object(SlowWriteLog.logger, 'warning')
+class SlowWriteLogTest(TestCase):
+
+    def setUp(self):
+        self.poll = Poll.objects.create(question="what's up?", pub_date=today)
+
+    def logged(self, warning):
+        return [(c[0][1], c[0][4], c[1]['extra']['measurement'])
+                for c in warning.call_args_list]
+
+    @override_settings(SIMPLE_HISTORY_SLOW_WRITE_LOG={'QUERIES': 0})
+    def test_query_threshold(self, warning):
+        choice = Choice.objects.create(poll=self.poll, choice="not much",
+                                       votes=0)
+        self.assertIsNone(get_write_metrics())
+        [(operation, pk, measurement)] = self.logged(warning)
+        self.assertEqual((operation, pk), ('create_historical_record',
+                                           choice.pk))
+        self.assertEqual(measurement.propagations, {'fake_m2m': 1})
+        message = warning.call_args[0][0] % warning.call_args[0][1:]
+        self.assertIn("Slow history write: create_historical_record of "
+                      "tests.choice pk=%s" % choice.pk, message)
+        self.assertIn("2 rows, 0 m2m and 1 fake m2m propagations\n", message)
+        self.assertIn('INSERT INTO "tests_historicalchoice"', message)
+
+    @override_settings(SIMPLE_HISTORY_SLOW_WRITE_LOG={'MS': 0})
+    def test_time_threshold(self, warning):
+        self.poll.save()
+        self.assertEqual([operation for operation, _, _
+                          in self.logged(warning)],
+                         ['create_historical_record'])
+
+    @override_settings(SIMPLE_HISTORY_SLOW_WRITE_LOG={'MS': 10000,
+                                                      'QUERIES': 1000})
+    def test_below_thresholds(self, warning):
+        Choice.objects.create(poll=self.poll, choice="not much", votes=0)
+        self.assertFalse(warning.called)
+
+    def test_disabled_by_default(self, warning):
+        self.poll.save()
+        self.assertIsNone(get_slow_write_log())
+        self.assertFalse(warning.called)
+
+
+class DisabledWriteMetricsTest(TestCase):
+
+    def test_disabled_by_default(self):
+        measured = []
+
+        def receiver(**kwargs):
+            measured.append(kwargs)
+        history_write_measured.connect(receiver)
+        self.addCleanup(history_write_measured.disconnect, receiver)
+        Poll.objects.create(question="what's up?", pub_date=today)
+        self.assertIsNone(get_write_metrics())
+        self.assertEqual(measured, [])
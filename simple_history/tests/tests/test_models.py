@@ -5,13 +5,18 @@ import unittest
 import warnings
 
 import django
-from django.db import models
+from django.db import connection, models
 from django.db.models.fields.proxy import OrderWrt
 from django.test import TestCase
 from django.core.files.base import ContentFile
-
-from simple_history import exceptions, register
-from simple_history.models import HistoricalRecords, convert_auto_field
+from mock import Mock, patch
+
+import simple_history
+from simple_history import (dependency_order, exceptions, register,
+                            register_model_list)
+from simple_history import models as sh_models
+from simple_history.models import (HistoricalRecords, convert_auto_field,
+                                   history_registry)
 from ..models import (
     AdminProfile, Bookcase, MultiOneToOne, Poll, Choice, Voter, Restaurant,
     Person, FileModel, Document, Book, HistoricalPoll, Library, State,
@@ -25,6 +30,7 @@ from ..models import (
     InheritTracking1, InheritTracking2, InheritTracking3, InheritTracking4,
 )
 from ..external.models import ExternalModel2, ExternalModel4
+from ..external.models import Poll as ExternalPoll
 
 try:
     from django.apps import apps
@@ -350,6 +356,134 @@ class RegisterTest(TestCase):
                          str(voter.history.all()[0])[:len(expected)])
 
 
+@patch.object(HistoricalRecords, 'create_fake_m2m')
+@patch.object(HistoricalRecords, 'setup_m2m_history')
+class RelationSetupTest(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, sh_models, 'pending_relation_setup', [])
+        self.records = HistoricalRecords()
+
+    def test_deferred_while_importing(self, setup_m2m_history,
+                                      create_fake_m2m):
+        with patch.object(apps, 'models_ready', False):
+            self.records.setup_relations(Voter)
+            self.records.setup_relations(Poll, fake_m2m=False)
+        self.assertFalse(setup_m2m_history.called)
+        self.assertFalse(create_fake_m2m.called)
+        sh_models.setup_pending_relations()
+        self.assertEqual([c[0] for c in setup_m2m_history.call_args_list],
+                         [(Voter,), (Poll,)])
+        create_fake_m2m.assert_called_once_with(Voter)
+        self.assertEqual(sh_models.pending_relation_setup, [])
+
+    def test_immediate_once_models_are_loaded(self, setup_m2m_history,
+                                              create_fake_m2m):
+        self.records.setup_relations(Voter)
+        setup_m2m_history.assert_called_once_with(Voter)
+        create_fake_m2m.assert_called_once_with(Voter)
+
+    def test_set_up_on_first_write(self, setup_m2m_history, create_fake_m2m):
+        with patch.object(apps, 'models_ready', False):
+            self.records.setup_relations(Voter)
+        Poll.objects.create(question="why?", pub_date=today)
+        create_fake_m2m.assert_called_once_with(Voter)
+
+
+class RegisterModelListTest(TestCase):
+    def test_dependency_order(self):
+        self.assertEqual(dependency_order([Voter, Choice, Poll]),
+                         [Poll, Choice, Voter])
+        self.assertEqual(dependency_order([Restaurant, Choice, Person, Poll]),
+                         [Restaurant, Person, Poll, Choice])
+        self.assertEqual(dependency_order([SelfFK, Province, Country]),
+                         [SelfFK, Country, Province])
+
+    def test_dependency_cycle(self):
+        self.assertEqual(dependency_order([City, Province, Country]),
+                         [Country, City, Province])
+        code = Country._meta.get_field('code')
+        # Django >= 1.9 reads ``rel`` from ``remote_field``.
+        rel = 'remote_field' if hasattr(code, 'remote_field') else 'rel'
+        with patch.object(code, rel, Mock(to=City)):
+            self.assertEqual(dependency_order([City, Province, Country]),
+                             [City, Country, Province])
+
+    def test_relations_set_up_in_one_pass(self):
+        self.addCleanup(setattr, sh_models, 'pending_relation_setup', [])
+        self.addCleanup(setattr, sh_models, 'future_register_models',
+                        sh_models.future_register_models)
+        calls = Mock()
+        records = Mock(setup_m2m_history=calls.setup_m2m_history,
+                       create_fake_m2m=calls.create_fake_m2m)
+        with patch.object(simple_history, '_create_history',
+                          return_value=records) as create_history, \
+                patch.object(apps, 'models_ready', False):
+            register_model_list([Voter, Choice, Poll])
+        self.assertEqual([c[0] for c in create_history.call_args_list],
+                         [(Poll,), (Choice,), (Voter,)])
+        self.assertEqual(calls.mock_calls, [])
+        sh_models.setup_pending_relations()
+        self.assertEqual([c[0] for c in calls.mock_calls], [
+            'setup_m2m_history', 'setup_m2m_history', 'setup_m2m_history',
+            'create_fake_m2m', 'create_fake_m2m', 'create_fake_m2m',
+        ])
+        self.assertEqual(sh_models.future_register_models,
+                         [Voter, Choice, Poll])
+
+
+class FakeM2MSetupTest(TestCase):
+    def test_set_up_once_per_relation(self):
+        links = dict(sh_models.fake_m2m_models)
+        HistoricalRecords().create_fake_m2m(Voter)
+        HistoricalRecords().create_fake_m2m(Choice)
+        self.assertEqual(sh_models.fake_m2m_models, links)
+
+    def test_relations_found_from_both_sides(self):
+        links = dict((from_name, (from_model, to_model, to_name))
+                     for (from_model, _, from_name), (to_model, _, to_name)
+                     in sh_models.fake_m2m_models.items()
+                     if Voter in (from_model, to_model))
+        self.assertEqual(links, {
+            'choice': (Voter, Choice, 'voters'),
+            'user': (Voter, User, 'voter_set'),
+        })
+
+
+class HistoryRegistryTest(TestCase):
+    def test_same_named_models(self):
+        self.assertIs(history_registry.get(Poll), HistoricalPoll)
+        self.assertIs(history_registry.get(ExternalPoll),
+                      ExternalPoll.history.model)
+        self.assertIsNot(ExternalPoll.history.model, HistoricalPoll)
+        self.assertIs(history_registry.get_by_label('tests.Poll'),
+                      HistoricalPoll)
+        self.assertIs(history_registry.get_by_label('external.poll'),
+                      ExternalPoll.history.model)
+        self.assertIsNone(history_registry.get(Country))
+        self.assertIsNone(history_registry.get_by_label('tests.country'))
+
+    def test_relations(self):
+        relations = history_registry.relations(Choice)
+        self.assertIs(relations.history_model, HistoricalChoice)
+        self.assertEqual(relations.history_fks,
+                         [(Choice._meta.get_field('poll'), HistoricalPoll)])
+        link_model = relations.fake_from[0][0]
+        self.assertEqual(relations.fake_from,
+                         [(link_model, 'poll_id', HistoricalPoll)])
+        self.assertEqual(history_registry.relations(Poll).fake_to,
+                         [(link_model, 'choice_set', HistoricalChoice)])
+        self.assertIs(history_registry.relations(Choice), relations)
+
+    def test_links_history_of_same_named_model(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        choice = Choice.objects.create(poll=poll, choice="yes", votes=0)
+        link_model = history_registry.relations(Choice).fake_from[0][0]
+        self.assertTrue(link_model.objects.filter(**{
+            'HistoricalPoll': poll.history.get(),
+            'HistoricalChoice': choice.history.get(),
+        }).exists())
+
+
 class CreateHistoryModelTests(unittest.TestCase):
 
     def test_create_history_model_with_one_to_one_field_to_integer_field(self):
@@ -442,6 +576,47 @@ class HistoryManagerTest(TestCase):
         self.assertEqual(most_recent.__class__, Poll)
         self.assertEqual(most_recent.question, "why?")
 
+    def test_most_recent_multi_table(self):
+        restaurant = Restaurant.objects.create(name="Tea 'N More", rating=5)
+        most_recent = restaurant.updates.most_recent()
+        self.assertEqual(most_recent.__class__, Restaurant)
+        self.assertEqual(most_recent.name, "Tea 'N More")
+        self.assertEqual(most_recent.rating, 5)
+        self.assertEqual(most_recent.pk, restaurant.pk)
+
+    def test_history_object_is_cached(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        record = poll.history.get()
+        with self.assertNumQueries(0):
+            history_object = record.history_object
+            self.assertIs(record.history_object, history_object)
+            self.assertIs(record.instance, history_object)
+        self.assertEqual(history_object.question, "what's up?")
+        self.assertEqual(history_object.pk, poll.pk)
+        self.assertFalse(history_object._state.adding)
+
+    def test_prev_and_next_record(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        poll.question = "how's it going?"
+        poll.save()
+        poll.question = "why?"
+        poll.save()
+        Poll.objects.create(question="other", pub_date=today)
+        first, second, third = poll.history.order_by('history_id')
+        # Records sharing a date are ordered by history_id.
+        first.history_date = second.history_date
+        first.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(second.prev_record, first)
+            self.assertEqual(second.prev_record, first)
+        with self.assertNumQueries(1):
+            next_record = second.next_record
+        self.assertEqual(next_record, third)
+        with self.assertNumQueries(0):
+            self.assertIs(next_record.prev_record, second)
+        self.assertIsNone(first.prev_record)
+        self.assertIsNone(third.next_record)
+
     def test_get_model(self):
         self.assertEqual(get_model('tests', 'poll'),
                          Poll)
@@ -727,7 +902,72 @@ class TestLatest(TestCase):
             {'pk': 1, 'history_date': yesterday},
             {'pk': 2, 'history_date': yesterday},
         ])
-        assert HistoricalPoll.objects.latest().pk == 1
+        # Ties are broken by history_id.
+        assert HistoricalPoll.objects.latest().pk == 2
+        assert HistoricalPoll.objects.earliest().pk == 1
+        self.assertEqual(
+            Poll.objects.get().history.latest().pk, 2)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Uses SQLite's query planner")
+class TestHistoryIndexes(TestCase):
+    """The default composite indexes serve the common history queries."""
+
+    def index_name(self, model, columns):
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA index_list(%s)' %
+                           connection.ops.quote_name(table))
+            names = [row[1] for row in cursor.fetchall()]
+            for name in names:
+                cursor.execute('PRAGMA index_info(%s)' %
+                               connection.ops.quote_name(name))
+                if [row[2] for row in cursor.fetchall()] == columns:
+                    return name
+        self.fail("No index on %s(%s)" % (table, ', '.join(columns)))
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = self.query_plan(queryset)
+        self.assertIn(index_name, plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_meta_options(self):
+        self.assertEqual(
+            set(HistoricalPoll._meta.index_together),
+            set([('id', 'history_date', 'history_id'),
+                 ('history_date', 'history_id')]))
+        self.assertIn(('poll', 'history_date', 'history_id'),
+                      PollInfo.history.model._meta.index_together)
+
+    def test_timeline_query(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        index_name = self.index_name(
+            HistoricalPoll, ['id', 'history_date', 'history_id'])
+        self.assertUsesIndex(poll.history.all(), index_name)
+
+    def test_as_of_query(self):
+        poll = Poll.objects.create(question="what's up?", pub_date=today)
+        index_name = self.index_name(
+            HistoricalPoll, ['id', 'history_date', 'history_id'])
+        self.assertUsesIndex(
+            poll.history.filter(history_date__lte=tomorrow)[:1], index_name)
+
+    def test_model_timeline_query(self):
+        index_name = self.index_name(HistoricalPoll,
+                                     ['history_date', 'history_id'])
+        self.assertUsesIndex(
+            Poll.history.filter(history_date__gte=yesterday), index_name)
+
+    def test_custom_index_together(self):
+        records = HistoricalRecords(index_together=[('history_date',)])
+        self.assertEqual(records.get_meta_options(Poll)['index_together'],
+                         [('history_date',)])
 
 
 class TestUserAccessor(unittest.TestCase):
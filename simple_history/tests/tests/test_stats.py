@@ -0,0 +1,115 @@
+from datetime import date, datetime, timedelta
+
+from django.core import management
+from django.test import TestCase
+from django.utils.timezone import now
+from six.moves import cStringIO as StringIO
+
+from simple_history import stats
+from simple_history.models import fake_m2m_models
+from ..models import Choice, Poll, Voter
+from ..custom_user.models import CustomUser
+
+
+def link_model(from_model, to_model):
+    for (left, link, _), (right, _, _) in fake_m2m_models.items():
+        if left is from_model and right is to_model:
+            return link
+
+
+class StatsTest(TestCase):
+
+    def setUp(self):
+        self.poll = Poll.objects.create(question="what's up?",
+                                        pub_date=datetime.now())
+        self.choice = Choice.objects.create(poll=self.poll, choice="not much",
+                                            votes=0)
+        self.user = CustomUser.objects.create(username="voter")
+        self.voter = Voter.objects.create(user=self.user, choice=self.choice)
+        for votes in range(1, 4):
+            self.choice.votes = votes
+            self.choice.save()
+
+    def test_estimated_count(self):
+        self.assertEqual(stats.estimated_count(Choice.history.model),
+                         (4, False))
+        self.assertEqual(stats.estimated_count(Poll.history.model,
+                                               exact=True), (1, False))
+
+    def test_versions_per_object(self):
+        Choice.objects.create(poll=self.poll, choice="nothing", votes=0)
+        with self.assertNumQueries(1):
+            histogram = stats.versions_per_object(Choice.history.model)
+        self.assertEqual(histogram, [(1, 1), (4, 1)])
+
+    def test_percentiles(self):
+        histogram = [(1, 90), (2, 9), (10, 1)]
+        self.assertEqual(stats.percentiles(histogram),
+                         [(50, 1), (90, 1), (99, 2), (100, 10)])
+        self.assertEqual(stats.percentiles([], ranks=(50,)), [(50, None)])
+
+    def test_rows_per_day(self):
+        Choice.history.filter(votes=1).update(
+            history_date=now() - timedelta(days=2))
+        per_day = stats.rows_per_day(Choice.history.model,
+                                     now() - timedelta(days=3))
+        self.assertEqual(len(per_day), 4)
+        self.assertEqual([rows for day, rows in per_day], [0, 1, 0, 3])
+        self.assertEqual(per_day[-1][0], now().date())
+        self.assertIsInstance(per_day[0][0], date)
+
+    def test_write_amplification(self):
+        saves, linked = stats.write_amplification(
+            Voter.history.model, now() - timedelta(days=1))
+        self.assertEqual(saves, 1)
+        self.assertEqual(linked[link_model(Voter, Choice)], 1)
+        self.assertEqual(linked[link_model(Voter, CustomUser)], 1)
+        # Links to the later choice records were written by their saves.
+        saves, linked = stats.write_amplification(
+            Choice.history.model, now() - timedelta(days=1))
+        self.assertEqual(saves, 4)
+        self.assertEqual(linked[link_model(Voter, Choice)], 3)
+
+    def test_history_stats(self):
+        result = stats.history_stats(Voter, Voter.history.model, days=1)
+        self.assertEqual(result.rows, 1)
+        self.assertEqual(result.objects, 1)
+        self.assertEqual(result.percentiles,
+                         [(50, 1), (90, 1), (99, 1), (100, 1)])
+        self.assertEqual(result.per_day, [(now().date(), 1)])
+        self.assertEqual(
+            len(stats.history_stats(Voter, Voter.history.model).per_day), 7)
+        self.assertEqual(
+            stats.history_stats(Voter, Voter.history.model, days=0).per_day,
+            [])
+        self.assertEqual(result.amplification, 2.0)
+
+    def test_command(self):
+        out = StringIO()
+        management.call_command('history_stats', 'tests.voter',
+                                'tests.choice', days=1, stdout=out)
+        output = out.getvalue()
+        self.assertIn("tests.choice: 4 records of 1 objects\n"
+                      "  versions per object: p50 4, p90 4, p99 4, max 4\n"
+                      "  last 1 days: 4 records, 4.0 per day\n"
+                      "  write amplification: 1.00 relation rows per record "
+                      "(HistoricalChoice_HistoricalPoll_fake 1, "
+                      "HistoricalVoter_HistoricalChoice_fake 3)\n", output)
+        self.assertIn("tests.voter: 1 records of 1 objects\n", output)
+        self.assertIn("  write amplification: 2.00 relation rows per record "
+                      "(HistoricalVoter_HistoricalChoice_fake 1, "
+                      "HistoricalVoter_HistoricalCustomUser_fake 1)\n", output)
+        self.assertIn("HistoricalVoter_HistoricalChoice_fake: 4 rows linking "
+                      "tests.voter and tests.choice\n", output)
+
+    def test_command_zero_days(self):
+        out = StringIO()
+        management.call_command('history_stats', 'tests.voter', days=0,
+                                stdout=out)
+        self.assertIn("  last 0 days: 0 records, 0.0 per day\n",
+                      out.getvalue())
+
+    def test_command_negative_days(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command('history_stats', 'tests.voter', days=-1,
+                                    stdout=StringIO())
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from django.test import TestCase
+
+from simple_history.metrics import recorders
+from simple_history.testing import (HistoryQueries, HistoryQueriesMixin,
+                                    assert_history_queries)
+from ..models import Choice, Poll
+
+today = datetime(2021, 1, 1, 10, 0)
+
+
+class HistoryQueriesTest(HistoryQueriesMixin, TestCase):
+
+    def setUp(self):
+        self.poll = Poll.objects.create(question="what's up?", pub_date=today)
+
+    def test_application_queries_not_counted(self):
+        with HistoryQueries(Poll) as queries:
+            self.poll.save()
+            Poll.objects.count()
+        self.assertTrue(len(queries) > 0)
+        self.assertIn('"tests_historicalpoll"',
+                      queries.captured_queries[0]['sql'])
+        self.assertFalse(any('"tests_poll"' in query['sql'] and
+                             'INSERT' in query['sql']
+                             for query in queries.captured_queries))
+        self.assertEqual(recorders, [])
+
+    def test_nested_writes_counted_once(self):
+        with HistoryQueries() as queries:
+            Choice.objects.create(poll=self.poll, choice="yes", votes=0)
+        self.assertEqual([(m.model, m.operation)
+                          for m in queries.measurements],
+                         [(Choice, 'post_save')])
+        self.assertEqual(len(queries), len(queries.measurements[0].queries))
+
+    def test_other_models_ignored(self):
+        with HistoryQueries(Choice) as queries:
+            self.poll.save()
+        self.assertEqual(len(queries), 0)
+
+    def test_assert_history_queries(self):
+        with self.assertHistoryQueries(Poll, 10):
+            self.poll.save()
+        with self.assertRaises(self.failureException) as cm:
+            with self.assertHistoryQueries(Poll, 0):
+                self.poll.save()
+        self.assertIn("history queries executed, at most 0 expected",
+                      str(cm.exception))
+        self.assertIn('1. ', str(cm.exception))
+
+    def test_assert_history_queries_function(self):
+        with self.assertRaises(AssertionError):
+            with assert_history_queries(max_queries=0):
+                self.poll.save()